@@ -2,8 +2,10 @@ from flask import Flask
 from flasgger import Swagger
 from flask_cors import CORS
 from .config import Config
+from .data.database import get_db_connection
 
 from .routes import register_blueprints
+from .routes.api.listing import ensure_list_indexes
 
 
 def create_app(config_class=Config):
@@ -25,6 +27,10 @@ def create_app(config_class=Config):
 
     # Register all blueprints for the application
     register_blueprints(app)
-    
+
+    # Build the indexes behind list filters once, off the request path
+    _, db = get_db_connection(config_class)
+    if db is not None:
+        ensure_list_indexes(db)
 
     return app
\ No newline at end of file
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 
 class Config:
@@ -7,6 +8,87 @@ class Config:
     
     MONGO_DATABASE_NAME = "event_driven_message_platform"
 
+    # delivery_receipts are buffered and bulk-written once either threshold is hit
+    RECEIPT_BATCH_SIZE = int(os.getenv('RECEIPT_BATCH_SIZE', 500))
+    RECEIPT_FLUSH_INTERVAL = float(os.getenv('RECEIPT_FLUSH_INTERVAL', 2.0))
+
+    # Default number of concurrent provider sends per campaign run
+    SEND_CONCURRENCY = int(os.getenv('SEND_CONCURRENCY', 4))
+
+    # Retryable provider errors are re-queued with exponential backoff and jitter (s)
+    SEND_MAX_ATTEMPTS = int(os.getenv('SEND_MAX_ATTEMPTS', 3))
+    RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 2.0))
+    RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 60.0))
+
+    # Campaign rate_limit is messages per minute; the sender limit is the provider's
+    # sustained messages per second, shared by every campaign using the same number
+    DEFAULT_CAMPAIGN_RATE_LIMIT = int(os.getenv('DEFAULT_CAMPAIGN_RATE_LIMIT', 100))
+    SENDER_RATE_LIMIT = float(os.getenv('SENDER_RATE_LIMIT', 80))
+
+    # Background campaign jobs: worker threads per process, progress write throttle (s),
+    # heartbeat interval (s) and how long without a heartbeat before a job counts as dead (s)
+    JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+    JOB_PROGRESS_INTERVAL = float(os.getenv('JOB_PROGRESS_INTERVAL', 1.0))
+    JOB_HEARTBEAT_INTERVAL = float(os.getenv('JOB_HEARTBEAT_INTERVAL', 30))
+    JOB_STALE_SECONDS = float(os.getenv('JOB_STALE_SECONDS', 300))
+
+    # Sharded campaign runs: default hash shards per campaign and worker lease length (s)
+    CAMPAIGN_SHARDS = int(os.getenv('CAMPAIGN_SHARDS', 8))
+    SHARD_LEASE_SECONDS = float(os.getenv('SHARD_LEASE_SECONDS', 30))
+
+    # Event outbox dispatcher: idle poll interval and when an unfinished claim is retried (s)
+    DISPATCH_POLL_INTERVAL = float(os.getenv('DISPATCH_POLL_INTERVAL', 1.0))
+    DISPATCH_STALE_SECONDS = float(os.getenv('DISPATCH_STALE_SECONDS', 300))
+
+    # User ingestion: uploads past the threshold (records) are validated on a process
+    # pool; at most INGEST_MAX_ERRORS invalid rows are reported per upload
+    INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', 4))
+    INGEST_PARALLEL_THRESHOLD = int(os.getenv('INGEST_PARALLEL_THRESHOLD', 10000))
+    INGEST_MAX_ERRORS = int(os.getenv('INGEST_MAX_ERRORS', 100))
+
+    # Background ingestion jobs: worker threads, largest accepted upload chunk (bytes)
+    # and how long a processing job may go without committing before it can be resumed (s)
+    INGEST_JOB_WORKERS = int(os.getenv('INGEST_JOB_WORKERS', 1))
+    INGEST_UPLOAD_CHUNK_SIZE = int(os.getenv('INGEST_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+    INGEST_JOB_STALE_SECONDS = float(os.getenv('INGEST_JOB_STALE_SECONDS', 300))
+
+    # Inbound webhook: records are acknowledged immediately, queued in memory and
+    # bulk-applied by a flusher; when the queue is full they spill to local disk
+    INBOUND_QUEUE_SIZE = int(os.getenv('INBOUND_QUEUE_SIZE', 10000))
+    INBOUND_BATCH_SIZE = int(os.getenv('INBOUND_BATCH_SIZE', 500))
+    INBOUND_FLUSH_INTERVAL = float(os.getenv('INBOUND_FLUSH_INTERVAL', 0.5))
+    INBOUND_SPILL_DIR = os.getenv('INBOUND_SPILL_DIR') or os.path.join(tempfile.gettempdir(), "inbound-spill")
+
+    # Status callbacks: coalescing window (s), batch size, status_history length and how
+    # long a callback waits for its send receipt to be written before it is dropped (s)
+    STATUS_FLUSH_INTERVAL = float(os.getenv('STATUS_FLUSH_INTERVAL', 0.5))
+    STATUS_BATCH_SIZE = int(os.getenv('STATUS_BATCH_SIZE', 500))
+    STATUS_HISTORY_CAP = int(os.getenv('STATUS_HISTORY_CAP', 20))
+    STATUS_ORPHAN_TTL = float(os.getenv('STATUS_ORPHAN_TTL', 60))
+
+    # How often (s) workers check whether the opted-out user set changed
+    SUPPRESSION_CHECK_INTERVAL = float(os.getenv('SUPPRESSION_CHECK_INTERVAL', 1.0))
+
+    # Twilio webhook retries are recognised for this long (s); in-process cache size
+    WEBHOOK_DEDUPE_TTL = int(os.getenv('WEBHOOK_DEDUPE_TTL', 86400))
+    WEBHOOK_DEDUPE_CACHE_SIZE = int(os.getenv('WEBHOOK_DEDUPE_CACHE_SIZE', 100000))
+
+    # Dashboard stats: "aggregate" ($facet per collection) or "counters" (O(1) reads of
+    # incrementally maintained counters); results are cached for STATS_CACHE_TTL (s)
+    STATS_MODE = os.getenv('STATS_MODE', 'aggregate')
+    STATS_CACHE_TTL = float(os.getenv('STATS_CACHE_TTL', 5.0))
+
+    # List endpoints: default and maximum page size, and the cursor batch size
+    # used when streaming a full dump as NDJSON
+    LIST_PAGE_SIZE = int(os.getenv('LIST_PAGE_SIZE', 100))
+    LIST_MAX_PAGE_SIZE = int(os.getenv('LIST_MAX_PAGE_SIZE', 1000))
+    LIST_STREAM_BATCH_SIZE = int(os.getenv('LIST_STREAM_BATCH_SIZE', 1000))
+
+    # Audience snapshots of event topics: reused by uploads within this window (s),
+    # and removed by a TTL index once they are this old (s)
+    AUDIENCE_SNAPSHOT_REUSE_SECONDS = float(os.getenv('AUDIENCE_SNAPSHOT_REUSE_SECONDS', 300))
+    AUDIENCE_SNAPSHOT_TTL = int(os.getenv('AUDIENCE_SNAPSHOT_TTL', 7 * 24 * 3600))
+
 class DevelopmentConfig(Config):
     DEBUG = True
 
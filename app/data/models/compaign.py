@@ -11,7 +11,8 @@ class CompaignModel(BaseModel):
         default={"start_time": None, "end_time": None}
     )
     status: str = Field(default="scheduled", pattern="^(scheduled|running|paused|completed)$")
-    rate_limit: Optional[int] = 100
+    rate_limit: Optional[int] = Field(default=100, description="Messages per minute")
+    concurrency: Optional[int] = Field(default=None, ge=1, le=64)
     quiet_hours: Dict[str, str] = Field(default={"start": "22:00", "end": "07:00"})
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
\ No newline at end of file
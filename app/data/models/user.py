@@ -3,6 +3,8 @@ from typing import Dict, Any, Optional
 from datetime import datetime
 import re
 
+E164_PATTERN = re.compile(r"^\+[1-9]\d{1,14}$")
+
 class UserModel(BaseModel):
     id: str = Field(..., alias="_id" ,description="Phone number in E.164 format (e.g., +14155552671)")
     wa_id: Optional[str] = Field(None, description="WhatsApp ID")
@@ -20,6 +22,6 @@ class UserModel(BaseModel):
     @field_validator('id')
     @classmethod
     def validate_phone_number(cls, value):
-        if not re.match(r"^\+[1-9]\d{1,14}$", value):
+        if not E164_PATTERN.match(value):
             raise ValueError("Phone number must be in E.164 format (e.g., +14155552671)")
         return value
\ No newline at end of file
@@ -2,6 +2,8 @@ from flask import Blueprint, request, jsonify
 from app.data.database import get_db_connection, utc_now
 from app.data.models.compaign import CompaignModel
 from app.config import Config
+from app.routes.api.listing import list_documents
+from app.services.rollups import campaign_analytics
 from pydantic import ValidationError
 from datetime import datetime
 from bson.objectid import ObjectId
@@ -15,10 +17,7 @@ def list_campaigns():
     
     _, db = get_db_connection(Config)
     
-    campaigns = list(db.campaigns.find({}))
-    for campaign in campaigns:
-        campaign["_id"] = str(campaign["_id"])
-    return jsonify(campaigns), 200
+    return list_documents(db.campaigns)
 
 
 @campaigns_bp.route("/", methods=["POST"])
@@ -76,3 +75,19 @@ def delete_campaign(camp_id):
     if res.deleted_count == 0:
         return jsonify({"error": "Campaign not found"}), 404
     return jsonify({"message": "Campaign deleted successfully"}), 200
+
+
+@campaigns_bp.route("/<string:camp_id>/analytics", methods=["GET"])
+def get_campaign_analytics(camp_id):
+    """Returns a campaign's delivery funnel and time series from its rollups."""
+    
+    _, db = get_db_connection(Config)
+    
+    try:
+        start = datetime.fromisoformat(request.args["from"]) if request.args.get("from") else None
+        end = datetime.fromisoformat(request.args["to"]) if request.args.get("to") else None
+        interval = int(request.args.get("interval", 60))
+    except ValueError:
+        return jsonify({"error": "'from'/'to' must be ISO-8601 timestamps and 'interval' a number of minutes"}), 400
+    
+    return jsonify(campaign_analytics(db, camp_id, start, end, interval)), 200
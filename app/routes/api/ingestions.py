@@ -1,72 +1,39 @@
-import io, csv, json
 from flask import Blueprint, request, jsonify
-from app.data.models.user import UserModel
 from app.data.database import get_db_connection
 from app.config import DevelopmentConfig as Config
-from datetime import datetime
-from pydantic import ValidationError
+from app.services.ingestion import (
+    IngestionError, open_user_records, open_event_records, new_summary,
+    ingest_user_records, ingest_event_records
+)
+from app.services.stats import get_stats
+from app.services.ingestion_jobs import (
+    UploadConflict, create_ingestion_job, append_chunk, start_ingestion_job, get_ingestion_job
+)
 
 ingestion_bp = Blueprint("ingestion_api", __name__, url_prefix="/ingestions")
 
 @ingestion_bp.route("/users", methods=["POST"])
 def ingest_users():
     """
-    Upload a CSV or JSON user file for ingestion.
+    Upload a CSV, JSON or NDJSON user file (optionally gzip/zstd-compressed) for ingestion.
     """
     _, db = get_db_connection(Config)
     file = request.files.get("file")
     if not file:
         return jsonify({"error": "No file provided"}), 400
 
-    # Determine file type and parse records
-    filename = file.filename.lower()
-    if filename.endswith(".csv"):
-        records = list(csv.DictReader(io.StringIO(file.stream.read().decode("utf-8"))))
-    elif filename.endswith(".json"):
-        records = json.load(file.stream)
-    else:
-        return jsonify({"error": "Unsupported file format"}), 400
-
-    # Initialize a summary of the ingestion process
-    summary = {
-        "total": len(records),
-        "valid": 0,
-        "invalid": 0,
-        "duplicates": 0,
-        "merged": 0,
-        "new": 0
-    }
-
-    for record in records:
-        # Clean and validate each record using the Pydantic model
-        try:
-            cleaned_record = {str(k).strip().lstrip("\ufeff"): v for k, v in record.items()}
-            
-            if "attributes" in cleaned_record and isinstance(cleaned_record["attributes"], str):
-                try:
-                    cleaned_record["attributes"] = json.loads(cleaned_record["attributes"])
-                except json.JSONDecodeError:
-                    cleaned_record["attributes"] = {}
-            
-            user = UserModel(**cleaned_record)
-        except ValidationError as e:
-            print("❌ Validation failed for record:", cleaned_record)
-            print("📋 Details:", e.errors())
-            summary["invalid"] += 1
-            continue
-
-        # Check for existing user and merge/update or create new
-        existing = db["users"].find_one({"$or":[{"id": user.id}, {"_id": user.id}]})
-        if existing:
-            existing.pop('_id', None)
-            new_user_data = user.model_dump(by_alias=True, exclude={"_id","id"})
-            merged = {**existing, **new_user_data, "updated_at": datetime.utcnow()}
-            db["users"].update_one({"id": user.id}, {"$set": merged})
-            summary["merged"] += 1
-        else:
-            db["users"].insert_one(user.dict())
-            summary["new"] += 1
-        summary["valid"] += 1
+    # Sniff compression and file type and pick a streaming parser; nothing is read into memory up front
+    try:
+        records = open_user_records(file.stream, file.filename)
+    except IngestionError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Validate and persist the records in fixed-size chunks
+    summary = new_summary()
+    try:
+        ingest_user_records(db, records, summary=summary)
+    except IngestionError as e:
+        return jsonify({"error": str(e), "summary": summary}), 400
 
     return jsonify({"message": "Ingestion completed", "summary": summary}), 200
 
@@ -74,73 +41,85 @@ def ingest_users():
 @ingestion_bp.route("/events", methods=["POST"])
 def ingest_jsonl_events():
     """
-    Ingest a JSONL trigger events file and resolve segment recipients.
+    Ingest a JSONL trigger events file (optionally gzip/zstd-compressed) and resolve segment recipients.
     """
     _, db = get_db_connection(Config)
     file = request.files.get("file")
     if not file:
         return jsonify({"error": "No file provided"}), 400
 
-    # Read each line of the JSONL file as a separate JSON object
-    events = []
-    for line in file.stream:
-        try:
-            event = json.loads(line.decode("utf-8").strip())
-            events.append(event)
-        except json.JSONDecodeError:
-            continue
-
-    # Resolve recipients for each event based on segment rules
-    resolved = []
-    triggered = 0
-    for ev in events:
-        rule = ev.get("segment_rule", {})
-        topic = rule.get("topic")
-        if not topic:
-            continue
-
-        # Find users subscribed to the topic
-        user_ids = [
-            sub["user_id"]
-            for sub in db["subscriptions"].find({"topic": topic})
-        ]
-
-        ev["recipients"] = user_ids
-        resolved.append(ev)
-        
-        # If a scheduled campaign exists for the topic, trigger it
-        campaign = db["campaigns"].find_one({"topic": topic, "status": "scheduled"})
-        if campaign:
-            from app.services.campaign_runner import run_campaign
-            run_campaign(campaign["_id"])
-            triggered += 1
-            
-    if resolved:
-        db["events_inbound"].insert_many(resolved)
-
-    return jsonify({"message": "Events ingested", "count": len(resolved), "campaigns_triggered": triggered}), 200
+    # Parse the JSONL file line by line and store the events in chunks
+    try:
+        summary = ingest_event_records(db, open_event_records(file.stream))
+    except IngestionError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify({
+        "message": "Events ingested",
+        "count": summary["count"],
+        "campaigns_triggered": summary["campaigns_triggered"]
+    }), 200
+
+
+@ingestion_bp.route("/jobs", methods=["POST"])
+def create_job():
+    """
+    Register a resumable upload for background ingestion.
+    Send the file with PUT /jobs/<id>/chunks?offset=N, then POST /jobs/<id>/start.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        job_id = create_ingestion_job(data.get("kind", "users"), data.get("filename"), data.get("size"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"job_id": job_id, "offset": 0, "max_chunk_size": Config.INGEST_UPLOAD_CHUNK_SIZE}), 201
+
+
+@ingestion_bp.route("/jobs/<string:job_id>/chunks", methods=["PUT"])
+def upload_job_chunk(job_id):
+    """
+    Append the request body to an upload at the given byte offset.
+    On 409 the response carries the offset to continue from.
+    """
+    offset = request.args.get("offset", type=int)
+    if offset is None:
+        return jsonify({"error": "offset is required"}), 400
+    try:
+        new_offset = append_chunk(job_id, offset, request.get_data())
+    except UploadConflict as e:
+        return jsonify({"error": str(e), "offset": e.offset}), 409
+    if new_offset is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify({"offset": new_offset}), 200
+
+
+@ingestion_bp.route("/jobs/<string:job_id>/start", methods=["POST"])
+def start_job(job_id):
+    """
+    Start processing an uploaded file, or resume a failed job from its last committed chunk.
+    """
+    status = start_ingestion_job(job_id)
+    if status is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify({"job_id": job_id, "status": status}), 202
+
+
+@ingestion_bp.route("/jobs/<string:job_id>", methods=["GET"])
+def get_job_status(job_id):
+    """
+    Report an ingestion job's progress, throughput and partial summary.
+    """
+    job = get_ingestion_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200
 
 
 @ingestion_bp.route("/stats", methods=["GET"])
 def get_campaign_stats():
     """
     Returns delivery and user statistics for dashboard display.
+    Served from a short-lived cache shared by concurrent dashboard polls.
     """
     _, db = get_db_connection(Config)
-    total_users = db["users"].count_documents({})
-    opt_outs = db["users"].count_documents({"consent_state": "STOPPED"})
-    total_receipts = db["delivery_receipts"].count_documents({})
-    sent = db["delivery_receipts"].count_documents({"status": "SUCCESS"})
-    failed = db["delivery_receipts"].count_documents({"status": "ERROR"})
-
-    delivery_pct = (sent / total_receipts * 100) if total_receipts > 0 else 0
-    failed_pct = (failed / total_receipts * 100) if total_receipts > 0 else 0
-
-    return jsonify({
-        "total_users": total_users,
-        "opt_outs": opt_outs,
-        "sent": sent,
-        "failed": failed,
-        "delivery_pct": round(delivery_pct, 2),
-        "failed_pct": round(failed_pct, 2)
-    }), 200
+    return jsonify(get_stats(db)), 200
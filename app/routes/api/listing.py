@@ -0,0 +1,94 @@
+from urllib.parse import urlencode
+from flask import request, jsonify, current_app, Response, stream_with_context
+from pymongo import ASCENDING
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from app.config import Config
+
+
+# Exact-match filters each list endpoint accepts; every one is backed by a (field, _id) index
+LIST_FILTERS = {
+    "users": ("id", "consent_state"),
+    "subscriptions": ("user_id", "topic"),
+    "campaigns": ("topic", "segment_id", "template_id"),
+    "segments": ("topic", "name"),
+    "templates": ("channel", "locale")
+}
+
+
+def ensure_list_indexes(db):
+    """Creates the indexes behind the list filters; run once at startup, not per request."""
+    for collection, fields in LIST_FILTERS.items():
+        for field in fields:
+            db[collection].create_index([(field, ASCENDING), ("_id", ASCENDING)])
+
+
+def _parse_after(after: str):
+    try:
+        return ObjectId(after)
+    except (InvalidId, TypeError):
+        return after
+
+
+def _serialize(doc: dict) -> dict:
+    doc["_id"] = str(doc["_id"])
+    return doc
+
+
+def list_documents(collection):
+    """
+    Lists a collection in `_id` order, one keyset page at a time.
+
+    Query parameters:
+      - `limit`: page size (default LIST_PAGE_SIZE, capped at LIST_MAX_PAGE_SIZE;
+        unbounded by default when streaming)
+      - `after`: the `_id` of the last document of the previous page
+      - `fields`: comma-separated fields to return (`_id` is always included)
+      - any of the collection's LIST_FILTERS fields: exact-match filters
+
+    The body stays a JSON array; the cursor of the next page is returned in
+    the `X-Next-Cursor` and `Link` headers. With `format=ndjson` (or
+    `Accept: application/x-ndjson`) every matching document is streamed as
+    one JSON line, straight off the cursor, so memory stays flat however
+    large the collection is.
+    """
+    args = request.args
+    stream = args.get("format") == "ndjson" or request.accept_mimetypes.best == "application/x-ndjson"
+    try:
+        limit = int(args["limit"]) if "limit" in args else (0 if stream else Config.LIST_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"error": "'limit' must be an integer"}), 400
+    if "limit" in args and limit <= 0:
+        return jsonify({"error": "'limit' must be positive"}), 400
+    if not stream:
+        limit = min(limit, Config.LIST_MAX_PAGE_SIZE)
+
+    query = {field: args[field] for field in LIST_FILTERS.get(collection.name, ()) if field in args}
+    if args.get("after"):
+        query["_id"] = {"$gt": _parse_after(args["after"])}
+
+    fields = [field.strip() for field in args.get("fields", "").split(",") if field.strip()]
+    projection = {field: 1 for field in fields} or None
+
+    cursor = collection.find(query, projection).sort("_id", ASCENDING)
+
+    if stream:
+        if limit:
+            cursor = cursor.limit(limit)
+        encode = current_app.json.dumps
+
+        def generate():
+            for doc in cursor.batch_size(Config.LIST_STREAM_BATCH_SIZE):
+                yield encode(_serialize(doc)) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+    # Fetch one extra document to learn whether another page follows
+    docs = [_serialize(doc) for doc in cursor.limit(limit + 1)]
+    response = jsonify(docs[:limit])
+    if len(docs) > limit:
+        next_cursor = docs[limit - 1]["_id"]
+        response.headers["X-Next-Cursor"] = next_cursor
+        next_args = {**args.to_dict(), "after": next_cursor}
+        response.headers["Link"] = f'<{request.base_url}?{urlencode(next_args)}>; rel="next"'
+    return response, 200
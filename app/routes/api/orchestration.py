@@ -1,5 +1,7 @@
-from flask import Blueprint, jsonify
-from app.services.campaign_runner import run_campaign
+from flask import Blueprint, jsonify, request
+from app.data.database import get_db_connection
+from app.config import DevelopmentConfig as Config
+from app.services.jobs import submit_campaign_job, find_active_job, get_job
 
 orchestration_bp = Blueprint("orchestration_api", __name__, url_prefix="/orchestration")
 
@@ -7,7 +9,28 @@ orchestration_bp = Blueprint("orchestration_api", __name__, url_prefix="/orchest
 def trigger_campaign(campaign_id):
     """
     Trigger a campaign run manually.
+    The run is queued as a background job; poll the returned job id for progress.
+    Pass `?shards=N` to split the audience across local worker processes.
+    If the campaign already has a queued or running job, that job is returned instead.
     """
-    # Calls the campaign runner service to start the campaign
-    result = run_campaign(campaign_id)
-    return jsonify(result), 200
+    shards = request.args.get("shards", type=int)
+    if shards is not None and shards < 1:
+        return jsonify({"error": "'shards' must be positive"}), 400
+
+    _, db = get_db_connection(Config)
+    active = find_active_job(db, campaign_id)
+    if active:
+        return jsonify({"message": "Campaign run already in progress", "job_id": str(active["_id"]), "status": active["status"]}), 200
+
+    job_id = submit_campaign_job(campaign_id, shards=shards)
+    return jsonify({"message": "Campaign run queued", "job_id": job_id, "status": "queued"}), 202
+
+@orchestration_bp.route("/jobs/<string:job_id>", methods=["GET"])
+def get_campaign_job(job_id):
+    """
+    Report the progress of a campaign job.
+    """
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200
@@ -4,6 +4,7 @@ from app.data.models.segment import SegmentModel
 from pydantic import ValidationError
 from datetime import datetime
 from app.config import Config
+from app.routes.api.listing import list_documents
 from bson.objectid import ObjectId
 
 segments_bp = Blueprint("segments_api", __name__, url_prefix="/segments")
@@ -12,10 +13,7 @@ segments_bp = Blueprint("segments_api", __name__, url_prefix="/segments")
 def list_segments():
     """Lists all segments."""
     _, db = get_db_connection(Config)
-    segments = list(db.segments.find({}))
-    for segment in segments:
-        segment["_id"] = str(segment["_id"])
-    return jsonify(segments), 200
+    return list_documents(db.segments)
 
 @segments_bp.route("/", methods=["POST"])
 def create_segment():
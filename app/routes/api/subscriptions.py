@@ -2,6 +2,7 @@ from flask import Blueprint, request, jsonify
 from app.data.database import get_db_connection, utc_now
 from app.data.models.subscription import SubscriptionModel
 from app.config import Config
+from app.routes.api.listing import list_documents
 from pydantic import ValidationError
 from datetime import datetime
 
@@ -12,10 +13,7 @@ def list_subscriptions():
     """Lists all subscriptions."""
     _, db = get_db_connection(Config)
     
-    subs = list(db.subscriptions.find({}))
-    for sub in subs:
-        sub["_id"] = str(sub["_id"])
-    return jsonify(subs), 200
+    return list_documents(db.subscriptions)
 
 
 @subscriptions_bp.route("/", methods=["POST"])
@@ -4,10 +4,25 @@ from app.data.models.template import TemplateModel
 from pydantic import ValidationError
 from datetime import datetime
 from app.config import Config
+from app.routes.api.listing import list_documents
 from bson.objectid import ObjectId
+from app.services.template_renderer import compile_template
 
 templates_bp = Blueprint("templates_api", __name__, url_prefix="/templates")
 
+
+def validate_placeholders(template: TemplateModel):
+    """
+    Checks the content's placeholders against the declared ones using the
+    same compiled form the campaign runner renders with.
+    Fills `placeholders` when none were declared; returns the undeclared ones.
+    """
+    compiled = compile_template(template.content)
+    if not template.placeholders:
+        template.placeholders = list(compiled.placeholders)
+        return []
+    return compiled.undeclared(template.placeholders)
+
 @templates_bp.route("/", methods=["GET"])
 def list_templates():
     """Lists all message templates."""
@@ -16,10 +31,7 @@ def list_templates():
     if db is None:
         return jsonify({"error": "Database connection failed or configuration is invalid"}), 500
     
-    templates = list(db.templates.find({}))
-    for template in templates:
-        template["_id"] = str(template["_id"])
-    return jsonify(templates), 200
+    return list_documents(db.templates)
 
 @templates_bp.route("/", methods=["POST"])
 def create_template():
@@ -35,6 +47,10 @@ def create_template():
     except ValidationError as e:
         return jsonify({"error": e.errors()}), 400
     
+    undeclared = validate_placeholders(template)
+    if undeclared:
+        return jsonify({"error": "Template uses undeclared placeholders", "undeclared": undeclared}), 400
+    
     template.created_at = utc_now()
     template.updated_at = utc_now()
     
@@ -53,12 +69,19 @@ def update_template(template_id):
     
     data = request.get_json()
     merged = {**existing, **data, "updated_at": datetime.utcnow()}
+    if "content" in data and "placeholders" not in data:
+        # New content without an explicit declaration: derive placeholders again
+        merged["placeholders"] = []
     
     try:
         template = TemplateModel(**merged)
     except ValidationError as e:
         return jsonify({"error": e.errors()}), 400
     
+    undeclared = validate_placeholders(template)
+    if undeclared:
+        return jsonify({"error": "Template uses undeclared placeholders", "undeclared": undeclared}), 400
+    
     db["templates"].update_one({"_id": ObjectId(template_id)}, {"$set": template.model_dump(by_alias=True)})
     return jsonify({"message": "Template updated successfully"}), 200
 
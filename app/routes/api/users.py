@@ -3,6 +3,8 @@ from flask import Blueprint, request, jsonify, current_app
 from app.data.database import get_db_connection, utc_now
 from app.data.models.user import UserModel
 from app.config import Config
+from app.routes.api.listing import list_documents
+from app.services.suppression import bump_suppression_version
 from pydantic import ValidationError
 from datetime import datetime
 
@@ -14,11 +16,7 @@ users_bp = Blueprint('users_api', __name__, url_prefix='/users')
 def list_users():
     """Lists all users."""
     _, db = get_db_connection(Config)
-    users = list(db.users.find({}))
-    
-    for user in users:
-        user['_id'] = str(user['_id'])
-    return jsonify(users), 200
+    return list_documents(db.users)
 
 @users_bp.route('/', methods=['POST'])
 def create_user():
@@ -34,6 +32,8 @@ def create_user():
     user.updated_at = utc_now()
     
     db["users"].insert_one(user.dict())
+    if user.consent_state == "STOPPED":
+        bump_suppression_version(db)
     return jsonify({"message": "User created successfully"}), 201
 
 @users_bp.route("/<string:user_id>", methods=["PUT"])
@@ -65,6 +65,8 @@ def update_user(user_id):
 
     # Save validated data
     db["users"].update_one({"id": user_id}, {"$set": update_data})
+    if existing.get("consent_state") != user.consent_state:
+        bump_suppression_version(db)
 
     return jsonify({"message": "User updated successfully"}), 200
 
@@ -75,5 +77,6 @@ def delete_user(user_id):
     result = db["users"].delete_one({"id": user_id})
     if result.deleted_count == 0:
         return jsonify({"error": "User not found"}), 404
+    bump_suppression_version(db)
     return jsonify({"message": "User deleted successfully"}), 200
     
\ No newline at end of file
@@ -1,8 +1,10 @@
-from flask import Blueprint, request, jsonify, current_app
-from datetime import datetime
+from flask import Blueprint, request, jsonify
 from app.data.database import get_db_connection
 from app.config import Config
-import re
+from app.services.webhook_dedupe import get_webhook_dedupe, dedupe_key
+from app.services.status_pipeline import get_status_pipeline
+from app.services.inbound_queue import parse_inbound, get_inbound_queue
+from app.data.models.user import E164_PATTERN
 
 webhook_bp = Blueprint('webhooks', __name__, url_prefix='/twilio')
 
@@ -11,72 +13,37 @@ def inbound_message():
     """
     Twilio inbound WhatsApp message webhook.
     Handles START, STOP, SUBSCRIBE, and UNSUBSCRIBE commands.
+    The message is queued and acknowledged before it is persisted.
     """
     _, db = get_db_connection(Config)
     data = request.form.to_dict()
-    from_number = data.get("From", "").replace("whatsapp:", "")
-    body = data.get("Body", "").strip().upper()
-    
-    
-    normalized = {"command": None, "topic": None} # To store the parsed command
-    
-    if body == "START":
-        db["users"].update_one({"id": from_number}, {"$set": {"consent_state": "SUBSCRIBED"}}, upsert=True)
-        normalized["command"] = "START"
-    elif body == "STOP":
-        db["users"].update_one({"id": from_number}, {"$set": {"consent_state": "STOPPED"}}, upsert=True)
-        normalized["command"] = "STOP"
-    elif body.startswith("SUBSCRIBE "):
-        topic = body.split("SUBSCRIBE ", 1)[1]
-        normalized.update({"command": "SUBSCRIBE", "topic": topic})
-        db["subscriptions"].update_one(
-            {"user_id": from_number, "topic": topic},
-            {"$set": {"user_id": from_number, "topic": topic, "subscribed_at": datetime.utcnow()}},
-            upsert=True
-        )
-    elif body.startswith("UNSUBSCRIBE "):
-        topic = body.split("UNSUBSCRIBE ", 1)[1]
-        normalized.update({"command": "UNSUBSCRIBE", "topic": topic})
-        db["subscriptions"].delete_one({"user_id": from_number, "topic": topic})
+    record = parse_inbound(data)
+    if not E164_PATTERN.match(record["from"]):
+        return jsonify({"error": "Invalid sender"}), 400
 
-    # Log the inbound event to the database
-    record = {
-        "from": from_number,
-        "body": data.get("Body", ""),
-        "timestamp": datetime.utcnow(),
-        "type": "inbound",
-        **normalized
-    }
-    
-    db["events_inbound"].insert_one(record)
+    # Twilio retries slow responses; acknowledge a retry of an applied message without queueing it.
+    # Retries that arrive before the first delivery is applied are dropped by the flusher's claim.
+    if get_webhook_dedupe(db).is_claimed(dedupe_key(data.get("MessageSid"))):
+        return jsonify({"status": "duplicate", "command": record["command"], "topic": record["topic"]}), 200
 
-    return jsonify({"status": "processed", "command": normalized["command"], "topic": normalized.get("topic")}), 200
+    # Acknowledge right away; the flusher applies consent, subscriptions and the event log in bulk
+    get_inbound_queue().put(record)
+
+    return jsonify({"status": "accepted", "command": record["command"], "topic": record["topic"]}), 200
 
 @webhook_bp.route('/status', methods=['POST'])
 def message_status_callback():
     """
     Twilio status callback webhook for outbound message lifecycle.
     Tracks queued, sending, sent, delivered, read, failed, etc.
+    on the send receipt with the matching twilio_sid.
     """
     _, db = get_db_connection(Config)
     data = request.form.to_dict()
-    message_sid = data.get("MessageSid")
-    message_status = data.get("MessageStatus")
-    error_code = data.get("ErrorCode")
-
-    # Record the status update for the given message SID
-    record = {
-        "message_sid": message_sid,
-        "status": message_status,
-        "error_code": error_code,
-        "timestamp": datetime.utcnow(),
-        "type": "status_callback"
-    }
+    if get_webhook_dedupe(db).is_claimed(dedupe_key(data.get("MessageSid"), data.get("MessageStatus"))):
+        return jsonify({"status": "duplicate"}), 200
 
-    db["delivery_receipts"].update_one(
-        {"message_sid": message_sid},
-        {"$set": record},
-        upsert=True
-    )
+    # Coalesced with other callbacks for the message and applied to its send receipt in bulk
+    get_status_pipeline().record(data.get("MessageSid"), data.get("MessageStatus"), data.get("ErrorCode"))
 
-    return jsonify({"status": "updated"}), 200
\ No newline at end of file
+    return jsonify({"status": "updated"}), 200
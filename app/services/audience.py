@@ -0,0 +1,146 @@
+import zlib
+from datetime import datetime, timedelta
+from itertools import islice
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from app.config import Config
+
+
+DEFAULT_BATCH_SIZE = 500
+
+
+def shard_of(user_id: str, shard_count: int) -> int:
+    """Stable hash partition of a user id, identical across processes and hosts."""
+    return zlib.crc32(str(user_id).encode("utf-8")) % shard_count
+
+
+def iter_audience_batches(db, topic: str, batch_size: int = DEFAULT_BATCH_SIZE, after=None, shard: tuple = None,
+                          exclude=None, on_excluded=None):
+    """
+    Streams the users subscribed to a topic one batch at a time.
+    Subscriptions are read lazily in `_id` order and joined to users with
+    one `$in` query per batch, so memory stays bounded by `batch_size`.
+    Yields `(last_key, users)`, where `last_key` is the last subscription
+    `_id` of the batch; pass it back as `after` to resume past that batch.
+    Users keep subscription order; subscribers without a user document
+    are skipped. With `shard=(index, count)` only users hashing to that
+    shard are fetched. Ids in `exclude` (e.g. the suppression index) are
+    dropped before any user document is read; `on_excluded(n)` is told
+    how many were dropped per batch.
+    """
+    db["subscriptions"].create_index([("topic", ASCENDING), ("_id", ASCENDING)])
+
+    query = {"topic": topic}
+    if after is not None:
+        query["_id"] = {"$gt": after}
+    subs_cursor = db["subscriptions"].find(
+        query,
+        {"user_id": 1},
+        batch_size=batch_size
+    ).sort("_id", ASCENDING)
+
+    while True:
+        chunk = list(islice(subs_cursor, batch_size))
+        if not chunk:
+            break
+
+        user_ids = [sub["user_id"] for sub in chunk]
+        if shard:
+            user_ids = [uid for uid in user_ids if shard_of(uid, shard[1]) == shard[0]]
+        if exclude is not None:
+            kept = [uid for uid in user_ids if uid not in exclude]
+            if on_excluded and len(kept) < len(user_ids):
+                on_excluded(len(user_ids) - len(kept))
+            user_ids = kept
+        users_by_id = {
+            user["id"]: user
+            for user in db["users"].find({"id": {"$in": user_ids}})
+        } if user_ids else {}
+        yield chunk[-1]["_id"], [users_by_id[uid] for uid in user_ids if uid in users_by_id]
+
+
+def iter_audience(db, topic: str, batch_size: int = DEFAULT_BATCH_SIZE, after=None):
+    """
+    Streams the users subscribed to a topic, see `iter_audience_batches`.
+    The first users are yielded before the whole topic has been scanned.
+    """
+    for _, users in iter_audience_batches(db, topic, batch_size, after):
+        yield from users
+
+
+SNAPSHOT_CHUNK_SIZE = 5000
+
+
+def snapshot_topic_audiences(db, topics, chunk_size: int = SNAPSHOT_CHUNK_SIZE, reuse_within: float = None) -> dict:
+    """
+    Materializes the current subscribers of several topics with a single
+    aggregation. Each topic's user ids are written to `audience_snapshots`
+    as fixed-size chunk documents, so no document grows with the topic,
+    followed by a header document (seq -1) with the recipient count.
+    A topic snapshotted less than `reuse_within` seconds ago reuses that
+    snapshot, and snapshots expire AUDIENCE_SNAPSHOT_TTL seconds after
+    they were taken.
+    Returns {topic: {"snapshot_id", "recipient_count"}} for every topic
+    requested, including topics without subscribers.
+    """
+    reuse_within = Config.AUDIENCE_SNAPSHOT_REUSE_SECONDS if reuse_within is None else reuse_within
+    snapshots = db["audience_snapshots"]
+    snapshots.create_index([("snapshot_id", ASCENDING), ("seq", ASCENDING)])
+    snapshots.create_index([("topic", ASCENDING), ("seq", ASCENDING), ("created_at", DESCENDING)])
+    snapshots.create_index([("created_at", ASCENDING)], expireAfterSeconds=int(Config.AUDIENCE_SNAPSHOT_TTL))
+
+    topics = list(dict.fromkeys(topics))
+    now = datetime.utcnow()
+    resolved = {}
+    if topics and reuse_within > 0:
+        # Headers are written after their chunks, so a header means the snapshot is complete
+        recent = snapshots.find({
+            "topic": {"$in": topics}, "seq": -1, "created_at": {"$gte": now - timedelta(seconds=reuse_within)}
+        }).sort("created_at", ASCENDING)
+        for header in recent:
+            resolved[header["topic"]] = {"snapshot_id": header["snapshot_id"], "recipient_count": header["recipient_count"]}
+
+    fresh = [topic for topic in topics if topic not in resolved]
+    resolved.update({topic: {"snapshot_id": ObjectId(), "recipient_count": 0} for topic in fresh})
+    if not fresh:
+        return resolved
+
+    def write_chunk(topic, user_ids, seq):
+        snapshots.insert_one({
+            "snapshot_id": resolved[topic]["snapshot_id"],
+            "topic": topic,
+            "seq": seq,
+            "user_ids": user_ids,
+            "created_at": now
+        })
+
+    cursor = db["subscriptions"].aggregate([
+        {"$match": {"topic": {"$in": fresh}}},
+        {"$sort": {"topic": ASCENDING, "_id": ASCENDING}},
+        {"$project": {"_id": 0, "topic": 1, "user_id": 1}}
+    ], allowDiskUse=True)
+
+    current, user_ids, seq = None, [], 0
+    for sub in cursor:
+        if sub["topic"] != current or len(user_ids) >= chunk_size:
+            if user_ids:
+                write_chunk(current, user_ids, seq)
+            seq = seq + 1 if sub["topic"] == current else 0
+            current, user_ids = sub["topic"], []
+        user_ids.append(sub["user_id"])
+        resolved[current]["recipient_count"] += 1
+    if user_ids:
+        write_chunk(current, user_ids, seq)
+
+    snapshots.insert_many([
+        {"snapshot_id": resolved[topic]["snapshot_id"], "topic": topic, "seq": -1,
+         "recipient_count": resolved[topic]["recipient_count"], "created_at": now}
+        for topic in fresh
+    ])
+    return resolved
+
+
+def iter_snapshot_recipients(db, snapshot_id):
+    """Streams the user ids of an audience snapshot in subscription order."""
+    for chunk in db["audience_snapshots"].find({"snapshot_id": snapshot_id, "seq": {"$gte": 0}}).sort("seq", ASCENDING):
+        yield from chunk["user_ids"]
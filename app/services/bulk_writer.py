@@ -0,0 +1,76 @@
+from threading import Lock
+from time import monotonic
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+
+class BulkWriter:
+    """
+    Buffers writes to one collection and flushes them in one unordered
+    bulk_write once `max_batch` operations are queued or `max_interval`
+    seconds have passed since the oldest buffered one.
+    Keep one writer per long-lived producer (a campaign run, the deferred
+    queue); a writer opened for a single write is just a one-op bulk_write.
+    Use it as a context manager so the buffer is always flushed,
+    including when the surrounding work fails.
+    """
+
+    def __init__(self, collection, max_batch: int = 500, max_interval: float = 2.0):
+        self.collection = collection
+        self.max_batch = max_batch
+        self.max_interval = max_interval
+        self._ops = []
+        self._first_buffered_at = None
+        self._lock = Lock()
+        self._flush_lock = Lock()
+
+    def insert(self, document: dict):
+        """Queues a new document."""
+        self._add(InsertOne(document), document)
+
+    def update(self, filter: dict, update: dict, upsert: bool = False):
+        """Queues an update to existing documents."""
+        self._add(UpdateOne(filter, update, upsert=upsert))
+
+    def _add(self, op, document: dict = None):
+        with self._lock:
+            if not self._ops:
+                self._first_buffered_at = monotonic()
+            self._ops.append((op, document))
+            due = (
+                len(self._ops) >= self.max_batch
+                or monotonic() - self._first_buffered_at >= self.max_interval
+            )
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered operations and returns how many were sent."""
+        # Serialize flushes so batches reach Mongo in the order they were buffered
+        with self._flush_lock:
+            with self._lock:
+                ops, self._ops = self._ops, []
+                self._first_buffered_at = None
+            if not ops:
+                return 0
+
+            failed = set()
+            try:
+                self.collection.bulk_write([op for op, _ in ops], ordered=False)
+            except BulkWriteError as error:
+                # Unordered writes keep going past individual failures; report them and move on
+                failed = {err["index"] for err in error.details.get("writeErrors", [])}
+                print(f"ERROR: {len(failed)} {self.collection.name} writes failed: {error}")
+
+            self._written(ops, failed)
+            return len(ops)
+
+    def _written(self, ops: list, failed: set):
+        """Runs after each flush with the (op, document) pairs and the indexes that failed."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+        return False
@@ -1,11 +1,23 @@
 import os
 import json
 from datetime import datetime
-from time import sleep
+from threading import Lock
+from collections import Counter, defaultdict
 from bson.objectid import ObjectId
 from twilio.rest import Client
 from dotenv import load_dotenv
 from app.data.database import get_db_connection
+from app.services.audience import iter_audience_batches
+from app.services.receipt_sink import ReceiptSink
+from app.services.send_engine import SendEngine
+from app.services.rate_limiter import get_bucket
+from app.services.template_renderer import CompiledTemplate, compile_template, get_compiled
+from app.services.scheduler import QuietWindow, QuietSchedule, DeferredQueue
+from app.services.ledger import DeliveryLedger
+from app.services.suppression import get_suppression_index
+from app.services.stats import record_receipt_counts
+from app.services.rollups import record_rollups, receipt_rollup_events
+from app.services.retry import RETRYABLE, classify_send_error, error_code, backoff_delay
 from app.config import DevelopmentConfig as Config
 
 # Load .env environment variables
@@ -20,19 +32,15 @@ TWILIO_CONTENT_SID = os.getenv("TWILIO_CONTENT_SID")
 client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
 
 
+DEFAULT_QUIET_HOURS = {"start": "22:00", "end": "06:00"}
+
+
 def is_quiet_hours(quiet_hours: dict) -> bool:
     """
     Checks if current time falls within defined quiet hours.
     Handles cases that wrap past midnight.
     """
-    now = datetime.now().time()
-    start = datetime.strptime(quiet_hours["start"], "%H:%M").time()
-    end = datetime.strptime(quiet_hours["end"], "%H:%M").time()
-
-    # Quiet period may wrap midnight (e.g., 22:00–06:00)
-    if start < end:
-        return start <= now <= end
-    return now >= start or now <= end
+    return QuietWindow(quiet_hours).contains(datetime.now().time())
 
 
 def render_template(template: str, context: dict) -> str:
@@ -40,151 +48,429 @@ def render_template(template: str, context: dict) -> str:
     Performs basic variable replacement in a template string.
     Example: "Hello {{name}}" + {"name": "Thiva"} -> "Hello Thiva"
     """
-    for key, value in context.items():
-        template = template.replace(f"{{{{{key}}}}}", str(value))
-    return template
+    return compile_template(template).render(context)
 
 
-def run_campaign(campaign_id: str, rate_limit: int = 50):
+def _deliver(user: dict, log_entry: dict, compiled: CompiledTemplate, receipts: ReceiptSink,
+             limiters: list, engine: SendEngine, on_outcome=None):
     """
-    Executes a campaign:
-    - Fetches campaign, template, and users subscribed to the topic
-    - Enforces consent and quiet hours
-    - Sends WhatsApp messages via Twilio
-    - Logs each delivery attempt in delivery_receipts
+    Renders one message and makes the first send attempt.
+    Runs on a send engine worker; retries continue through `_attempt`.
     """
-    # Get DB connection inside the function to allow for mocking in tests
-    _, db = get_db_connection(Config)
+    # Render message
+    attributes = user.get("attributes", {})
+    rendered_text = compiled.render(attributes)
+
+    recipient_number = user.get("id")
+    if not str(recipient_number).startswith("whatsapp:"):
+        recipient = f"whatsapp:{recipient_number}"
+    else:
+        recipient = recipient_number
 
-    # Fetch campaign
+    _attempt(recipient, rendered_text, log_entry, receipts, limiters, engine, on_outcome, 1)
+
+
+def _attempt(recipient: str, rendered_text: str, log_entry: dict, receipts: ReceiptSink,
+             limiters: list, engine: SendEngine, on_outcome, attempt: int):
+    """
+    Makes one provider call after taking a token from each limiter.
+    Retryable errors (429, 5xx, timeouts) are parked on the engine's delayed
+    queue with exponential backoff and jitter; permanent errors and the last
+    attempt record a FAILED receipt. `on_outcome(sent)` fires once per recipient.
+    """
+    try:
+        for limiter in limiters:
+            limiter.acquire()
+
+        print(f"[Attempt {attempt}] Sending WhatsApp message to {recipient}...")
+
+        message = client.messages.create(
+            from_=TWILIO_WHATSAPP_FROM,
+            content_sid=TWILIO_CONTENT_SID,
+            content_variables=json.dumps({"1": rendered_text}),
+            to=recipient
+        )
+
+    except Exception as e:
+        error_class = classify_send_error(e)
+        print(f"Error sending to {recipient} ({error_class}): {e}")
+
+        if error_class == RETRYABLE and attempt < Config.SEND_MAX_ATTEMPTS:
+            delay = backoff_delay(attempt, Config.RETRY_BASE_DELAY, Config.RETRY_MAX_DELAY)
+            engine.submit_later(
+                delay, _attempt,
+                recipient, rendered_text, log_entry, receipts, limiters, engine, on_outcome, attempt + 1
+            )
+            return
+
+        log_entry.update({
+            "decision": "FAILED",
+            "status": "ERROR",
+            "reason": "Max retries reached" if error_class == RETRYABLE else "Permanent provider error",
+            "error_class": error_class,
+            "error_code": error_code(e),
+            "attempts": attempt
+        })
+        receipts.insert(log_entry)
+        if on_outcome:
+            on_outcome(False)
+        return
+
+    print(f"Message sent to {recipient} | SID: {message.sid}")
+    log_entry.update({
+        "decision": "SENT",
+        "status": "SUCCESS",
+        "twilio_sid": message.sid,
+        "attempts": attempt
+    })
+
+    # Store delivery record
+    receipts.insert(log_entry)
+    if on_outcome:
+        on_outcome(True)
+
+
+def _load_campaign(db, campaign_id: str):
+    """Fetches a campaign and its template; returns (campaign, template, error)."""
     campaign = db["campaigns"].find_one({"_id": ObjectId(campaign_id)})
     if not campaign:
-        return {"error": f"Campaign '{campaign_id}' not found."}
+        return None, None, f"Campaign '{campaign_id}' not found."
 
-    # Fetch associated template
     template = db["templates"].find_one({"_id": ObjectId(campaign["template_id"])})
     if not template:
-        return {"error": "Template not found for this campaign."}
+        return campaign, None, "Template not found for this campaign."
+    return campaign, template, None
 
-    topic = campaign.get("topic")
-    quiet_hours = campaign.get("quiet_hours", {"start": "22:00", "end": "06:00"})
-
-    # Get target users from subscriptions
-    subs_cursor = db["subscriptions"].find({"topic": topic})
-    user_ids = [sub["user_id"] for sub in subs_cursor]
-
-    total_processed = 0
-    total_sent = 0
-
-    for uid in user_ids:
-        user = db["users"].find_one({"id": uid})
-        if not user:
-            continue
-
-        log_entry = {
-            "campaign_id": campaign_id,
-            "user_id": uid,
-            "timestamp": datetime.utcnow(),
-            "decision": None,
-            "reason": None,
-            "status": None
-        }
 
-        # Enforce consent (STOP)
-        if user.get("consent_state") == "STOPPED":
-            log_entry.update({
-                "decision": "SKIPPED",
-                "reason": "User opted out"
-            })
-            db["delivery_receipts"].insert_one(log_entry)
-            continue
-
-        # Enforce quiet hours
-        if is_quiet_hours(quiet_hours):
-            log_entry.update({
-                "decision": "DELAYED",
-                "reason": "Quiet hours"
-            })
-            db["delivery_receipts"].insert_one(log_entry)
-            continue
-
-        # Render message
-        attributes = user.get("attributes", {})
-        rendered_text = render_template(template["content"], attributes)
-
-        # Prepare recipient
-        recipient_number = user.get("id")
-        if not recipient_number:
-            log_entry.update({
-                "decision": "FAILED",
-                "status": "ERROR",
-                "reason": "Missing phone number"
-            })
-            db["delivery_receipts"].insert_one(log_entry)
-            continue
-
-        if not str(recipient_number).startswith("whatsapp:"):
-            recipient = f"whatsapp:{recipient_number}"
-        else:
-            recipient = recipient_number
-
-        # Send via Twilio with retry logic
-        success = False
-        sid = None
-
-        for attempt in range(3):
-            try:
-                print(f"[Attempt {attempt+1}] Sending WhatsApp message to {recipient}...")
-
-                message = client.messages.create(
-                    from_=TWILIO_WHATSAPP_FROM,
-                    content_sid=TWILIO_CONTENT_SID,
-                    content_variables=json.dumps({"1": rendered_text}),
-                    to=recipient
-                )
-
-                sid = message.sid
-                success = True
-                print(f"Message sent to {recipient} | SID: {sid}")
+def _campaign_limiters(campaign: dict, rate_limit: int = None, share: float = 1.0) -> list:
+    """
+    Smooth pacing: one bucket per campaign (rate_limit is messages per minute)
+    and one shared by every campaign on this sender number.
+    `share` scales both when several processes split one campaign.
+    """
+    rate_limit = rate_limit or campaign.get("rate_limit") or Config.DEFAULT_CAMPAIGN_RATE_LIMIT
+    return [
+        get_bucket(f"campaign:{campaign['_id']}", rate_limit / 60 * share),
+        get_bucket(f"sender:{TWILIO_WHATSAPP_FROM}", Config.SENDER_RATE_LIMIT * share),
+    ]
+
+
+def _new_log_entry(campaign_id: str, uid: str) -> dict:
+    return {
+        "campaign_id": campaign_id,
+        "user_id": uid,
+        "timestamp": datetime.utcnow(),
+        "decision": None,
+        "reason": None,
+        "status": None
+    }
+
+
+def _receipt_sink(db) -> ReceiptSink:
+    def on_flush(documents):
+        # Keep the dashboard counters and per-campaign rollups in step with each bulk write
+        record_receipt_counts(db, documents)
+        record_rollups(db, receipt_rollup_events(documents))
+
+    return ReceiptSink(
+        db["delivery_receipts"],
+        max_batch=Config.RECEIPT_BATCH_SIZE,
+        max_interval=Config.RECEIPT_FLUSH_INTERVAL,
+        on_flush=on_flush
+    )
+
+
+def _summary(campaign_id: str, counts: dict) -> dict:
+    return {
+        "message": f"Campaign '{campaign_id}' run completed.",
+        "total_processed": counts.get("submitted", 0),
+        "total_sent": counts.get("sent", 0),
+        "skipped": counts.get("skipped", 0),
+        "suppressed": counts.get("suppressed", 0),
+        "delayed": counts.get("delayed", 0),
+        "failed": counts.get("failed", 0),
+        "already_handled": counts.get("already_handled", 0)
+    }
+
+
+def _checkpoint_key(after):
+    """Checkpoints store the last subscription `_id` as a string, so they stay plain JSON."""
+    return ObjectId(after) if ObjectId.is_valid(after) else after
+
+
+def process_audience(db, campaign: dict, template: dict, checkpoint: dict = None, save_checkpoint=None,
+                     progress=None, rate_limit: int = None, rate_share: float = 1.0,
+                     shard: tuple = None, should_stop=None) -> dict:
+    """
+    Sends a campaign to its audience, or to one `(index, count)` shard of it,
+    and returns the final counters:
+    - Enforces consent and quiet hours; recipients inside their quiet
+      window are queued in deferred_sends and released by the scheduler
+    - Claims each recipient in the idempotency ledger right before deciding
+    - Sends on a bounded pool of send workers, paced by the rate limiters
+      (scaled by `rate_share` when several processes split the campaign)
+    - Resumes after `checkpoint["after"]` and calls `save_checkpoint(after, counts)`
+      after every batch, with `after` as a string; stops early once `should_stop()` returns True
+    """
+    campaign_id = str(campaign["_id"])
+
+    # Compile the template once per run; versions are cached by _id and updated_at
+    compiled = get_compiled(template)
+    undeclared = compiled.undeclared(template.get("placeholders"))
+    if template.get("placeholders") and undeclared:
+        print(f"WARNING: Template '{template['_id']}' uses undeclared placeholders: {undeclared}")
+
+    topic = campaign.get("topic")
+    quiet = QuietSchedule(campaign.get("quiet_hours", DEFAULT_QUIET_HOURS))
+    deferred = DeferredQueue(db)
+    ledger = DeliveryLedger(db)
+    concurrency = campaign.get("concurrency") or Config.SEND_CONCURRENCY
+    limiters = _campaign_limiters(campaign, rate_limit, rate_share)
+    resume_after = _checkpoint_key(checkpoint["after"]) if checkpoint else None
+
+    # "processed" counts audience users handled, "submitted" counts send attempts
+    counts = Counter(checkpoint["counts"]) if checkpoint else Counter()
+    counts_lock = Lock()
+
+    def count(key):
+        with counts_lock:
+            counts[key] += 1
+
+    def count_sent(sent):
+        count("sent" if sent else "failed")
+
+    def count_suppressed(n):
+        # Suppressed users get no receipt, so they're kept apart from the receipt-backed "skipped"
+        with counts_lock:
+            counts["processed"] += n
+            counts["suppressed"] += n
+
+    def snapshot():
+        with counts_lock:
+            return dict(counts)
+
+    def report():
+        if progress:
+            progress(snapshot())
+
+    # Buffer receipts and bulk-write them; the sink flushes on exit, even on errors
+    with _receipt_sink(db) as receipts, SendEngine(max_workers=concurrency) as engine:
+
+        # Stream target users from subscriptions in batches; opted-out users are
+        # dropped by the in-memory suppression index before their documents are read
+        suppressed = get_suppression_index(db)
+        batches = iter_audience_batches(
+            db, topic, after=resume_after, shard=shard, exclude=suppressed, on_excluded=count_suppressed
+        )
+        for last_key, users in batches:
+            if should_stop and should_stop():
+                print(f"Stopping campaign '{campaign_id}' before subscription {last_key}.")
                 break
 
-            except Exception as e:
-                print(f"Error sending to {recipient}: {e}")
-                sleep(2)
-
-        # Update log entry
-        if success:
-            log_entry.update({
-                "decision": "SENT",
-                "status": "SUCCESS",
-                "twilio_sid": sid
-            })
-            total_sent += 1
-        else:
-            log_entry.update({
-                "decision": "FAILED",
-                "status": "ERROR",
-                "reason": "Max retries reached"
-            })
-
-        # Store delivery record
-        db["delivery_receipts"].insert_one(log_entry)
-        total_processed += 1
-
-        # Enforce rate limit
-        if total_processed % rate_limit == 0:
-            print(f"Rate limit reached ({rate_limit}). Sleeping 60s...")
-            sleep(60)
+            decided = []
+            for user in users:
+                count("processed")
+
+                # Enforce quiet hours in the recipient's timezone and defer until the window ends.
+                # Deferred users are not claimed: they are still owed a message.
+                release_at = None
+                if user.get("consent_state") != "STOPPED":
+                    release_at = quiet.release_at(user.get("attributes", {}).get("timezone"))
+                if release_at:
+                    log_entry = _new_log_entry(campaign_id, user["id"])
+                    log_entry.update({
+                        "decision": "DELAYED",
+                        "reason": "Quiet hours",
+                        "release_at": release_at
+                    })
+                    receipts.insert(log_entry)
+                    deferred.defer(campaign_id, user["id"], release_at)
+                    count("delayed")
+                    continue
+                decided.append(user)
+
+            for user in decided:
+                uid = user["id"]
+
+                # Claim right before deciding, so a crash can't strand claimed-but-unsent users;
+                # users already in the ledger were handled by an earlier run
+                if not ledger.claim(campaign_id, uid):
+                    count("already_handled")
+                    continue
+
+                log_entry = _new_log_entry(campaign_id, uid)
+
+                # Enforce consent (STOP) for opt-outs newer than the suppression index
+                if user.get("consent_state") == "STOPPED":
+                    log_entry.update({
+                        "decision": "SKIPPED",
+                        "reason": "User opted out"
+                    })
+                    receipts.insert(log_entry)
+                    count("skipped")
+                    continue
+
+                # Prepare recipient
+                if not user.get("id"):
+                    log_entry.update({
+                        "decision": "FAILED",
+                        "status": "ERROR",
+                        "reason": "Missing phone number"
+                    })
+                    receipts.insert(log_entry)
+                    count("failed")
+                    continue
+
+                # Hand the send off to the engine; retries are re-queued with backoff, one receipt per recipient
+                engine.submit(_deliver, user, log_entry, compiled, receipts, limiters, engine, count_sent)
+                count("submitted")
+
+            # Everyone up to last_key is now claimed or deferred, so a restart can skip past it.
+            # Deferrals aren't in the ledger, so they must be durable before the checkpoint moves.
+            if save_checkpoint:
+                deferred.flush()
+                receipts.flush()
+                save_checkpoint(str(last_key), snapshot())
+            report()
+
+        # Let in-flight sends record their receipts before the final flush
+        engine.wait()
+        deferred.flush()
+
+    report()
+    return snapshot()
+
+
+def run_campaign(campaign_id: str, rate_limit: int = None, progress=None):
+    """
+    Executes a campaign:
+    - Fetches campaign, template, and users subscribed to the topic
+    - Sends to the whole audience in this process, see `process_audience`
+    - Logs each delivery attempt in delivery_receipts
+    - Checkpoints progress on the campaign so a crashed run resumes in place
+    - Reports running counters to `progress(counts)` when given
+    """
+    # Get DB connection inside the function to allow for mocking in tests
+    _, db = get_db_connection(Config)
+
+    # Fetch campaign and associated template
+    campaign, template, error = _load_campaign(db, campaign_id)
+    if error:
+        return {"error": error}
+
+    # Resume from the last checkpoint if an earlier run of this campaign died midway
+    checkpoint = campaign.get("checkpoint") if campaign.get("status") == "running" else None
+    if checkpoint:
+        print(f"Resuming campaign '{campaign_id}' after subscription {checkpoint['after']}.")
+    total = db["subscriptions"].count_documents({"topic": campaign.get("topic")})
+
+    def save_checkpoint(after, counts):
+        db["campaigns"].update_one(
+            {"_id": ObjectId(campaign_id)},
+            {"$set": {"checkpoint": {"after": after, "counts": counts, "updated_at": datetime.utcnow()}}}
+        )
+
+    def report(counts):
+        if progress:
+            progress({**counts, "total": total})
+
+    db["campaigns"].update_one(
+        {"_id": ObjectId(campaign_id)},
+        {"$set": {"status": "running", "updated_at": datetime.utcnow()}}
+    )
+
+    counts = process_audience(
+        db, campaign, template,
+        checkpoint=checkpoint,
+        save_checkpoint=save_checkpoint,
+        progress=report,
+        rate_limit=rate_limit
+    )
 
     # Finalize campaign
     db["campaigns"].update_one(
         {"_id": ObjectId(campaign_id)},
-        {"$set": {"status": "completed", "last_run": datetime.utcnow()}}
+        {
+            "$set": {"status": "completed", "last_run": datetime.utcnow(), "last_run_counts": counts},
+            "$unset": {"checkpoint": ""}
+        }
     )
 
-    print(f"Campaign '{campaign_id}' completed: {total_sent}/{total_processed} sent.")
-    return {
-        "message": f"Campaign '{campaign_id}' run completed.",
-        "total_processed": total_processed,
-        "total_sent": total_sent
-    }
+    print(f"Campaign '{campaign_id}' completed: {counts.get('sent', 0)}/{counts.get('submitted', 0)} sent.")
+    return _summary(campaign_id, counts)
+
+
+def deliver_deferred(batch_size: int = 500) -> int:
+    """
+    Releases one batch of deferred recipients whose quiet window has ended:
+    - Claims the earliest due entries from deferred_sends
+    - Re-checks consent and quiet hours, re-deferring anyone still in theirs
+    - Skips users already claimed in the campaign's idempotency ledger
+    - Sends through the same rate limiters as the original campaign run
+    Returns the number of entries claimed.
+    """
+    _, db = get_db_connection(Config)
+    queue = DeferredQueue(db)
+    ledger = DeliveryLedger(db)
+    entries = queue.claim_due(batch_size)
+    if not entries:
+        return 0
+
+    by_campaign = defaultdict(list)
+    for entry in entries:
+        by_campaign[entry["campaign_id"]].append(entry)
+
+    done = []
+    with _receipt_sink(db) as receipts:
+        for campaign_id, group in by_campaign.items():
+            campaign, template, error = _load_campaign(db, campaign_id)
+            if error:
+                print(f"ERROR: Dropping {len(group)} deferred sends: {error}")
+                done.extend(entry["_id"] for entry in group)
+                continue
+
+            compiled = get_compiled(template)
+            quiet = QuietSchedule(campaign.get("quiet_hours", DEFAULT_QUIET_HOURS))
+            limiters = _campaign_limiters(campaign)
+            suppressed = get_suppression_index(db)
+            users = {
+                user["id"]: user
+                for user in db["users"].find({"id": {"$in": [
+                    entry["user_id"] for entry in group if entry["user_id"] not in suppressed
+                ]}})
+            }
+
+            ready = []
+            for entry in group:
+                user = users.get(entry["user_id"])
+                if not user:
+                    done.append(entry["_id"])
+                    continue
+
+                release_at = quiet.release_at(user.get("attributes", {}).get("timezone"))
+                if release_at:
+                    queue.defer(campaign_id, user["id"], release_at)
+                    continue
+
+                done.append(entry["_id"])
+                ready.append(user)
+
+            with SendEngine(max_workers=campaign.get("concurrency") or Config.SEND_CONCURRENCY) as engine:
+                for user in ready:
+                    # Same idempotency ledger as the main run: never message a user twice per campaign
+                    if not ledger.claim(campaign_id, user["id"]):
+                        continue
+                    log_entry = _new_log_entry(campaign_id, user["id"])
+                    log_entry["deferred"] = True
+                    if user.get("consent_state") == "STOPPED":
+                        log_entry.update({"decision": "SKIPPED", "reason": "User opted out"})
+                        receipts.insert(log_entry)
+                        continue
+
+                    engine.submit(_deliver, user, log_entry, compiled, receipts, limiters, engine)
+                engine.wait()
+
+    queue.flush()
+    queue.complete(done)
+    print(f"Released {len(done)} of {len(entries)} deferred sends.")
+    return len(entries)
@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta
+from time import sleep
+from uuid import uuid4
+from pymongo import ASCENDING
+from app.data.database import get_db_connection
+from app.config import DevelopmentConfig as Config
+
+PENDING = "pending"
+DISPATCHING = "dispatching"
+DISPATCHED = "dispatched"
+
+
+def outbox_entry(campaign_id: str) -> dict:
+    """
+    Builds the outbox trigger embedded in an events_inbound document.
+    Writing the trigger inside the event makes recording the event and
+    its campaign trigger a single atomic document write.
+    """
+    return {"campaign_id": campaign_id, "state": PENDING, "created_at": datetime.utcnow()}
+
+
+def ensure_outbox_indexes(db):
+    db["events_inbound"].create_index([("dispatch.state", ASCENDING), ("dispatch.campaign_id", ASCENDING)])
+
+
+def dispatch_pending(db=None, stale_after: float = None) -> dict:
+    """
+    Drains the event outbox once. Pending triggers are grouped by campaign,
+    so any number of events for one campaign start a single job, and a
+    campaign that already has a queued or running job is attached to it
+    instead of being started again (jobs whose process died count as
+    finished, see `expire_stale_jobs`). Triggers claimed by a dispatcher that
+    died mid-dispatch are retried after `stale_after` seconds.
+    Returns {campaign_id: job_id} for the campaigns handled in this pass.
+    """
+    from app.services.jobs import submit_campaign_job, find_active_job
+
+    if db is None:
+        _, db = get_db_connection(Config)
+    stale_after = Config.DISPATCH_STALE_SECONDS if stale_after is None else stale_after
+    events = db["events_inbound"]
+    ensure_outbox_indexes(db)
+
+    now = datetime.utcnow()
+    claimable = {"$or": [
+        {"dispatch.state": PENDING},
+        {"dispatch.state": DISPATCHING, "dispatch.claimed_at": {"$lt": now - timedelta(seconds=stale_after)}}
+    ]}
+
+    dispatched = {}
+    for campaign_id in events.distinct("dispatch.campaign_id", claimable):
+        # Claim every trigger of the campaign at once; other dispatchers skip them
+        token = uuid4().hex
+        claimed = events.update_many(
+            {"$and": [claimable, {"dispatch.campaign_id": campaign_id}]},
+            {"$set": {"dispatch.state": DISPATCHING, "dispatch.token": token, "dispatch.claimed_at": now}}
+        )
+        if not claimed.modified_count:
+            continue
+
+        active = find_active_job(db, campaign_id)
+        job_id = str(active["_id"]) if active else submit_campaign_job(campaign_id)
+
+        events.update_many(
+            {"dispatch.token": token},
+            {"$set": {"dispatch.state": DISPATCHED, "dispatch.job_id": job_id, "dispatch.dispatched_at": datetime.utcnow()}}
+        )
+        print(f"Dispatched {claimed.modified_count} trigger(s) for campaign '{campaign_id}' as job {job_id}.")
+        dispatched[campaign_id] = job_id
+
+    return dispatched
+
+
+def run_dispatcher(poll_interval: float = None):
+    """
+    Drains event-triggered campaign runs from the outbox and executes them
+    on this process's job workers. Meant to run as its own process:
+        python -m app.services.dispatcher
+    """
+    poll_interval = poll_interval or Config.DISPATCH_POLL_INTERVAL
+    _, db = get_db_connection(Config)
+    while True:
+        if not dispatch_pending(db):
+            sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    run_dispatcher()
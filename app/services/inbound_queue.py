@@ -0,0 +1,298 @@
+import atexit
+import fcntl
+import json
+import os
+import shutil
+from datetime import datetime
+from queue import Queue, Empty, Full
+from threading import Lock, Thread, Event
+from uuid import uuid4
+from pymongo import UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
+from app.data.database import get_db_connection
+from app.config import Config
+from app.services.suppression import bump_suppression_version
+from app.services.webhook_dedupe import get_webhook_dedupe
+
+_queue = None
+_queue_lock = Lock()
+
+
+def parse_inbound(data: dict) -> dict:
+    """
+    Turns a Twilio inbound form into the events_inbound record, with the
+    START, STOP, SUBSCRIBE and UNSUBSCRIBE commands parsed out.
+    """
+    from_number = data.get("From", "").replace("whatsapp:", "")
+    body = data.get("Body", "").strip().upper()
+
+    normalized = {"command": None, "topic": None}
+    if body in ("START", "STOP"):
+        normalized["command"] = body
+    elif body.startswith("SUBSCRIBE "):
+        normalized.update({"command": "SUBSCRIBE", "topic": body.split("SUBSCRIBE ", 1)[1]})
+    elif body.startswith("UNSUBSCRIBE "):
+        normalized.update({"command": "UNSUBSCRIBE", "topic": body.split("UNSUBSCRIBE ", 1)[1]})
+
+    return {
+        "message_sid": data.get("MessageSid"),
+        "from": from_number,
+        "body": data.get("Body", ""),
+        "timestamp": datetime.utcnow(),
+        "type": "inbound",
+        **normalized
+    }
+
+
+def apply_inbound_batch(db, records: list):
+    """
+    Applies a batch of inbound records, oldest first, in three bulk writes:
+    consent changes, subscription changes and the event log. Commands for
+    the same user (or user and topic) are coalesced so the latest one wins.
+    Records are claimed in the webhook dedupe layer by MessageSid first:
+    retries of messages that were already applied are skipped, and the
+    claims are released again if the writes fail.
+    """
+    dedupe = get_webhook_dedupe(db)
+    claimed = dedupe.claim(record.get("message_sid") for record in records)
+    fresh, seen = [], set()
+    for record in records:
+        sid = record.get("message_sid")
+        if sid and (sid not in claimed or sid in seen):
+            continue
+        seen.add(sid)
+        fresh.append(record)
+
+    try:
+        _apply_records(db, fresh)
+    except Exception:
+        dedupe.release(claimed)
+        raise
+
+
+def _apply_records(db, records: list):
+    consent, subscriptions = {}, {}
+    for record in records:
+        user_id, command, topic = record["from"], record["command"], record["topic"]
+        if command == "START":
+            consent[user_id] = "SUBSCRIBED"
+        elif command == "STOP":
+            consent[user_id] = "STOPPED"
+        elif command == "SUBSCRIBE":
+            subscriptions[(user_id, topic)] = UpdateOne(
+                {"user_id": user_id, "topic": topic},
+                {"$set": {"user_id": user_id, "topic": topic, "subscribed_at": record["timestamp"]}},
+                upsert=True
+            )
+        elif command == "UNSUBSCRIBE":
+            subscriptions[(user_id, topic)] = DeleteOne({"user_id": user_id, "topic": topic})
+
+    writes = [
+        ("users", [UpdateOne({"id": uid}, {"$set": {"consent_state": state}}, upsert=True) for uid, state in consent.items()]),
+        ("subscriptions", list(subscriptions.values()))
+    ]
+    for collection, ops in writes:
+        if not ops:
+            continue
+        try:
+            db[collection].bulk_write(ops, ordered=False)
+        except BulkWriteError as error:
+            print(f"ERROR: {len(error.details.get('writeErrors', []))} inbound {collection} writes failed: {error}")
+
+    if consent:
+        bump_suppression_version(db)
+    if records:
+        db["events_inbound"].insert_many(records, ordered=False)
+
+
+class InboundQueue:
+    """
+    Bounded in-process queue between the inbound webhook and Mongo.
+    A background flusher drains it in batches through `apply_inbound_batch`.
+    When the queue is full, records are appended to a spill file on local
+    disk instead. Once spilling starts, every new record is spilled until
+    the file has been drained, so records are always applied in arrival
+    order. Each process spills to its own files and holds an flock on its
+    lock file while alive; spill files whose lock is free belong to a
+    process that is gone and are drained by the next queue that starts.
+    """
+
+    def __init__(self, spill_dir: str, max_size: int = 10000, batch_size: int = 500,
+                 flush_interval: float = 0.5, start: bool = True):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_dir = spill_dir
+        self.spill_id = f"inbound-{os.getpid()}-{uuid4().hex[:8]}"
+        self.spill_path = os.path.join(spill_dir, f"{self.spill_id}.spill")
+        self._draining_path = self.spill_path + ".draining"
+        os.makedirs(spill_dir, exist_ok=True)
+        self._lock_path = os.path.join(spill_dir, f"{self.spill_id}.lock")
+        self._lock_file = open(self._lock_path, "w")
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+        self._queue = Queue(maxsize=max_size)
+        self._lock = Lock()
+        self._drain_lock = Lock()
+        self._spilling = False
+        self._orphans_adopted = False
+        self._stopped = Event()
+        self._thread = None
+        if start:
+            self._thread = Thread(target=self._run, name="inbound-flusher", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    @staticmethod
+    def _encode(record: dict) -> str:
+        # insert_many may have added an _id to records of a failed batch; a retry gets a fresh one
+        fields = {key: value for key, value in record.items() if key != "_id"}
+        return json.dumps({**fields, "timestamp": record["timestamp"].isoformat()}) + "\n"
+
+    def put(self, record: dict):
+        """Queues a record without blocking; spills it to disk if the queue is full."""
+        with self._lock:
+            if not self._spilling:
+                try:
+                    self._queue.put_nowait(record)
+                    return
+                except Full:
+                    print("WARNING: Inbound queue is full; spilling to disk.")
+                    self._spilling = True
+            with open(self.spill_path, "a", encoding="utf-8") as spill:
+                spill.write(self._encode(record))
+
+    def _spill_backlog(self, batch: list):
+        """
+        Moves a batch that failed to apply, and everything still queued behind
+        it, to the front of the spill file so it is retried in arrival order.
+        """
+        with self._lock:
+            backlog = list(batch)
+            while True:
+                try:
+                    backlog.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            staging = self.spill_path + ".staging"
+            with open(staging, "w", encoding="utf-8") as spill:
+                spill.writelines(self._encode(record) for record in backlog)
+                # Records spilled earlier arrived after everything that was still queued
+                if os.path.exists(self.spill_path):
+                    with open(self.spill_path, encoding="utf-8") as newer:
+                        shutil.copyfileobj(newer, spill)
+            os.replace(staging, self.spill_path)
+            self._spilling = True
+
+    def _take_batch(self, timeout: float = None) -> list:
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=timeout) if timeout else self._queue.get_nowait())
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except Empty:
+            pass
+        return batch
+
+    def _apply_spill_file(self, db, path: str):
+        with open(path, encoding="utf-8") as spill:
+            batch = []
+            for line in spill:
+                record = json.loads(line)
+                record["timestamp"] = datetime.fromisoformat(record["timestamp"])
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    apply_inbound_batch(db, batch)
+                    batch = []
+            apply_inbound_batch(db, batch)
+        os.remove(path)
+
+    def _drain_spill(self, db):
+        """Applies spilled records in order, then leaves spill mode once none are left."""
+        while True:
+            with self._lock:
+                if not os.path.exists(self._draining_path):
+                    if not os.path.exists(self.spill_path):
+                        self._spilling = False
+                        return
+                    os.replace(self.spill_path, self._draining_path)
+            self._apply_spill_file(db, self._draining_path)
+
+    def _adopt_orphans(self, db):
+        """Drains spill files left by processes that are gone, i.e. whose lock file isn't held."""
+        owners = {name.split(".spill")[0] for name in os.listdir(self.spill_dir) if ".spill" in name}
+        for owner in sorted(owners - {self.spill_id}):
+            lock_path = os.path.join(self.spill_dir, f"{owner}.lock")
+            with open(lock_path, "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                spill_path = os.path.join(self.spill_dir, f"{owner}.spill")
+                for path in (spill_path + ".draining", spill_path):
+                    if os.path.exists(path):
+                        print(f"Draining inbound records spilled by {owner}.")
+                        self._apply_spill_file(db, path)
+                os.remove(lock_path)
+
+    def drain(self, timeout: float = None) -> int:
+        """
+        Applies everything queued so far, then any spilled records.
+        Waits up to `timeout` seconds for the first record. A batch that
+        fails to apply is spilled, ahead of the rest of the queue, and
+        retried on the next pass. Returns the number of queued records applied.
+        """
+        _, db = get_db_connection(Config)
+        applied = 0
+        with self._drain_lock:
+            if not self._orphans_adopted:
+                self._adopt_orphans(db)
+                self._orphans_adopted = True
+            batch = self._take_batch(timeout)
+            while batch:
+                try:
+                    apply_inbound_batch(db, batch)
+                except Exception as error:
+                    # The webhook already answered 200, so Twilio won't resend these: keep them on disk
+                    print(f"ERROR: Failed to apply {len(batch)} inbound records; spilling them for retry: {error}")
+                    self._spill_backlog(batch)
+                    return applied
+                applied += len(batch)
+                batch = self._take_batch()
+            if self._spilling:
+                self._drain_spill(db)
+        return applied
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.drain(timeout=self.flush_interval)
+            except Exception as error:
+                # Spilled records stay on disk and are retried on the next pass
+                print(f"ERROR: Inbound flusher failed: {error}")
+                self._stopped.wait(self.flush_interval)
+
+    def close(self):
+        """Stops the flusher and applies whatever is still queued."""
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        self.drain()
+        # Keep the lock file while records are still spilled, so another process adopts them
+        spilled = os.path.exists(self.spill_path) or os.path.exists(self._draining_path)
+        if not spilled and os.path.exists(self._lock_path):
+            os.remove(self._lock_path)
+        self._lock_file.close()
+
+
+def get_inbound_queue() -> InboundQueue:
+    """Lazily starts the process-wide inbound queue and its flusher."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = InboundQueue(
+                Config.INBOUND_SPILL_DIR,
+                max_size=Config.INBOUND_QUEUE_SIZE,
+                batch_size=Config.INBOUND_BATCH_SIZE,
+                flush_interval=Config.INBOUND_FLUSH_INTERVAL
+            )
+        return _queue
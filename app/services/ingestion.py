@@ -0,0 +1,539 @@
+import codecs
+import csv
+import gzip
+import io
+import json
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+from pydantic import TypeAdapter, ValidationError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from app.data.models.user import UserModel
+from app.services.audience import snapshot_topic_audiences
+from app.services.dispatcher import outbox_entry
+from app.services.suppression import bump_suppression_version
+from app.config import DevelopmentConfig as Config
+import zstandard
+
+DEFAULT_CHUNK_SIZE = 1000
+READ_SIZE = 64 * 1024
+MAX_RECORD_SIZE = 16 * 1024 * 1024
+
+USER_LIST_ADAPTER = TypeAdapter(list[UserModel])
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+COMPRESSED_SUFFIXES = (".gz", ".gzip", ".zst")
+
+
+class IngestionError(ValueError):
+    """Raised when an upload cannot be parsed any further."""
+
+
+def chunked(iterable, size: int):
+    """Yields lists of at most `size` items without materializing the iterable."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_csv_records(stream):
+    """
+    Parses CSV rows straight off a binary stream.
+    Bytes are decoded incrementally (a leading BOM is dropped), so only the
+    rows being read are held in memory.
+    """
+    reader = codecs.getreader("utf-8-sig")(stream)
+    try:
+        yield from csv.DictReader(reader)
+    except (csv.Error, UnicodeDecodeError) as error:
+        raise IngestionError(f"Invalid CSV: {error}")
+
+
+def iter_json_array(stream, read_size: int = READ_SIZE):
+    """
+    Incrementally parses a top-level JSON array of records off a binary
+    stream, yielding one element at a time. A single top-level object is
+    yielded as one record.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, pos, eof
+        data = stream.read(read_size)
+        if not data:
+            eof = True
+            buffer = buffer[pos:] + text_decoder.decode(b"", final=True)
+        else:
+            buffer = buffer[pos:] + text_decoder.decode(data)
+        pos = 0
+
+    def skip(chars: str):
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in chars:
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            fill()
+
+    skip(" \t\r\n")
+    if pos >= len(buffer):
+        return
+    opening = buffer[pos]
+    if opening == "{":
+        in_array = False
+    elif opening == "[":
+        in_array = True
+        pos += 1
+    else:
+        raise IngestionError("Expected a JSON array or object")
+
+    while True:
+        skip(" \t\r\n," if in_array else " \t\r\n")
+        if pos >= len(buffer):
+            if in_array:
+                raise IngestionError("Unterminated JSON array")
+            return
+        if in_array and buffer[pos] == "]":
+            return
+
+        try:
+            record, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as error:
+            # Either the record continues in the next read or the input is malformed
+            if eof or len(buffer) - pos > MAX_RECORD_SIZE:
+                raise IngestionError(f"Invalid JSON: {error}")
+            fill()
+            continue
+
+        # A value ending exactly at the buffer edge may be cut short (e.g. a number)
+        if end == len(buffer) and not eof:
+            fill()
+            continue
+
+        pos = end
+        yield record
+        if not in_array:
+            return
+
+
+def iter_jsonl_records(stream, strict: bool = False):
+    """
+    Parses newline-delimited JSON off a binary stream, one line at a time.
+    Blank lines are skipped; malformed lines are skipped too unless `strict`,
+    in which case they raise IngestionError.
+    """
+    for number, line in enumerate(stream, start=1):
+        try:
+            line = line.decode("utf-8-sig" if number == 1 else "utf-8").strip()
+            if line:
+                yield json.loads(line)
+        except (UnicodeDecodeError, json.JSONDecodeError) as error:
+            if strict:
+                raise IngestionError(f"Invalid JSON on line {number}: {error}")
+
+
+class _ReadAdapter(io.RawIOBase):
+    """
+    Exposes any object with `read(size)` as a raw stream, so it can be
+    buffered and peeked at. Decoder errors surface as IngestionError.
+    """
+
+    def __init__(self, stream, errors: tuple = ()):
+        self._stream = stream
+        self._errors = errors
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        try:
+            data = self._stream.read(len(buffer))
+        except self._errors as error:
+            raise IngestionError(f"Invalid compressed upload: {error}")
+        size = len(data)
+        buffer[:size] = data
+        return size
+
+
+class _ZstdReader:
+    """
+    Inflates a stream of zstd frames incrementally. Unlike zstandard's
+    stream_reader, it raises on a truncated final frame instead of
+    silently ending early.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._decompressor = zstandard.ZstdDecompressor()
+        self._frame = self._decompressor.decompressobj()
+        self._in_frame = False
+        self._pending = b""
+
+    def read(self, size: int) -> bytes:
+        while len(self._pending) < size:
+            data = self._stream.read(READ_SIZE)
+            if not data:
+                if self._in_frame:
+                    raise zstandard.ZstdError("upload ends in the middle of a zstd frame")
+                break
+            while data:
+                self._in_frame = True
+                self._pending += self._frame.decompress(data)
+                data = b""
+                if self._frame.eof:
+                    # Concatenated frames: start a fresh decompressor on what follows
+                    data = self._frame.unused_data
+                    self._frame = self._decompressor.decompressobj()
+                    self._in_frame = False
+        chunk, self._pending = self._pending[:size], self._pending[size:]
+        return chunk
+
+
+def _buffered(stream, errors: tuple = ()) -> io.BufferedReader:
+    return io.BufferedReader(_ReadAdapter(stream, errors), buffer_size=READ_SIZE)
+
+
+def decompress_stream(stream) -> io.BufferedReader:
+    """
+    Detects gzip or zstd compression from the upload's magic bytes and
+    returns a stream that inflates it incrementally as it is read.
+    Uncompressed uploads are passed through.
+    """
+    stream = _buffered(stream)
+    magic = stream.peek(len(ZSTD_MAGIC))[:len(ZSTD_MAGIC)]
+    if magic.startswith(GZIP_MAGIC):
+        return _buffered(gzip.GzipFile(fileobj=stream, mode="rb"), (OSError, EOFError))
+    if magic == ZSTD_MAGIC:
+        return _buffered(_ZstdReader(stream), (zstandard.ZstdError, OSError))
+    return stream
+
+
+def sniff_format(stream, filename: str):
+    """
+    Returns "csv", "json" (array or single object) or "ndjson" for a
+    decompressed upload, or None when it can't be recognised. The file
+    extension decides when it is specific; otherwise the first bytes do.
+    """
+    name = (filename or "").lower()
+    for suffix in COMPRESSED_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    if name.endswith(".csv"):
+        return "csv"
+    if name.endswith((".ndjson", ".jsonl")):
+        return "ndjson"
+
+    head = stream.peek(READ_SIZE)
+    if head.startswith(codecs.BOM_UTF8):
+        head = head[len(codecs.BOM_UTF8):]
+    head = head.lstrip(b" \t\r\n")
+    if head.startswith(b"["):
+        return "json"
+    if head.startswith(b"{"):
+        # One complete object on the first line means one record per line
+        first_line = head.split(b"\n", 1)[0]
+        try:
+            json.loads(first_line)
+            return "ndjson"
+        except ValueError:
+            return "json"
+    return None
+
+
+def open_user_records(stream, filename: str):
+    """
+    Returns a streaming record iterator for a user upload: gzip/zstd are
+    inflated on the fly and CSV, JSON or NDJSON is detected.
+    Raises IngestionError for unsupported uploads.
+    """
+    stream = decompress_stream(stream)
+    file_format = sniff_format(stream, filename)
+    if file_format == "csv":
+        return iter_csv_records(stream)
+    if file_format == "json":
+        return iter_json_array(stream)
+    if file_format == "ndjson":
+        return iter_jsonl_records(stream, strict=True)
+    raise IngestionError("Unsupported file format")
+
+
+def open_event_records(stream):
+    """Returns a streaming iterator over a (optionally gzip/zstd-compressed) JSONL event upload."""
+    return iter_jsonl_records(decompress_stream(stream))
+
+
+def clean_record(record: dict) -> dict:
+    """Normalizes header names and decodes JSON-encoded attributes from CSV cells."""
+    cleaned_record = {str(k).strip().lstrip("\ufeff"): v for k, v in record.items()}
+
+    # Normalize the phone number so repeated rows collapse onto one key
+    if isinstance(cleaned_record.get("id"), str):
+        cleaned_record["id"] = cleaned_record["id"].strip()
+
+    if "attributes" in cleaned_record and isinstance(cleaned_record["attributes"], str):
+        try:
+            cleaned_record["attributes"] = json.loads(cleaned_record["attributes"])
+        except json.JSONDecodeError:
+            cleaned_record["attributes"] = {}
+    return cleaned_record
+
+
+def new_summary() -> dict:
+    return {
+        "total": 0,
+        "valid": 0,
+        "invalid": 0,
+        "duplicates": 0,
+        "merged": 0,
+        "new": 0,
+        "errors": [],
+        "errors_truncated": False
+    }
+
+
+def _error_entry(row: int, loc: tuple, message: str) -> dict:
+    field = ".".join(str(part) for part in loc) or None
+    return {"row": row, "field": field, "message": message}
+
+
+def validate_user_chunk(records: list, first_row: int = 1) -> tuple:
+    """
+    Cleans and validates a chunk of raw records in one batch pass.
+    Returns (users, errors) where `errors` holds one entry per failed
+    field as {"row", "field", "message"}; rows are 1-based across the upload.
+    Runs in pool workers, so it only touches its arguments.
+    """
+    errors = []
+    cleaned, rows = [], []
+    for offset, record in enumerate(records):
+        try:
+            cleaned.append(clean_record(record))
+            rows.append(first_row + offset)
+        except AttributeError:
+            errors.append(_error_entry(first_row + offset, (), "Record must be an object"))
+
+    try:
+        return USER_LIST_ADAPTER.validate_python(cleaned), errors
+    except ValidationError as e:
+        invalid = set()
+        for err in e.errors(include_url=False, include_input=False):
+            index, loc = err["loc"][0], err["loc"][1:]
+            invalid.add(index)
+            errors.append(_error_entry(rows[index], loc, err["msg"]))
+        # Re-validate only the rows that passed; they cannot fail again
+        valid = [record for index, record in enumerate(cleaned) if index not in invalid]
+        errors.sort(key=lambda entry: entry["row"])
+        return USER_LIST_ADAPTER.validate_python(valid), errors
+
+
+def _iter_validated(records, chunk_size: int, workers: int, parallel_threshold: int):
+    """
+    Yields (chunk_length, users, errors) per chunk, in upload order.
+    Chunks are validated inline until the upload passes `parallel_threshold`
+    records; the rest are fanned out to a process pool with a bounded number
+    of chunks in flight, so memory stays proportional to `workers`.
+    """
+    pool = None
+    pending = deque()
+    row = 1
+    try:
+        for chunk in chunked(records, chunk_size):
+            if pool is None and workers > 1 and row - 1 >= parallel_threshold:
+                pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+            if pool is None:
+                yield (len(chunk), *validate_user_chunk(chunk, row))
+            else:
+                pending.append((len(chunk), pool.submit(validate_user_chunk, chunk, row)))
+                if len(pending) >= workers * 2:
+                    length, future = pending.popleft()
+                    yield (length, *future.result())
+            row += len(chunk)
+
+        while pending:
+            length, future = pending.popleft()
+            yield (length, *future.result())
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+def dedupe_users(users: list) -> tuple:
+    """
+    Collapses users repeated within a chunk onto one entry per id.
+    Later rows win for the fields they set, and attributes are merged key
+    by key. Returns (unique_users, duplicates) with first-seen order kept.
+    """
+    by_id = {}
+    for user in users:
+        previous = by_id.get(user.id)
+        if previous is None:
+            by_id[user.id] = user
+            continue
+        update = {field: getattr(user, field) for field in user.model_fields_set if field != "id"}
+        update["attributes"] = {**previous.attributes, **user.attributes}
+        by_id[user.id] = previous.model_copy(update=update)
+    return list(by_id.values()), len(users) - len(by_id)
+
+
+def _user_upsert(user: UserModel) -> UpdateOne:
+    """
+    Builds the merge-or-create write for one validated user.
+    Like the previous read-then-write merge, incoming fields overwrite
+    stored ones and any other stored fields are kept; created_at is only
+    set when the user is new.
+    """
+    fields = user.model_dump(by_alias=True, exclude={"_id", "id", "created_at"})
+    fields["updated_at"] = datetime.utcnow()
+    return UpdateOne(
+        {"id": user.id},
+        {"$set": fields, "$setOnInsert": {"id": user.id, "created_at": user.created_at}},
+        upsert=True
+    )
+
+
+def upsert_users(db, users: list) -> tuple:
+    """
+    Writes a batch of users with one unordered bulk_write.
+    Returns (new, merged, failed) counts taken from the bulk result.
+    """
+    if not users:
+        return 0, 0, 0
+
+    db["users"].create_index("id")
+    # Which of these users are opted out now, to tell whether the upload changes that set
+    stopped_before = {
+        doc["id"] for doc in db["users"].find(
+            {"id": {"$in": [user.id for user in users]}, "consent_state": "STOPPED"}, {"id": 1, "_id": 0}
+        )
+    }
+    stopped_after = {user.id for user in users if user.consent_state == "STOPPED"}
+    try:
+        result = db["users"].bulk_write([_user_upsert(user) for user in users], ordered=False)
+        counts = result.upserted_count, result.matched_count, 0
+    except BulkWriteError as error:
+        details = error.details
+        failed = len(details.get("writeErrors", []))
+        print(f"ERROR: {failed} user writes failed: {error}")
+        counts = details.get("nUpserted", 0), details.get("nMatched", 0), failed
+
+    # Workers reload their suppression index only if the chunk opted someone out or back in
+    if stopped_before != stopped_after:
+        bump_suppression_version(db)
+    return counts
+
+
+def ingest_user_records(db, records, chunk_size: int = DEFAULT_CHUNK_SIZE, summary: dict = None,
+                        workers: int = None, parallel_threshold: int = None, max_errors: int = None,
+                        on_chunk=None) -> dict:
+    """
+    Validates and persists user records in fixed-size chunks.
+    `records` may be any iterable (typically a streaming parser), so peak
+    memory depends on `chunk_size`, not on the size of the upload.
+    Large uploads are validated on a process pool; repeated ids within a
+    chunk are collapsed and each chunk is written with a single bulk upsert. Invalid rows are collected in
+    summary["errors"], capped at `max_errors` entries.
+    `on_chunk(summary)` is called once each chunk has been written.
+    """
+    summary = summary or new_summary()
+    workers = workers or Config.INGEST_WORKERS
+    parallel_threshold = Config.INGEST_PARALLEL_THRESHOLD if parallel_threshold is None else parallel_threshold
+    max_errors = Config.INGEST_MAX_ERRORS if max_errors is None else max_errors
+
+    for length, users, errors in _iter_validated(records, chunk_size, workers, parallel_threshold):
+        summary["total"] += length
+        summary["invalid"] += length - len(users)
+
+        room = max_errors - len(summary["errors"])
+        summary["errors"].extend(errors[:room])
+        if len(errors) > room:
+            summary["errors_truncated"] = True
+
+        # Repeated ids in the chunk become a single write
+        valid = len(users)
+        users, duplicates = dedupe_users(users)
+        summary["duplicates"] += duplicates
+
+        # Merge into existing users or create new ones in one round trip
+        new, merged, failed = upsert_users(db, users)
+        summary["new"] += new
+        summary["merged"] += merged
+        summary["invalid"] += failed
+        summary["valid"] += valid - failed
+        if on_chunk:
+            on_chunk(summary)
+
+    if summary["invalid"]:
+        print(f"WARNING: {summary['invalid']} of {summary['total']} user records were rejected.")
+    return summary
+
+
+def new_event_summary() -> dict:
+    return {
+        "total": 0,
+        "count": 0,
+        "campaigns_triggered": 0
+    }
+
+
+def ingest_event_records(db, records, chunk_size: int = DEFAULT_CHUNK_SIZE, summary: dict = None,
+                         on_chunk=None) -> dict:
+    """
+    Stores trigger events in chunks and resolves their segment audiences.
+    Each distinct topic is resolved once per call: audiences are snapshotted
+    with one aggregation per chunk for topics not seen yet, and matching
+    scheduled campaigns are recorded as outbox triggers for the dispatcher.
+    `on_chunk(summary)` is called once each chunk has been written.
+    """
+    summary = summary or new_event_summary()
+    audiences, campaigns, triggered = {}, {}, set()
+
+    for chunk in chunked(records, chunk_size):
+        summary["total"] += len(chunk)
+        events = [ev for ev in chunk if isinstance(ev, dict) and (ev.get("segment_rule") or {}).get("topic")]
+
+        # Resolve only the topics this upload hasn't seen yet
+        new_topics = list(dict.fromkeys(
+            ev["segment_rule"]["topic"] for ev in events if ev["segment_rule"]["topic"] not in audiences
+        ))
+        if new_topics:
+            audiences.update(snapshot_topic_audiences(db, new_topics))
+            for campaign in db["campaigns"].find({"topic": {"$in": new_topics}, "status": "scheduled"}):
+                campaigns.setdefault(campaign["topic"], campaign)
+
+        for ev in events:
+            topic = ev["segment_rule"]["topic"]
+
+            # Store a reference to the topic's snapshot instead of the user ids
+            audience = audiences[topic]
+            ev["recipient_count"] = audience["recipient_count"]
+            ev["audience_snapshot_id"] = audience["snapshot_id"]
+
+            # If a scheduled campaign exists for the topic, record the trigger in the
+            # event itself (outbox); the dispatcher runs it off the request path
+            campaign = campaigns.get(topic)
+            if campaign:
+                ev["dispatch"] = outbox_entry(str(campaign["_id"]))
+                if campaign["_id"] not in triggered:
+                    triggered.add(campaign["_id"])
+                    summary["campaigns_triggered"] += 1
+
+        if events:
+            db["events_inbound"].insert_many(events)
+        summary["count"] += len(events)
+        if on_chunk:
+            on_chunk(summary)
+
+    return summary
@@ -0,0 +1,257 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import islice
+from threading import Lock
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo import ASCENDING, ReturnDocument
+from app.data.database import get_db_connection
+from app.config import DevelopmentConfig as Config
+from app.services.ingestion import (
+    IngestionError, open_user_records, open_event_records, new_summary, new_event_summary,
+    ingest_user_records, ingest_event_records
+)
+
+KINDS = ("users", "events")
+
+_executor = None
+_executor_lock = Lock()
+
+
+class UploadConflict(ValueError):
+    """Raised when a chunk does not continue the upload at its committed offset."""
+
+    def __init__(self, message: str, offset: int):
+        super().__init__(message)
+        self.offset = offset
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Lazily starts the process-wide pool that processes ingestion jobs."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=Config.INGEST_JOB_WORKERS, thread_name_prefix="ingestion-job")
+        return _executor
+
+
+class UploadStream(io.RawIOBase):
+    """
+    Reads a persisted upload back as one binary stream, fetching its chunks
+    in offset order as they are consumed. `position` is the number of bytes
+    handed out so far.
+    """
+
+    def __init__(self, db, job_id):
+        self._chunks = db["ingestion_chunks"].find({"job_id": job_id}, batch_size=2).sort("offset", ASCENDING)
+        self._data = b""
+        self._pos = 0
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self._pos >= len(self._data):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._data, self._pos = bytes(chunk["data"]), 0
+        size = min(len(buffer), len(self._data) - self._pos)
+        buffer[:size] = self._data[self._pos:self._pos + size]
+        self._pos += size
+        self.position += size
+        return size
+
+
+def create_ingestion_job(kind: str, filename: str, size: int = None) -> str:
+    """Registers an upload that will be sent in chunks; returns the job id."""
+    _, db = get_db_connection(Config)
+    if kind not in KINDS:
+        raise ValueError(f"Unknown ingestion kind '{kind}'")
+
+    db["ingestion_chunks"].create_index([("job_id", ASCENDING), ("offset", ASCENDING)], unique=True)
+    job = {
+        "kind": kind,
+        "filename": filename,
+        "size": size,
+        "status": "uploading",
+        "received_bytes": 0,
+        "records_done": 0,
+        "bytes_processed": 0,
+        "summary": new_summary() if kind == "users" else new_event_summary(),
+        "created_at": datetime.utcnow(),
+        "updated_at": datetime.utcnow(),
+        "started_at": None,
+        "finished_at": None,
+        "error": None
+    }
+    return str(db["ingestion_jobs"].insert_one(job).inserted_id)
+
+
+def _object_id(job_id: str):
+    try:
+        return ObjectId(job_id)
+    except (InvalidId, TypeError):
+        return None
+
+
+def append_chunk(job_id: str, offset: int, data: bytes):
+    """
+    Persists one piece of an upload at `offset`. A chunk must start exactly
+    where the committed upload ends; re-sending the last chunk after a lost
+    response is accepted. Returns the new committed offset, or None if the
+    job does not exist.
+    """
+    _, db = get_db_connection(Config)
+    oid = _object_id(job_id)
+    job = db["ingestion_jobs"].find_one({"_id": oid}) if oid else None
+    if not job:
+        return None
+    if job["status"] != "uploading":
+        raise UploadConflict("Upload is already complete", job["received_bytes"])
+    if len(data) > Config.INGEST_UPLOAD_CHUNK_SIZE:
+        raise UploadConflict(f"Chunks may be at most {Config.INGEST_UPLOAD_CHUNK_SIZE} bytes", job["received_bytes"])
+
+    received = job["received_bytes"]
+    if offset != received:
+        previous = db["ingestion_chunks"].find_one({"job_id": oid, "offset": offset}, {"size": 1})
+        if previous and offset + previous["size"] == received and previous["size"] == len(data):
+            return received
+        raise UploadConflict(f"Expected a chunk at offset {received}", received)
+
+    # Store the chunk first; the offset only advances once it is durable
+    db["ingestion_chunks"].replace_one(
+        {"job_id": oid, "offset": offset},
+        {"job_id": oid, "offset": offset, "size": len(data), "data": Binary(data)},
+        upsert=True
+    )
+    result = db["ingestion_jobs"].update_one(
+        {"_id": oid, "status": "uploading", "received_bytes": offset},
+        {"$inc": {"received_bytes": len(data)}, "$set": {"updated_at": datetime.utcnow()}}
+    )
+    if result.matched_count == 0:
+        current = db["ingestion_jobs"].find_one({"_id": oid}, {"received_bytes": 1})
+        raise UploadConflict("Upload changed concurrently", current["received_bytes"])
+    return offset + len(data)
+
+
+def start_ingestion_job(job_id: str):
+    """
+    Queues a fully uploaded job for processing, or resumes a failed or
+    stalled one from its last committed chunk. Returns the job status, or
+    None if the job does not exist.
+    """
+    _, db = get_db_connection(Config)
+    oid = _object_id(job_id)
+    if not oid or not db["ingestion_jobs"].find_one({"_id": oid}, {"_id": 1}):
+        return None
+
+    stale = datetime.utcnow() - timedelta(seconds=Config.INGEST_JOB_STALE_SECONDS)
+    job = db["ingestion_jobs"].find_one_and_update(
+        {"_id": oid, "$or": [
+            {"status": {"$in": ["uploading", "failed"]}},
+            {"status": "processing", "updated_at": {"$lt": stale}}
+        ]},
+        {"$set": {"status": "queued", "error": None, "updated_at": datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER
+    )
+    if job is None:
+        return db["ingestion_jobs"].find_one({"_id": oid}, {"status": 1})["status"]
+
+    _get_executor().submit(_process_job, oid)
+    return job["status"]
+
+
+def _process_job(oid):
+    """Parses the persisted upload and ingests it, committing progress per chunk."""
+    _, db = get_db_connection(Config)
+    jobs = db["ingestion_jobs"]
+    job = jobs.find_one_and_update(
+        {"_id": oid, "status": "queued"},
+        {"$set": {"status": "processing", "started_at": datetime.utcnow(), "updated_at": datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER
+    )
+    if job is None:
+        return
+
+    raw = UploadStream(db, oid)
+    stream = io.BufferedReader(raw, buffer_size=64 * 1024)
+    resumed_from = job["records_done"]
+
+    def commit(summary: dict):
+        jobs.update_one({"_id": oid}, {"$set": {
+            "summary": summary,
+            "records_done": summary["total"],
+            "bytes_processed": raw.position,
+            "resumed_from": resumed_from,
+            "updated_at": datetime.utcnow()
+        }})
+
+    try:
+        if job["kind"] == "users":
+            records = open_user_records(stream, job["filename"])
+            ingest = ingest_user_records
+        else:
+            records = open_event_records(stream)
+            ingest = ingest_event_records
+
+        # Skip the records already committed by an earlier attempt
+        records = islice(records, resumed_from, None)
+        summary = ingest(db, records, summary=job["summary"], on_chunk=commit)
+    except Exception as error:
+        if not isinstance(error, IngestionError):
+            print(f"ERROR: Ingestion job '{oid}' failed: {error}")
+        jobs.update_one({"_id": oid}, {"$set": {"status": "failed", "error": str(error), "updated_at": datetime.utcnow()}})
+        return
+
+    jobs.update_one({"_id": oid}, {"$set": {
+        "status": "completed",
+        "summary": summary,
+        "records_done": summary["total"],
+        "bytes_processed": job["received_bytes"],
+        "finished_at": datetime.utcnow(),
+        "updated_at": datetime.utcnow()
+    }})
+    db["ingestion_chunks"].delete_many({"job_id": oid})
+
+
+def get_ingestion_job(job_id: str):
+    """
+    Returns an ingestion job's upload and processing progress, its
+    throughput in rows per second and the partial summary, or None.
+    """
+    _, db = get_db_connection(Config)
+    oid = _object_id(job_id)
+    job = db["ingestion_jobs"].find_one({"_id": oid}) if oid else None
+    if not job:
+        return None
+
+    rows_per_sec = None
+    if job.get("started_at"):
+        end = job.get("finished_at") or datetime.utcnow()
+        elapsed = (end - job["started_at"]).total_seconds()
+        rows = job["records_done"] - job.get("resumed_from", 0)
+        rows_per_sec = round(rows / elapsed, 1) if elapsed > 0 else None
+
+    received = job["received_bytes"]
+    progress_pct = round(min(job["bytes_processed"] / received, 1.0) * 100, 1) if received else 0.0
+
+    return {
+        "job_id": str(job["_id"]),
+        "kind": job["kind"],
+        "filename": job["filename"],
+        "status": job["status"],
+        "size": job.get("size"),
+        "received_bytes": received,
+        "records_done": job["records_done"],
+        "progress_pct": progress_pct,
+        "rows_per_sec": rows_per_sec,
+        "summary": job["summary"],
+        "created_at": job["created_at"],
+        "started_at": job.get("started_at"),
+        "finished_at": job.get("finished_at"),
+        "error": job.get("error")
+    }
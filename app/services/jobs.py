@@ -0,0 +1,202 @@
+import os
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Lock, Thread, Event
+from time import monotonic
+from uuid import uuid4
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from app.data.database import get_db_connection
+from app.services.campaign_runner import run_campaign, _summary
+from app.config import DevelopmentConfig as Config
+
+ACTIVE_STATUSES = ["queued", "running"]
+
+_executor = None
+_executor_lock = Lock()
+_owner = None
+_heartbeat_stopped = Event()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Lazily starts the process-wide pool that executes campaign jobs, and its heartbeat."""
+    global _executor, _owner
+    with _executor_lock:
+        if _executor is None:
+            _owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+            _executor = ThreadPoolExecutor(max_workers=Config.JOB_WORKERS, thread_name_prefix="campaign-job")
+            Thread(target=_heartbeat, args=(_owner,), name="campaign-job-heartbeat", daemon=True).start()
+        return _executor
+
+
+def _heartbeat(owner: str):
+    """
+    Refreshes `updated_at` on every queued or running job this process owns.
+    A job whose process dies stops being refreshed and is expired by
+    `expire_stale_jobs`, so it no longer blocks new runs of its campaign.
+    """
+    _, db = get_db_connection(Config)
+    while not _heartbeat_stopped.wait(Config.JOB_HEARTBEAT_INTERVAL):
+        try:
+            db["campaign_jobs"].update_many(
+                {"owner": owner, "status": {"$in": ACTIVE_STATUSES}},
+                {"$set": {"updated_at": datetime.utcnow()}}
+            )
+        except Exception as error:
+            print(f"ERROR: Campaign job heartbeat failed: {error}")
+
+
+def expire_stale_jobs(db, query: dict = None) -> int:
+    """
+    Marks queued or running jobs matching `query` as failed once their
+    process hasn't refreshed them for JOB_STALE_SECONDS. Returns how many
+    were expired.
+    """
+    stale = datetime.utcnow() - timedelta(seconds=Config.JOB_STALE_SECONDS)
+    result = db["campaign_jobs"].update_many(
+        {**(query or {}), "status": {"$in": ACTIVE_STATUSES}, "$or": [
+            {"updated_at": {"$lt": stale}},
+            {"updated_at": {"$exists": False}}
+        ]},
+        {"$set": {
+            "status": "failed",
+            "error": "Job stopped heartbeating; its worker process is gone.",
+            "finished_at": datetime.utcnow()
+        }}
+    )
+    if result.modified_count:
+        print(f"WARNING: Expired {result.modified_count} stale campaign job(s).")
+    return result.modified_count
+
+
+def find_active_job(db, campaign_id: str):
+    """Returns the campaign's live queued or running job, ignoring ones whose process died."""
+    expire_stale_jobs(db, {"campaign_id": campaign_id})
+    return db["campaign_jobs"].find_one({"campaign_id": campaign_id, "status": {"$in": ACTIVE_STATUSES}})
+
+
+def submit_campaign_job(campaign_id: str, shards: int = None) -> str:
+    """
+    Records a queued run in campaign_jobs and hands it to the worker pool.
+    With `shards`, the run is split across local worker processes.
+    Returns the job id immediately; the run happens in the background.
+    """
+    _, db = get_db_connection(Config)
+    executor = _get_executor()
+    job = {
+        "campaign_id": campaign_id,
+        "shards": shards,
+        "status": "queued",
+        "owner": _owner,
+        "progress": {},
+        "created_at": datetime.utcnow(),
+        "updated_at": datetime.utcnow(),
+        "started_at": None,
+        "finished_at": None,
+        "result": None,
+        "error": None
+    }
+    job_id = db["campaign_jobs"].insert_one(job).inserted_id
+    executor.submit(_execute_job, job_id, campaign_id, shards)
+    return str(job_id)
+
+
+def _execute_job(job_id, campaign_id: str, shards: int = None):
+    """Runs one campaign job and keeps its document up to date."""
+    # Imported here: the app package imports this module, and sharding also runs as `python -m app.services.sharding`
+    from app.services.sharding import run_campaign_sharded
+
+    _, db = get_db_connection(Config)
+    jobs = db["campaign_jobs"]
+    jobs.update_one({"_id": job_id}, {"$set": {"status": "running", "started_at": datetime.utcnow(), "updated_at": datetime.utcnow()}})
+
+    last_write = 0.0
+    latest = {}
+
+    def progress(counts: dict):
+        # Throttle progress writes; the final snapshot is stored with the result
+        nonlocal last_write, latest
+        latest = counts
+        now = monotonic()
+        if now - last_write >= Config.JOB_PROGRESS_INTERVAL:
+            last_write = now
+            jobs.update_one({"_id": job_id}, {"$set": {"progress": counts}})
+
+    try:
+        if shards:
+            totals = run_campaign_sharded(campaign_id, shard_count=shards)
+            latest = totals or {}
+            result = _summary(campaign_id, latest) if totals is not None else {"error": "Sharded run did not complete."}
+        else:
+            result = run_campaign(campaign_id, progress=progress)
+    except Exception as error:
+        print(f"ERROR: Campaign job '{job_id}' failed: {error}")
+        jobs.update_one(
+            {"_id": job_id},
+            {"$set": {
+                "status": "failed",
+                "progress": latest,
+                "error": str(error),
+                "finished_at": datetime.utcnow()
+            }}
+        )
+        return
+
+    status = "failed" if "error" in result else "completed"
+    jobs.update_one(
+        {"_id": job_id},
+        {"$set": {
+            "status": status,
+            "progress": latest,
+            "result": result,
+            "error": result.get("error"),
+            "finished_at": datetime.utcnow()
+        }}
+    )
+
+
+def get_job(job_id: str):
+    """
+    Returns a job's status with processed/sent/skipped/suppressed counters and an ETA
+    in seconds extrapolated from the throughput so far, or None if unknown.
+    """
+    _, db = get_db_connection(Config)
+    try:
+        oid = ObjectId(job_id)
+    except InvalidId:
+        return None
+    expire_stale_jobs(db, {"_id": oid})
+    job = db["campaign_jobs"].find_one({"_id": oid})
+    if not job:
+        return None
+
+    progress = job.get("progress") or {}
+    result = job.get("result") or {}
+    processed = progress.get("processed", 0)
+    total = progress.get("total", 0)
+
+    eta_seconds = None
+    if job["status"] == "running" and job.get("started_at") and processed:
+        elapsed = (datetime.utcnow() - job["started_at"]).total_seconds()
+        eta_seconds = round(elapsed / processed * max(total - processed, 0), 1)
+    elif job["status"] in ("completed", "failed"):
+        eta_seconds = 0
+
+    return {
+        "job_id": str(job["_id"]),
+        "campaign_id": job["campaign_id"],
+        "status": job["status"],
+        "processed": processed,
+        "total": total,
+        "sent": result.get("total_sent", progress.get("sent", 0)),
+        "skipped": result.get("skipped", progress.get("skipped", 0)),
+        "suppressed": result.get("suppressed", progress.get("suppressed", 0)),
+        "delayed": result.get("delayed", progress.get("delayed", 0)),
+        "failed": result.get("failed", progress.get("failed", 0)),
+        "eta_seconds": eta_seconds,
+        "created_at": job["created_at"],
+        "started_at": job.get("started_at"),
+        "finished_at": job.get("finished_at"),
+        "error": job.get("error")
+    }
@@ -0,0 +1,30 @@
+from datetime import datetime
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+
+class DeliveryLedger:
+    """
+    Idempotency ledger for campaign sends.
+    Holds one document per (campaign_id, user_id), enforced by a unique
+    index. A recipient is claimed right before its terminal decision (send,
+    skip, failure) is made, so a restarted or concurrent run can never
+    message the same user twice for one campaign. Sends are at-most-once:
+    a crash loses only the claims still waiting on the send engine, which
+    is bounded by its pending slots rather than by the audience batch.
+    """
+
+    def __init__(self, db):
+        self.collection = db["campaign_deliveries"]
+        self.collection.create_index([("campaign_id", ASCENDING), ("user_id", ASCENDING)], unique=True)
+
+    def claim(self, campaign_id: str, user_id: str) -> bool:
+        """
+        Claims one recipient.
+        Returns False if the recipient is already in the ledger.
+        """
+        try:
+            self.collection.insert_one({"campaign_id": campaign_id, "user_id": user_id, "claimed_at": datetime.utcnow()})
+        except DuplicateKeyError:
+            return False
+        return True
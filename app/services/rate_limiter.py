@@ -0,0 +1,69 @@
+from threading import Lock
+from time import monotonic, sleep
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.
+    Tokens refill continuously at `rate` per second up to `capacity`, so
+    sends are spread evenly instead of arriving in bursts followed by
+    long pauses. Rates below one message per second are supported.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self._lock = Lock()
+        self.set_rate(rate, capacity)
+        self._tokens = self.capacity
+        self._updated_at = monotonic()
+
+    def set_rate(self, rate: float, capacity: float = None):
+        """Changes the refill rate; the capacity defaults to one second of traffic."""
+        if rate <= 0:
+            raise ValueError("Rate must be a positive number of messages per second")
+        with self._lock:
+            self.rate = float(rate)
+            self.capacity = float(capacity) if capacity else max(1.0, self.rate)
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """
+        Takes `tokens` if available and returns 0.
+        Otherwise returns how many seconds to wait before trying again.
+        """
+        with self._lock:
+            self._refill(monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens: float = 1):
+        """Blocks until `tokens` are available and takes them."""
+        while True:
+            wait_for = self.try_acquire(tokens)
+            if not wait_for:
+                return
+            sleep(wait_for)
+
+
+_buckets = {}
+_buckets_lock = Lock()
+
+
+def get_bucket(key: str, rate: float, capacity: float = None) -> TokenBucket:
+    """
+    Returns the process-wide bucket registered under `key`, creating it on
+    first use. Campaigns and workers that share a key (e.g. the same sender
+    number) share one budget; the latest configured rate wins.
+    """
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = _buckets[key] = TokenBucket(rate, capacity)
+            return bucket
+    if bucket.rate != rate:
+        bucket.set_rate(rate, capacity)
+    return bucket
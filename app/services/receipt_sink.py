@@ -0,0 +1,19 @@
+from app.services.bulk_writer import BulkWriter
+
+
+class ReceiptSink(BulkWriter):
+    """
+    Buffers delivery_receipts writes through a BulkWriter.
+    `on_flush(documents)` receives the receipts each flush inserted, so
+    counters and rollups are only fed receipts that actually landed.
+    """
+
+    def __init__(self, collection, max_batch: int = 500, max_interval: float = 2.0, on_flush=None):
+        super().__init__(collection, max_batch=max_batch, max_interval=max_interval)
+        self.on_flush = on_flush
+
+    def _written(self, ops: list, failed: set):
+        if self.on_flush:
+            inserted = [doc for i, (_, doc) in enumerate(ops) if doc is not None and i not in failed]
+            if inserted:
+                self.on_flush(inserted)
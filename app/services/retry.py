@@ -0,0 +1,89 @@
+import heapq
+import random
+from itertools import count
+from threading import Condition, Thread
+from time import monotonic
+from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout
+from twilio.base.exceptions import TwilioRestException
+
+RETRYABLE = "retryable"
+PERMANENT = "permanent"
+
+
+def classify_send_error(error: Exception) -> str:
+    """
+    Splits provider errors into ones worth retrying (throttling, provider
+    outages, network timeouts) and permanent ones such as an invalid
+    number, which would fail the same way on every attempt.
+    """
+    if isinstance(error, TwilioRestException):
+        status = error.status or 0
+        if status == 429 or status >= 500:
+            return RETRYABLE
+        return PERMANENT
+    if isinstance(error, (RequestsConnectionError, Timeout, TimeoutError, ConnectionError)):
+        return RETRYABLE
+    # Unknown failures keep the previous behaviour of being retried
+    return RETRYABLE
+
+
+def error_code(error: Exception):
+    """Returns the provider error code when there is one."""
+    code = getattr(error, "code", None)
+    return str(code) if code is not None else None
+
+
+def backoff_delay(attempt: int, base: float = 2.0, cap: float = 60.0) -> float:
+    """
+    Exponential backoff with jitter for the given (1-based) failed attempt.
+    Jitter spreads retries out so throttled recipients don't retry in lockstep.
+    """
+    ceiling = min(cap, base * (2 ** (attempt - 1)))
+    return random.uniform(ceiling / 2, ceiling)
+
+
+class RetryQueue:
+    """
+    Delayed queue backed by a heap and a single timer thread.
+    Scheduled callables are handed to `dispatch` once their delay expires,
+    so waiting retries hold no send worker and healthy sends keep flowing.
+    """
+
+    def __init__(self, dispatch):
+        self._dispatch = dispatch
+        self._heap = []
+        self._sequence = count()
+        self._condition = Condition()
+        self._closed = False
+        self._thread = Thread(target=self._run, name="retry-queue", daemon=True)
+        self._thread.start()
+
+    def schedule(self, delay: float, task):
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("cannot schedule on a closed retry queue")
+            heapq.heappush(self._heap, (monotonic() + delay, next(self._sequence), task))
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._heap:
+                        wait_for = self._heap[0][0] - monotonic()
+                        if wait_for <= 0:
+                            break
+                    elif self._closed:
+                        return
+                    else:
+                        wait_for = None
+                    self._condition.wait(wait_for)
+                _, _, task = heapq.heappop(self._heap)
+            self._dispatch(task)
+
+    def close(self):
+        """Stops the timer thread once every scheduled task has been dispatched."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
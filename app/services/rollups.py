@@ -0,0 +1,98 @@
+from collections import Counter
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+
+METRICS = ("sent", "delivered", "read", "failed", "skipped", "delayed")
+
+# Send decisions and provider statuses that count towards a funnel metric
+DECISION_METRICS = {"SENT": "sent", "FAILED": "failed", "SKIPPED": "skipped", "DELAYED": "delayed"}
+STATUS_METRICS = {"delivered": "delivered", "read": "read", "failed": "failed", "undelivered": "failed"}
+
+
+def bucket_of(at: datetime) -> datetime:
+    """Truncates a timestamp to its one-minute rollup bucket."""
+    return at.replace(second=0, microsecond=0)
+
+
+def record_rollups(db, events):
+    """
+    Adds `(campaign_id, at, metric)` events to the per-campaign, per-minute
+    counters in `campaign_rollups`. Events for the same bucket are summed
+    first, so a whole batch costs one $inc per touched bucket in a single
+    unordered bulk write.
+    """
+    increments = Counter()
+    for campaign_id, at, metric in events:
+        if campaign_id and metric in METRICS:
+            increments[(campaign_id, bucket_of(at), metric)] += 1
+    if not increments:
+        return
+
+    buckets = {}
+    for (campaign_id, bucket, metric), n in increments.items():
+        buckets.setdefault((campaign_id, bucket), {})[f"counts.{metric}"] = n
+
+    rollups = db["campaign_rollups"]
+    rollups.create_index([("campaign_id", ASCENDING), ("bucket", ASCENDING)])
+    ops = [
+        UpdateOne(
+            {"_id": f"{campaign_id}:{bucket:%Y%m%d%H%M}"},
+            {"$inc": inc, "$setOnInsert": {"campaign_id": campaign_id, "bucket": bucket}},
+            upsert=True
+        )
+        for (campaign_id, bucket), inc in buckets.items()
+    ]
+    try:
+        rollups.bulk_write(ops, ordered=False)
+    except BulkWriteError as error:
+        print(f"ERROR: {len(error.details.get('writeErrors', []))} rollup updates failed: {error}")
+
+
+def receipt_rollup_events(documents: list):
+    """Maps freshly inserted send receipts to rollup events by their decision."""
+    return [
+        (doc.get("campaign_id"), doc.get("timestamp") or datetime.utcnow(), DECISION_METRICS.get(doc.get("decision")))
+        for doc in documents
+    ]
+
+
+def campaign_analytics(db, campaign_id: str, start: datetime = None, end: datetime = None,
+                       interval_minutes: int = 60) -> dict:
+    """
+    Builds a campaign's funnel and time series from its rollup buckets
+    only. `start`/`end` bound the buckets read and `interval_minutes`
+    sets the width of each point in the series.
+    """
+    query = {"campaign_id": campaign_id}
+    if start or end:
+        query["bucket"] = {}
+        if start:
+            query["bucket"]["$gte"] = bucket_of(start)
+        if end:
+            query["bucket"]["$lt"] = end
+    interval = timedelta(minutes=max(1, interval_minutes))
+
+    totals = Counter()
+    series = {}
+    for doc in db["campaign_rollups"].find(query, {"_id": 0, "bucket": 1, "counts": 1}).sort("bucket", ASCENDING):
+        counts = doc.get("counts", {})
+        totals.update(counts)
+        # Align each minute bucket to the start of its series interval
+        offset = (doc["bucket"] - datetime.min) % interval
+        series.setdefault(doc["bucket"] - offset, Counter()).update(counts)
+
+    sent = totals["sent"]
+    funnel = {metric: totals[metric] for metric in METRICS}
+    funnel["delivery_rate"] = round(totals["delivered"] / sent * 100, 2) if sent else 0
+    funnel["read_rate"] = round(totals["read"] / sent * 100, 2) if sent else 0
+
+    return {
+        "campaign_id": campaign_id,
+        "interval_minutes": int(interval.total_seconds() // 60),
+        "funnel": funnel,
+        "series": [
+            {"bucket": bucket, **{metric: counts[metric] for metric in METRICS}}
+            for bucket, counts in sorted(series.items())
+        ]
+    }
@@ -0,0 +1,188 @@
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+from time import sleep
+from uuid import uuid4
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from pymongo import ASCENDING
+from app.data.database import get_db_connection
+from app.services.bulk_writer import BulkWriter
+from app.config import DevelopmentConfig as Config
+
+
+class QuietWindow:
+    """
+    A daily quiet period parsed once, e.g. 22:00-07:00.
+    Windows may wrap past midnight; the end time itself is no longer quiet.
+    """
+
+    def __init__(self, quiet_hours: dict):
+        self.start = datetime.strptime(quiet_hours["start"], "%H:%M").time()
+        self.end = datetime.strptime(quiet_hours["end"], "%H:%M").time()
+
+    def contains(self, moment) -> bool:
+        """Checks whether a wall-clock time falls inside the window."""
+        moment = moment.replace(tzinfo=None)
+        if self.start < self.end:
+            return self.start <= moment < self.end
+        return moment >= self.start or moment < self.end
+
+    @staticmethod
+    def _next(now: datetime, at) -> datetime:
+        candidate = now.replace(hour=at.hour, minute=at.minute, second=0, microsecond=0)
+        if candidate <= now:
+            candidate += timedelta(days=1)
+        return candidate
+
+    def next_end(self, now: datetime) -> datetime:
+        return self._next(now, self.end)
+
+    def next_boundary(self, now: datetime) -> datetime:
+        return min(self._next(now, self.start), self._next(now, self.end))
+
+
+def _to_utc_naive(moment: datetime) -> datetime:
+    # Documents store naive UTC datetimes (datetime.utcnow()) throughout the platform
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+class QuietSchedule:
+    """
+    Evaluates a campaign's quiet window once per timezone and reuses the
+    answer until the window next opens or closes, instead of re-parsing
+    and re-checking it for every recipient.
+    Recipients may carry an IANA `timezone` attribute; everyone else is
+    evaluated in the server's local time.
+    """
+
+    def __init__(self, quiet_hours: dict):
+        self.window = QuietWindow(quiet_hours)
+        self._decisions = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def _zone(tz_name):
+        if tz_name:
+            try:
+                return ZoneInfo(tz_name)
+            except (ZoneInfoNotFoundError, ValueError):
+                pass
+        return None
+
+    def release_at(self, tz_name: str = None):
+        """
+        Returns None when sending is allowed now, otherwise the UTC time at
+        which the quiet window ends for that timezone.
+        """
+        now_utc = datetime.now(timezone.utc)
+        with self._lock:
+            cached = self._decisions.get(tz_name)
+            if cached and now_utc < cached[1]:
+                return cached[0]
+
+        zone = self._zone(tz_name)
+        local_now = now_utc.astimezone(zone) if zone else now_utc.astimezone()
+        release_at = None
+        if self.window.contains(local_now.time()):
+            release_at = _to_utc_naive(self.window.next_end(local_now))
+        valid_until = self.window.next_boundary(local_now).astimezone(timezone.utc)
+
+        with self._lock:
+            self._decisions[tz_name] = (release_at, valid_until)
+        return release_at
+
+
+class DeferredQueue:
+    """
+    Persistent time-ordered queue of sends held back by quiet hours.
+    Entries live in the `deferred_sends` collection ordered by an index
+    on release_at, so the earliest due recipients are always read first
+    and nothing is lost if the process restarts.
+    """
+
+    def __init__(self, db):
+        self.collection = db["deferred_sends"]
+        self.collection.create_index([("status", ASCENDING), ("release_at", ASCENDING)])
+        self.collection.create_index([("campaign_id", ASCENDING), ("user_id", ASCENDING)], unique=True)
+        self._writes = BulkWriter(self.collection)
+
+    def defer(self, campaign_id: str, user_id: str, release_at: datetime):
+        """
+        Queues one recipient; writes are buffered and bulk-upserted.
+        Re-deferring a recipient only moves its release time.
+        """
+        self._writes.update(
+            {"campaign_id": campaign_id, "user_id": user_id},
+            {
+                "$set": {"release_at": release_at, "status": "pending", "claimed_by": None},
+                "$setOnInsert": {"created_at": datetime.utcnow()}
+            },
+            upsert=True
+        )
+
+    def flush(self):
+        self._writes.flush()
+
+    def claim_due(self, limit: int, now: datetime = None, stale_after: float = 600) -> list:
+        """
+        Atomically claims up to `limit` entries whose release time has passed,
+        earliest first. Concurrent schedulers never claim the same entry;
+        claims older than `stale_after` seconds (a crashed scheduler) are
+        claimable again.
+        """
+        now = now or datetime.utcnow()
+        claimable = {"$or": [
+            {"status": "pending"},
+            {"status": "claimed", "claimed_at": {"$lt": now - timedelta(seconds=stale_after)}}
+        ]}
+        due_ids = [
+            doc["_id"] for doc in self.collection.find(
+                {**claimable, "release_at": {"$lte": now}},
+                {"_id": 1}
+            ).sort("release_at", ASCENDING).limit(limit)
+        ]
+        if not due_ids:
+            return []
+
+        token = uuid4().hex
+        self.collection.update_many(
+            {**claimable, "_id": {"$in": due_ids}},
+            {"$set": {"status": "claimed", "claimed_by": token, "claimed_at": now}}
+        )
+        return list(self.collection.find({"claimed_by": token}).sort("release_at", ASCENDING))
+
+    def complete(self, entry_ids: list):
+        """Removes delivered (or permanently failed) entries from the queue."""
+        if entry_ids:
+            self.collection.delete_many({"_id": {"$in": entry_ids}})
+
+    def next_release_at(self):
+        """Returns the earliest pending release time, or None if the queue is empty."""
+        doc = self.collection.find_one({"status": "pending"}, sort=[("release_at", ASCENDING)])
+        return doc["release_at"] if doc else None
+
+
+def run_scheduler(batch_size: int = 500, idle_interval: float = 30.0):
+    """
+    Releases deferred sends as their quiet windows end, one rate-limited
+    batch at a time. Meant to run as its own process:
+        python -m app.services.scheduler
+    """
+    # Imported here: campaign_runner imports this module
+    from app.services.campaign_runner import deliver_deferred
+
+    _, db = get_db_connection(Config)
+    queue = DeferredQueue(db)
+    while True:
+        if deliver_deferred(batch_size):
+            continue
+
+        # Idle: sleep until the earliest pending release, capped by idle_interval
+        next_release = queue.next_release_at()
+        wait_for = idle_interval
+        if next_release:
+            wait_for = min(idle_interval, max((next_release - datetime.utcnow()).total_seconds(), 1.0))
+        sleep(wait_for)
+
+
+if __name__ == "__main__":
+    run_scheduler()
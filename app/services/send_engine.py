@@ -0,0 +1,96 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Condition
+from app.services.retry import RetryQueue
+
+
+class SendEngine:
+    """
+    Runs per-recipient send tasks on a bounded thread pool so provider
+    HTTP calls overlap instead of blocking the campaign one at a time.
+    Each task owns one recipient end to end (retries and receipt), which
+    keeps per-recipient ordering while recipients proceed concurrently.
+    `submit` blocks once `max_pending` tasks are in flight, so a streaming
+    audience is never drained into memory faster than it can be sent.
+    `submit_later` parks a task (e.g. a retry with backoff) on a delayed
+    queue instead of sleeping on a worker.
+    """
+
+    def __init__(self, max_workers: int = 4, max_pending: int = None):
+        self.max_workers = max(1, int(max_workers))
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="send")
+        self._slots = BoundedSemaphore(max_pending or self.max_workers * 2)
+        self._idle = Condition()
+        self._in_flight = 0
+        self._delayed = RetryQueue(self._dispatch_delayed)
+
+    def submit(self, fn, *args, callback=None):
+        """
+        Schedules `fn(*args)`, waiting for a free slot first.
+        `callback(result)` runs on the worker once `fn` returns.
+        """
+        self._slots.acquire()
+        with self._idle:
+            self._in_flight += 1
+        try:
+            self._executor.submit(self._run, fn, args, callback, True)
+        except Exception:
+            self._finish(True)
+            raise
+
+    def submit_later(self, delay: float, fn, *args, callback=None):
+        """
+        Schedules `fn(*args)` to run after `delay` seconds without holding a
+        worker or a submission slot meanwhile. Delayed tasks count as in
+        flight, so `wait` also waits for them.
+        """
+        with self._idle:
+            self._in_flight += 1
+        try:
+            self._delayed.schedule(delay, (fn, args, callback))
+        except Exception:
+            self._finish(False)
+            raise
+
+    def _dispatch_delayed(self, task):
+        fn, args, callback = task
+        self._executor.submit(self._run, fn, args, callback, False)
+
+    def _run(self, fn, args, callback, holds_slot):
+        try:
+            result = fn(*args)
+            if callback:
+                callback(result)
+        except Exception as error:
+            print(f"ERROR: Send task failed unexpectedly: {error}")
+        finally:
+            self._finish(holds_slot)
+
+    def _finish(self, holds_slot):
+        if holds_slot:
+            self._slots.release()
+        with self._idle:
+            self._in_flight -= 1
+            if self._in_flight == 0:
+                self._idle.notify_all()
+
+    def wait(self):
+        """Blocks until every submitted task, including its callback, has finished."""
+        with self._idle:
+            while self._in_flight:
+                self._idle.wait()
+
+    def shutdown(self):
+        """
+        Waits for every task, including retries they park on the delayed queue,
+        before closing it; a retry scheduled after the close would be lost.
+        """
+        self.wait()
+        self._delayed.close()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.shutdown()
+        return False
@@ -0,0 +1,250 @@
+import argparse
+import multiprocessing
+import os
+import socket
+from collections import Counter
+from datetime import datetime, timedelta
+from threading import Event, Thread
+from time import sleep
+from uuid import uuid4
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, ReturnDocument
+from app.data.database import get_db_connection
+from app.services.campaign_runner import _load_campaign, process_audience
+from app.config import DevelopmentConfig as Config
+
+
+def plan_shards(db, campaign_id: str, shard_count: int, worker_count: int = None) -> str:
+    """
+    Starts a sharded run of the campaign, with one lease document per hash
+    shard of its audience, and returns the run id. While a run is still
+    unfinished (recorded as `shard_run` on the campaign) this joins it
+    instead, keeping that run's shard count, so every worker may call it.
+    `worker_count` is how many workers will run shards at the same time; each
+    one paces itself at that share of the campaign and sender rate limits.
+    """
+    if shard_count < 1:
+        raise ValueError(f"shard_count must be positive, got {shard_count}")
+    shards = db["campaign_shards"]
+    shards.create_index([("run_id", ASCENDING), ("status", ASCENDING), ("lease_expires_at", ASCENDING)])
+    worker_count = worker_count or shard_count
+
+    run = {"run_id": uuid4().hex, "shard_count": shard_count, "worker_count": worker_count}
+    started = db["campaigns"].update_one(
+        {"_id": ObjectId(campaign_id), "shard_run": None},
+        {"$set": {"shard_run": run}}
+    )
+    if not started.modified_count:
+        current = (db["campaigns"].find_one({"_id": ObjectId(campaign_id)}, {"shard_run": 1}) or {}).get("shard_run")
+        if current:
+            if current["shard_count"] != shard_count:
+                print(f"Joining unfinished run {current['run_id']} of campaign '{campaign_id}' with {current['shard_count']} shards.")
+            run = current
+        else:
+            print(f"WARNING: Campaign '{campaign_id}' not found; shards are not tied to a campaign.")
+    else:
+        # Shards of earlier, finished runs have already been summed onto the campaign
+        shards.delete_many({"campaign_id": campaign_id, "run_id": {"$ne": run["run_id"]}})
+
+    for index in range(run["shard_count"]):
+        shards.update_one(
+            {"_id": f"{run['run_id']}:{index}"},
+            {"$setOnInsert": {
+                "campaign_id": campaign_id,
+                "run_id": run["run_id"],
+                "shard": index,
+                "shard_count": run["shard_count"],
+                "worker_count": run["worker_count"],
+                "status": "pending",
+                "owner": None,
+                "lease_expires_at": None,
+                "checkpoint": None,
+                "counts": {},
+                "created_at": datetime.utcnow()
+            }},
+            upsert=True
+        )
+    return run["run_id"]
+
+
+def claim_shard(db, run_id: str, worker_id: str, lease_seconds: float):
+    """
+    Atomically takes an unfinished shard of the run that is unowned or whose
+    owner's lease has expired (a dead worker). Returns the shard document or None.
+    """
+    now = datetime.utcnow()
+    return db["campaign_shards"].find_one_and_update(
+        {
+            "run_id": run_id,
+            "status": {"$ne": "done"},
+            "$or": [{"owner": None}, {"lease_expires_at": {"$lt": now}}]
+        },
+        {"$set": {
+            "owner": worker_id,
+            "status": "running",
+            "lease_expires_at": now + timedelta(seconds=lease_seconds),
+            "heartbeat_at": now
+        }},
+        sort=[("shard", ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+class LeaseHeartbeat:
+    """
+    Extends a shard lease in the background while its owner works on it.
+    If the lease was lost (another worker re-claimed it after a stall),
+    `lost` is set and the owner must stop processing that shard.
+    """
+
+    def __init__(self, db, shard_id: str, worker_id: str, lease_seconds: float):
+        self.db = db
+        self.shard_id = shard_id
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.lost = Event()
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, name=f"lease-{shard_id}", daemon=True)
+
+    def _run(self):
+        while not self._stopped.wait(self.lease_seconds / 3):
+            now = datetime.utcnow()
+            result = self.db["campaign_shards"].update_one(
+                {"_id": self.shard_id, "owner": self.worker_id},
+                {"$set": {"lease_expires_at": now + timedelta(seconds=self.lease_seconds), "heartbeat_at": now}}
+            )
+            if result.matched_count == 0:
+                print(f"WARNING: Lease on shard '{self.shard_id}' lost by {self.worker_id}.")
+                self.lost.set()
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stopped.set()
+        self._thread.join()
+        return False
+
+
+def finalize_if_complete(db, campaign_id: str, run_id: str):
+    """
+    Once every shard of the run is done, sums their counters onto the
+    campaign, marks it completed and ends the run. Safe to call from several
+    workers at once. Returns the run's aggregated counters, or None while
+    shards are still running.
+    """
+    shards = list(db["campaign_shards"].find({"run_id": run_id}))
+    if not shards or any(shard["status"] != "done" for shard in shards):
+        return None
+
+    totals = Counter()
+    for shard in shards:
+        totals.update(shard.get("counts") or {})
+    totals = dict(totals)
+
+    db["campaigns"].update_one(
+        {"_id": ObjectId(campaign_id), "shard_run.run_id": run_id},
+        {
+            "$set": {"status": "completed", "last_run": datetime.utcnow(), "last_run_counts": totals},
+            "$unset": {"checkpoint": "", "shard_run": ""}
+        }
+    )
+    return totals
+
+
+def run_shard_worker(campaign_id: str, run_id: str, worker_id: str = None, lease_seconds: float = None,
+                     poll_interval: float = None):
+    """
+    Claims and processes shards of one campaign run until all of them are done.
+    While other workers hold live leases it keeps polling, so shards of a
+    worker that died are picked up once their lease expires.
+    Returns the run's aggregated counters.
+    """
+    _, db = get_db_connection(Config)
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:6]}"
+    lease_seconds = lease_seconds or Config.SHARD_LEASE_SECONDS
+    poll_interval = poll_interval or lease_seconds / 2
+
+    campaign, template, error = _load_campaign(db, campaign_id)
+    if error:
+        print(f"ERROR: {error}")
+        return {"error": error}
+
+    while True:
+        shard = claim_shard(db, run_id, worker_id, lease_seconds)
+        if shard is None:
+            totals = finalize_if_complete(db, campaign_id, run_id)
+            if totals is not None:
+                return totals
+            sleep(poll_interval)
+            continue
+
+        shard_id = shard["_id"]
+        print(f"Worker {worker_id} processing shard {shard_id}.")
+
+        def save_checkpoint(after, counts):
+            db["campaign_shards"].update_one(
+                {"_id": shard_id, "owner": worker_id},
+                {"$set": {"checkpoint": {"after": after, "counts": counts}, "counts": counts}}
+            )
+
+        with LeaseHeartbeat(db, shard_id, worker_id, lease_seconds) as heartbeat:
+            counts = process_audience(
+                db, campaign, template,
+                checkpoint=shard.get("checkpoint"),
+                save_checkpoint=save_checkpoint,
+                rate_share=1 / shard.get("worker_count", shard["shard_count"]),
+                shard=(shard["shard"], shard["shard_count"]),
+                should_stop=heartbeat.lost.is_set
+            )
+
+        if heartbeat.lost.is_set():
+            continue
+        db["campaign_shards"].update_one(
+            {"_id": shard_id, "owner": worker_id},
+            {"$set": {"status": "done", "counts": counts, "owner": None, "finished_at": datetime.utcnow()}}
+        )
+
+
+def run_campaign_sharded(campaign_id: str, shard_count: int = None, processes: int = None):
+    """
+    Runs one campaign across local worker processes, one hash shard of the
+    audience per lease. Other hosts can join the same run with:
+        python -m app.services.sharding <campaign_id>
+    Returns the aggregated counters once every shard is done.
+    """
+    _, db = get_db_connection(Config)
+    shard_count = Config.CAMPAIGN_SHARDS if shard_count is None else shard_count
+    if shard_count < 1:
+        raise ValueError(f"shard_count must be positive, got {shard_count}")
+    processes = processes or min(shard_count, os.cpu_count() or 1)
+
+    run_id = plan_shards(db, campaign_id, shard_count, worker_count=processes)
+    db["campaigns"].update_one(
+        {"_id": ObjectId(campaign_id)},
+        {"$set": {"status": "running", "updated_at": datetime.utcnow()}}
+    )
+
+    # Spawn rather than fork: MongoClient and Twilio sessions must not cross a fork
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_shard_worker, args=(campaign_id, run_id)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    return finalize_if_complete(db, campaign_id, run_id)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run shards of a campaign in this process.")
+    parser.add_argument("campaign_id")
+    parser.add_argument("--shards", type=int, default=Config.CAMPAIGN_SHARDS)
+    parser.add_argument("--workers", type=int, default=None, help="Workers running shards concurrently across all hosts")
+    args = parser.parse_args()
+
+    _, db = get_db_connection(Config)
+    run_id = plan_shards(db, args.campaign_id, args.shards, worker_count=args.workers)
+    print(run_shard_worker(args.campaign_id, run_id))
@@ -0,0 +1,125 @@
+from collections import Counter
+from threading import Lock
+from time import monotonic
+from pymongo import ASCENDING
+from app.config import Config
+from app.services.suppression import get_suppression_index
+
+RECEIPT_COUNTERS_ID = "delivery_receipts"
+
+_caches = {}
+_caches_lock = Lock()
+
+
+def _count(facet: list) -> int:
+    return facet[0]["n"] if facet else 0
+
+
+def _aggregate_receipt_counts(db) -> dict:
+    """Counts receipts in total and per send status with one $facet aggregation."""
+    db["delivery_receipts"].create_index([("status", ASCENDING)])
+    facets = next(db["delivery_receipts"].aggregate([{"$facet": {
+        "total": [{"$count": "n"}],
+        "by_status": [{"$group": {"_id": "$status", "n": {"$sum": 1}}}]
+    }}]))
+    by_status = {str(row["_id"]): row["n"] for row in facets["by_status"] if row["_id"] is not None}
+    return {"total": _count(facets["total"]), "status": by_status}
+
+
+def aggregate_stats(db) -> dict:
+    """
+    Computes the dashboard figures with one $facet aggregation per
+    collection instead of a count_documents call per figure.
+    """
+    db["users"].create_index([("consent_state", ASCENDING)])
+    users = next(db["users"].aggregate([{"$facet": {
+        "total": [{"$count": "n"}],
+        "opt_outs": [{"$match": {"consent_state": "STOPPED"}}, {"$count": "n"}]
+    }}]))
+    receipts = _aggregate_receipt_counts(db)
+    return _stats(_count(users["total"]), _count(users["opt_outs"]), receipts)
+
+
+def record_receipt_counts(db, documents: list):
+    """
+    Adds freshly inserted receipts to the counters document; a ReceiptSink
+    `on_flush` hook. Only counts once the counters have been built.
+    """
+    by_status = Counter(str(doc.get("status")) for doc in documents if doc.get("status"))
+    increments = {"total": len(documents), **{f"status.{status}": n for status, n in by_status.items()}}
+    db["stats_counters"].update_one({"_id": RECEIPT_COUNTERS_ID}, {"$inc": increments})
+
+
+def rebuild_receipt_counters(db) -> dict:
+    """Recomputes the receipt counters document from the collection."""
+    counts = _aggregate_receipt_counts(db)
+    db["stats_counters"].replace_one({"_id": RECEIPT_COUNTERS_ID}, {"_id": RECEIPT_COUNTERS_ID, **counts}, upsert=True)
+    return counts
+
+
+def counter_stats(db) -> dict:
+    """
+    Reads the dashboard figures in O(1): receipt counters are maintained
+    incrementally by the receipt sinks, the user total comes from
+    collection metadata and opt-outs from the suppression index.
+    """
+    receipts = db["stats_counters"].find_one({"_id": RECEIPT_COUNTERS_ID}) or rebuild_receipt_counters(db)
+    opt_outs = len(get_suppression_index(db))
+    return _stats(db["users"].estimated_document_count(), opt_outs, receipts)
+
+
+def _stats(total_users: int, opt_outs: int, receipts: dict) -> dict:
+    total_receipts = receipts.get("total", 0)
+    sent = receipts.get("status", {}).get("SUCCESS", 0)
+    failed = receipts.get("status", {}).get("ERROR", 0)
+
+    delivery_pct = (sent / total_receipts * 100) if total_receipts > 0 else 0
+    failed_pct = (failed / total_receipts * 100) if total_receipts > 0 else 0
+
+    return {
+        "total_users": total_users,
+        "opt_outs": opt_outs,
+        "sent": sent,
+        "failed": failed,
+        "delivery_pct": round(delivery_pct, 2),
+        "failed_pct": round(failed_pct, 2)
+    }
+
+
+class SingleFlightCache:
+    """
+    Holds one computed value for `ttl` seconds. When it goes stale, the
+    first caller recomputes it while concurrent callers wait for that
+    result instead of starting their own computation.
+    """
+
+    def __init__(self, ttl: float, compute):
+        self.ttl = ttl
+        self.compute = compute
+        self._value = None
+        self._computed_at = None
+        self._lock = Lock()
+
+    def _fresh(self) -> bool:
+        return self._computed_at is not None and monotonic() - self._computed_at < self.ttl
+
+    def get(self):
+        if self._fresh():
+            return self._value
+        with self._lock:
+            # Another caller may have refreshed it while we waited
+            if not self._fresh():
+                self._value = self.compute()
+                self._computed_at = monotonic()
+            return self._value
+
+
+def get_stats(db, mode: str = None) -> dict:
+    """Returns the dashboard stats through the per-mode TTL cache ("aggregate" or "counters")."""
+    mode = mode or Config.STATS_MODE
+    compute = counter_stats if mode == "counters" else aggregate_stats
+    with _caches_lock:
+        cache = _caches.get((mode, id(db)))
+        if cache is None:
+            cache = _caches[(mode, id(db))] = SingleFlightCache(Config.STATS_CACHE_TTL, lambda: compute(db))
+    return cache.get()
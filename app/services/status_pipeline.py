@@ -0,0 +1,195 @@
+import atexit
+from datetime import datetime, timedelta
+from threading import Lock, Thread, Event
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+from app.data.database import get_db_connection
+from app.config import Config
+from app.services.rollups import record_rollups, STATUS_METRICS
+from app.services.webhook_dedupe import get_webhook_dedupe, dedupe_key
+
+# Lifecycle order of Twilio message statuses; a callback ranked at or below
+# the receipt's current status arrived out of order and is ignored
+STATUS_RANK = {
+    "accepted": 1,
+    "queued": 1,
+    "sending": 2,
+    "sent": 3,
+    "delivered": 4,
+    "undelivered": 4,
+    "failed": 4,
+    "read": 5
+}
+
+_pipeline = None
+_pipeline_lock = Lock()
+
+
+class StatusPipeline:
+    """
+    Coalesces Twilio status callbacks and applies them to the original
+    send receipt, matched on the indexed `twilio_sid`.
+    Callbacks for one sid that arrive within a flush window become a single
+    update: `delivery_status` moves to the furthest status and every
+    transition is appended to a capped `status_history`. The update only
+    matches while the stored status ranks lower, so late or duplicate
+    callbacks never move a receipt backwards. Callbacks that arrive before
+    their receipt has been written are retried for `orphan_ttl` seconds.
+    """
+
+    def __init__(self, max_batch: int = 500, flush_interval: float = 0.5, history_cap: int = 20,
+                 orphan_ttl: float = 60.0, start: bool = True):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.history_cap = history_cap
+        self.orphan_ttl = orphan_ttl
+        self._pending = {}
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._indexed = False
+        self._stopped = Event()
+        self._thread = None
+        if start:
+            self._thread = Thread(target=self._run, name="status-flusher", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def record(self, sid: str, status: str, error_code: str = None):
+        """Buffers one callback; transitions that don't move the message forward are dropped."""
+        rank = STATUS_RANK.get((status or "").lower())
+        if not sid or rank is None:
+            return
+        now = datetime.utcnow()
+        with self._lock:
+            entry = self._pending.setdefault(sid, {"rank": 0, "history": [], "first_seen": now})
+            if rank <= entry["rank"]:
+                return
+            entry.update({"rank": rank, "status": status.lower(), "error_code": error_code})
+            entry["history"].append({"status": status.lower(), "error_code": error_code, "at": now})
+            due = len(self._pending) >= self.max_batch
+        if due:
+            self.flush()
+
+    def flush(self) -> int:
+        """Writes the buffered transitions in one bulk write; returns how many receipts were updated."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+
+            _, db = get_db_connection(Config)
+            try:
+                return self._apply(db, pending)
+            except Exception:
+                # These callbacks were already acknowledged; keep them for the next flush
+                self._requeue(list(pending), pending)
+                raise
+
+    def _apply(self, db, pending: dict) -> int:
+        receipts = db["delivery_receipts"]
+        if not self._indexed:
+            receipts.create_index([("twilio_sid", ASCENDING)])
+            self._indexed = True
+
+        # One indexed read links each sid to its receipt: the campaign for the
+        # rollups, the stored rank to skip regressions, and missing receipts
+        current = {
+            doc["twilio_sid"]: doc
+            for doc in receipts.find({"twilio_sid": {"$in": list(pending)}}, {"twilio_sid": 1, "campaign_id": 1, "status_rank": 1})
+        }
+        orphans = [sid for sid in pending if sid not in current]
+        applicable = {
+            sid: entry for sid, entry in pending.items()
+            if sid in current and entry["rank"] > current[sid].get("status_rank", 0)
+        }
+        if not applicable:
+            self._requeue(orphans, pending, expire=True)
+            return 0
+
+        ops = [
+            UpdateOne(
+                {"twilio_sid": sid, "$or": [
+                    {"status_rank": {"$exists": False}},
+                    {"status_rank": {"$lt": entry["rank"]}}
+                ]},
+                {
+                    "$set": {
+                        "delivery_status": entry["status"],
+                        "status_rank": entry["rank"],
+                        "provider_error_code": entry["error_code"],
+                        "status_updated_at": entry["history"][-1]["at"]
+                    },
+                    "$push": {"status_history": {"$each": entry["history"], "$slice": -self.history_cap}}
+                }
+            )
+            for sid, entry in applicable.items()
+        ]
+        try:
+            updated = receipts.bulk_write(ops, ordered=False).modified_count
+        except BulkWriteError as error:
+            print(f"ERROR: {len(error.details.get('writeErrors', []))} status updates failed: {error}")
+            updated = error.details.get("nModified", 0)
+
+        # Count each newly reached status in the campaign's minute buckets
+        record_rollups(db, [
+            (current[sid].get("campaign_id"), step["at"], STATUS_METRICS.get(step["status"]))
+            for sid, entry in applicable.items()
+            for step in entry["history"]
+            if STATUS_RANK[step["status"]] > current[sid].get("status_rank", 0)
+        ])
+
+        # Only now that they are stored are retries of these callbacks answered as duplicates
+        get_webhook_dedupe(db).claim(
+            dedupe_key(sid, step["status"]) for sid, entry in applicable.items() for step in entry["history"]
+        )
+        self._requeue(orphans, pending, expire=True)
+        return updated
+
+    def _requeue(self, sids, pending, expire: bool = False):
+        """
+        Puts callbacks back for the next flush. With `expire`, callbacks whose
+        receipt still hasn't been written after `orphan_ttl` seconds are dropped.
+        """
+        expired = datetime.utcnow() - timedelta(seconds=self.orphan_ttl)
+        with self._lock:
+            for sid in sids:
+                entry = pending[sid]
+                if expire and entry["first_seen"] < expired:
+                    print(f"WARNING: Dropping status '{entry['status']}' for unknown message {sid}.")
+                    continue
+                # Merge with callbacks that arrived for the same sid during the flush
+                newer = self._pending.get(sid)
+                if newer:
+                    entry["history"] += [h for h in newer["history"] if STATUS_RANK[h["status"]] > entry["rank"]]
+                    if newer["rank"] > entry["rank"]:
+                        entry.update(rank=newer["rank"], status=newer["status"], error_code=newer["error_code"])
+                self._pending[sid] = entry
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as error:
+                print(f"ERROR: Status flusher failed: {error}")
+
+    def close(self):
+        """Stops the flusher and writes whatever is still buffered."""
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+
+def get_status_pipeline() -> StatusPipeline:
+    """Lazily starts the process-wide status pipeline and its flusher."""
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = StatusPipeline(
+                max_batch=Config.STATUS_BATCH_SIZE,
+                flush_interval=Config.STATUS_FLUSH_INTERVAL,
+                history_cap=Config.STATUS_HISTORY_CAP,
+                orphan_ttl=Config.STATUS_ORPHAN_TTL
+            )
+        return _pipeline
@@ -0,0 +1,76 @@
+from threading import Lock
+from time import monotonic
+from pymongo import ASCENDING, ReturnDocument
+from app.config import Config
+
+META_ID = "consent"
+
+_index = None
+_index_db = None
+_index_lock = Lock()
+
+
+def bump_suppression_version(db) -> int:
+    """
+    Marks the set of opted-out users as changed. Every writer of
+    `consent_state` calls this so workers reload their suppression index.
+    """
+    meta = db["suppression_meta"].find_one_and_update(
+        {"_id": META_ID},
+        {"$inc": {"version": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return meta["version"]
+
+
+class SuppressionIndex:
+    """
+    In-memory set of opted-out (STOPPED) user ids, so consent is an O(1)
+    membership check before any user document is fetched or rendered.
+    The set is loaded once and reloaded only when the version counter in
+    `suppression_meta` has moved; the counter is polled at most every
+    `check_interval` seconds.
+    """
+
+    def __init__(self, check_interval: float = 1.0):
+        self.check_interval = check_interval
+        self.version = None
+        self._suppressed = frozenset()
+        self._checked_at = None
+        self._lock = Lock()
+
+    def refresh(self, db, force: bool = False):
+        """Reloads the set if its version changed since the last load."""
+        with self._lock:
+            if not force and self._checked_at is not None and monotonic() - self._checked_at < self.check_interval:
+                return self
+            self._checked_at = monotonic()
+            meta = db["suppression_meta"].find_one({"_id": META_ID}) or {}
+            version = meta.get("version", 0)
+            if version == self.version and not force:
+                return self
+
+            db["users"].create_index([("consent_state", ASCENDING)])
+            self._suppressed = frozenset(
+                user["id"] for user in db["users"].find({"consent_state": "STOPPED"}, {"id": 1, "_id": 0}) if "id" in user
+            )
+            self.version = version
+            return self
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self._suppressed
+
+    def __len__(self) -> int:
+        return len(self._suppressed)
+
+
+def get_suppression_index(db) -> SuppressionIndex:
+    """Returns this process's suppression index, reloaded if consent changed."""
+    global _index, _index_db
+    with _index_lock:
+        # Versions are only comparable within one database
+        if _index is None or _index_db is not db:
+            _index = SuppressionIndex(Config.SUPPRESSION_CHECK_INTERVAL)
+            _index_db = db
+    return _index.refresh(db)
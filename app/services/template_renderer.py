@@ -0,0 +1,70 @@
+import re
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+
+PLACEHOLDER_PATTERN = re.compile(r"\{\{([^{}]+)\}\}")
+
+
+class CompiledTemplate:
+    """
+    A template split once into literal and placeholder parts.
+    `parts` alternates literal text (even indexes) and placeholder names
+    (odd indexes), so rendering is a single join that only looks up the
+    attributes the template actually references.
+    """
+
+    __slots__ = ("content", "parts", "placeholders")
+
+    def __init__(self, content: str):
+        self.content = content
+        # re.split with one capture group yields [literal, name, literal, name, ..., literal]
+        self.parts = tuple(PLACEHOLDER_PATTERN.split(content))
+        self.placeholders = tuple(dict.fromkeys(self.parts[1::2]))
+
+    def render(self, context: dict) -> str:
+        """
+        Renders the template for one recipient.
+        Placeholders missing from `context` are left untouched.
+        """
+        parts = list(self.parts)
+        for i in range(1, len(parts), 2):
+            name = parts[i]
+            parts[i] = str(context[name]) if name in context else f"{{{{{name}}}}}"
+        return "".join(parts)
+
+    def undeclared(self, declared) -> list:
+        """Returns the placeholders used in the content but absent from `declared`."""
+        declared = set(declared or [])
+        return [name for name in self.placeholders if name not in declared]
+
+
+@lru_cache(maxsize=256)
+def compile_template(content: str) -> CompiledTemplate:
+    """Compiles raw template content, memoized by the content itself."""
+    return CompiledTemplate(content)
+
+
+_compiled_by_version = OrderedDict()
+_compiled_lock = Lock()
+_MAX_CACHED_TEMPLATES = 256
+
+
+def get_compiled(template: dict) -> CompiledTemplate:
+    """
+    Returns the compiled form of a template document, cached by its
+    `_id` and `updated_at` so edits invalidate the cached version.
+    """
+    key = (str(template.get("_id")), str(template.get("updated_at")))
+    with _compiled_lock:
+        compiled = _compiled_by_version.get(key)
+        if compiled is not None and compiled.content == template["content"]:
+            _compiled_by_version.move_to_end(key)
+            return compiled
+
+    compiled = CompiledTemplate(template["content"])
+    with _compiled_lock:
+        _compiled_by_version[key] = compiled
+        if len(_compiled_by_version) > _MAX_CACHED_TEMPLATES:
+            _compiled_by_version.popitem(last=False)
+    return compiled
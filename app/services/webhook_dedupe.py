@@ -0,0 +1,119 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock
+from time import monotonic
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError
+from app.config import Config
+
+_dedupe = None
+_dedupe_lock = Lock()
+
+
+def dedupe_key(*parts):
+    """Identifies one webhook delivery, e.g. by MessageSid and MessageStatus; None without a sid."""
+    if not parts or not parts[0]:
+        return None
+    return ":".join(str(part) for part in parts)
+
+
+class WebhookDedupe:
+    """
+    Recognises Twilio webhook retries so they can be acknowledged without
+    writing anything. A key is claimed in `webhook_dedupe`, whose unique
+    `_id` makes the first claim win across workers, by the pipeline that
+    persists the webhook, once its write has gone through, so a retry of a
+    webhook that was lost before reaching Mongo is still applied. The
+    webhook itself only checks for a claim, in an in-process LRU with a TTL
+    first. Dedupe documents expire through a TTL index after `ttl` seconds.
+    """
+
+    def __init__(self, db, ttl: float = 86400, max_entries: int = 100000):
+        self.collection = db["webhook_dedupe"]
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._seen = OrderedDict()
+        self._lock = Lock()
+        self.collection.create_index([("created_at", ASCENDING)], expireAfterSeconds=int(ttl))
+
+    def _seen_recently(self, key: str) -> bool:
+        with self._lock:
+            seen_at = self._seen.get(key)
+            if seen_at is None:
+                return False
+            if monotonic() - seen_at > self.ttl:
+                del self._seen[key]
+                return False
+            self._seen.move_to_end(key)
+            return True
+
+    def _remember(self, key: str):
+        with self._lock:
+            self._seen[key] = monotonic()
+            self._seen.move_to_end(key)
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+
+    def _forget(self, key: str):
+        with self._lock:
+            self._seen.pop(key, None)
+
+    def _fresh(self, claim: dict) -> bool:
+        # Mongo's TTL monitor runs about once a minute, so check the age ourselves
+        return bool(claim) and claim["created_at"] > datetime.utcnow() - timedelta(seconds=self.ttl)
+
+    def is_claimed(self, key: str) -> bool:
+        """Returns True if the webhook was already persisted, here or by another worker, within the TTL."""
+        if not key:
+            return False
+        if self._seen_recently(key):
+            return True
+        if self._fresh(self.collection.find_one({"_id": key})):
+            self._remember(key)
+            return True
+        return False
+
+    def claim(self, keys) -> set:
+        """
+        Claims a batch of keys with one unordered insert and returns the ones
+        claimed by this call; the others were claimed earlier within the TTL.
+        """
+        keys = list(dict.fromkeys(key for key in keys if key))
+        if not keys:
+            return set()
+        now = datetime.utcnow()
+        taken = set()
+        try:
+            self.collection.insert_many([{"_id": key, "created_at": now} for key in keys], ordered=False)
+        except BulkWriteError as error:
+            taken = {keys[err["index"]] for err in error.details.get("writeErrors", []) if err.get("code") == 11000}
+            # Claims past their TTL that the TTL monitor hasn't removed yet can be taken over
+            for claim in self.collection.find({"_id": {"$in": list(taken)}}):
+                if not self._fresh(claim):
+                    replaced = self.collection.replace_one(
+                        {"_id": claim["_id"], "created_at": claim["created_at"]}, {"_id": claim["_id"], "created_at": now}
+                    )
+                    if replaced.modified_count:
+                        taken.discard(claim["_id"])
+        claimed = set(keys) - taken
+        for key in keys:
+            self._remember(key)
+        return claimed
+
+    def release(self, keys):
+        """Gives up claims whose writes failed, so a retry of those webhooks is applied."""
+        keys = [key for key in keys if key]
+        if not keys:
+            return
+        self.collection.delete_many({"_id": {"$in": keys}})
+        for key in keys:
+            self._forget(key)
+
+
+def get_webhook_dedupe(db) -> WebhookDedupe:
+    """Returns this process's webhook dedupe layer."""
+    global _dedupe
+    with _dedupe_lock:
+        if _dedupe is None or _dedupe.collection.database is not db:
+            _dedupe = WebhookDedupe(db, Config.WEBHOOK_DEDUPE_TTL, Config.WEBHOOK_DEDUPE_CACHE_SIZE)
+        return _dedupe
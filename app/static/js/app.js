@@ -22,6 +22,25 @@ function showResult(elementId, data, isError = false) {
         : 'text-xs mt-2 bg-gray-50 p-2 rounded';
 }
 
+/**
+ * Loads every item of a list endpoint by following its page cursor.
+ * @param {string} path - The list endpoint, e.g. '/templates/'.
+ * @param {string} fields - Comma-separated fields to fetch.
+ * @returns {Promise<object[]>} All items, in _id order.
+ */
+async function fetchAll(path, fields) {
+    const items = [];
+    let after = null;
+    do {
+        const params = new URLSearchParams({ limit: 1000, fields });
+        if (after) params.set('after', after);
+        const response = await fetch(`${API_BASE_URL}${path}?${params}`);
+        items.push(...await response.json());
+        after = response.headers.get('X-Next-Cursor');
+    } while (after);
+    return items;
+}
+
 async function uploadUsers() {
     const fileInput = document.getElementById('userFile');
     if (fileInput.files.length === 0) {
@@ -163,8 +182,7 @@ async function runCampaign() {
 
 async function loadTemplates() {
     try {
-        const response = await fetch(`${API_BASE_URL}/templates/`);
-        const templates = await response.json();
+        const templates = await fetchAll('/templates/', 'content');
         const select = document.getElementById('templateSelect');
         select.innerHTML = '<option value="">-- Select a Template --</option>';
         templates.forEach(t => {
@@ -177,8 +195,7 @@ async function loadTemplates() {
 
 async function loadSegments() {
     try {
-        const response = await fetch(`${API_BASE_URL}/segments/`);
-        const segments = await response.json();
+        const segments = await fetchAll('/segments/', 'name');
         const select = document.getElementById('segmentSelect');
         select.innerHTML = '<option value="">-- Select a Segment --</option>';
         segments.forEach(s => {
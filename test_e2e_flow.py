@@ -1,4 +1,6 @@
+import time
 import json
+from datetime import datetime
 from bson.objectid import ObjectId
 from unittest.mock import MagicMock
 
@@ -6,7 +8,7 @@ def test_e2e_webhook_to_campaign_to_status(client, mocker):
     """
     End-to-end test for the following flow:
     1. An event is ingested that triggers a campaign.
-    2. The campaign runner sends a message via a mocked Twilio client.
+    2. The dispatcher drains the trigger and the campaign runner sends a message via a mocked Twilio client.
     3. A status callback is received for the message.
     """
     # --- 1. Setup: Seed the mock database and mock Twilio ---
@@ -61,6 +63,17 @@ def test_e2e_webhook_to_campaign_to_status(client, mocker):
     assert response.status_code == 200
     assert response.json['campaigns_triggered'] == 1
 
+    # The trigger waits in the outbox until the dispatcher drains it
+    mock_twilio_client.messages.create.assert_not_called()
+    from app.services.dispatcher import dispatch_pending
+    from app.services.jobs import get_job
+    job_id = dispatch_pending(db)[campaign_id]
+    for _ in range(100):
+        if get_job(job_id)['status'] in ('completed', 'failed'):
+            break
+        time.sleep(0.05)
+    assert dispatch_pending(db) == {}
+
     # --- 3. Verification (Part 1): Check if Twilio was called ---
 
     mock_twilio_client.messages.create.assert_called_once()
@@ -80,6 +93,217 @@ def test_e2e_webhook_to_campaign_to_status(client, mocker):
 
     # --- 5. Verification (Part 2): Check if the status was logged ---
 
-    receipt = db.delivery_receipts.find_one({"message_sid": "SMxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx"})
-    assert receipt is not None
-    assert receipt['status'] == 'delivered'
+    # A late "sent" callback must not move the receipt backwards
+    client.post('/twilio/status', data={"MessageSid": "SMxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx", "MessageStatus": "sent"})
+    from app.services.status_pipeline import get_status_pipeline
+    get_status_pipeline().flush()
+
+    receipts = list(db.delivery_receipts.find({"twilio_sid": "SMxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx"}))
+    assert len(receipts) == 1
+    assert receipts[0]['delivery_status'] == 'delivered'
+    assert [h['status'] for h in receipts[0]['status_history']] == ['delivered']
+    assert db.delivery_receipts.count_documents({"message_sid": {"$exists": True}}) == 0
+
+
+def test_orchestration_run_is_queued_as_job(client, mocker):
+    """
+    Tests that triggering a campaign returns a job id immediately and that
+    the job endpoint reports the finished run's counters.
+    """
+    from app.data.database import mongo_db as db
+
+    user_id = "+15550002222"
+    template_id = ObjectId()
+    campaign_id = ObjectId()
+    db.users.insert_one({"id": user_id, "consent_state": "STARTED", "attributes": {"name": "Job"}})
+    db.templates.insert_one({"_id": template_id, "content": "Hi {{name}}"})
+    db.subscriptions.insert_one({"user_id": user_id, "topic": "JOBS"})
+    db.campaigns.insert_one({"_id": campaign_id, "topic": "JOBS", "template_id": str(template_id), "status": "scheduled"})
+
+    mock_twilio_client = MagicMock()
+    mock_twilio_client.messages.create.return_value.sid = "SMjob"
+    mocker.patch('app.services.campaign_runner.client', mock_twilio_client)
+
+    response = client.post(f'/api/v1/orchestration/run/{campaign_id}')
+    assert response.status_code == 202
+    job_id = response.json['job_id']
+
+    for _ in range(100):
+        job = client.get(f'/api/v1/orchestration/jobs/{job_id}').json
+        if job['status'] in ('completed', 'failed'):
+            break
+        time.sleep(0.05)
+
+    assert job['status'] == 'completed'
+    assert job['processed'] == 1
+    assert job['sent'] == 1
+    assert client.get(f'/api/v1/orchestration/jobs/{ObjectId()}').status_code == 404
+    assert client.post(f'/api/v1/orchestration/run/{campaign_id}?shards=-1').status_code == 400
+
+    # A campaign with a live job gets that job back instead of a second concurrent run
+    busy_id = str(ObjectId())
+    live_job = db.campaign_jobs.insert_one({"campaign_id": busy_id, "status": "running", "updated_at": datetime.utcnow()}).inserted_id
+    response = client.post(f'/api/v1/orchestration/run/{busy_id}')
+    assert response.status_code == 200
+    assert response.json['job_id'] == str(live_job)
+    assert db.campaign_jobs.count_documents({"campaign_id": busy_id}) == 1
+
+
+def test_ingestion_job_uploads_in_chunks_and_resumes(client):
+    """
+    Tests a resumable chunked upload processed in the background, and that a
+    failed job resumes after its last committed records.
+    """
+    from app.data.database import mongo_db as db
+
+    def wait_for(job_id):
+        for _ in range(100):
+            job = client.get(f'/api/v1/ingestions/jobs/{job_id}').json
+            if job['status'] in ('completed', 'failed'):
+                return job
+            time.sleep(0.05)
+        return job
+
+    content = b"id,name\n+15550003001,Ana\n+15550003002,Ben\n+15550003003,Cal\n"
+    job_id = client.post('/api/v1/ingestions/jobs', json={"kind": "users", "filename": "users.csv"}).json['job_id']
+
+    assert client.put(f'/api/v1/ingestions/jobs/{job_id}/chunks?offset=0', data=content[:20]).json['offset'] == 20
+    conflict = client.put(f'/api/v1/ingestions/jobs/{job_id}/chunks?offset=5', data=content[20:])
+    assert conflict.status_code == 409 and conflict.json['offset'] == 20
+    assert client.put(f'/api/v1/ingestions/jobs/{job_id}/chunks?offset=20', data=content[20:]).json['offset'] == len(content)
+
+    # Pretend an earlier attempt committed the first record and then failed
+    summary = {"total": 1, "valid": 1, "invalid": 0, "duplicates": 0, "merged": 0, "new": 1,
+               "errors": [], "errors_truncated": False}
+    db.ingestion_jobs.update_one({"_id": ObjectId(job_id)}, {"$set": {"status": "failed", "records_done": 1, "summary": summary}})
+
+    assert client.post(f'/api/v1/ingestions/jobs/{job_id}/start').status_code == 202
+    job = wait_for(job_id)
+
+    assert job['status'] == 'completed'
+    assert job['records_done'] == 3 and job['progress_pct'] == 100.0
+    assert job['summary']['new'] == 3
+    assert db.users.count_documents({"id": "+15550003001"}) == 0
+    assert db.users.count_documents({"id": {"$in": ["+15550003002", "+15550003003"]}}) == 2
+    assert db.ingestion_chunks.count_documents({"job_id": ObjectId(job_id)}) == 0
+    assert client.get(f'/api/v1/ingestions/jobs/{ObjectId()}').status_code == 404
+
+
+def test_webhook_retries_are_acknowledged_without_writes(client, mocker):
+    """
+    Tests that a retried inbound message or status callback is applied
+    once, and acknowledged as a duplicate once the first delivery is stored.
+    """
+    from app.data.database import mongo_db as db
+    from app.services import inbound_queue
+    from app.services.inbound_queue import get_inbound_queue
+    from app.services.status_pipeline import get_status_pipeline
+
+    inbound = {"MessageSid": "SMretry01", "From": "whatsapp:+15550009001", "Body": "STOP"}
+    # Flush by hand so the test decides when records are applied
+    queue, pipeline = get_inbound_queue(), get_status_pipeline()
+    for flusher in (queue, pipeline):
+        flusher._stopped.set()
+        flusher._thread.join()
+
+    # Both deliveries are queued before either is applied; the flusher's claim keeps one
+    assert client.post('/twilio/inbound', data=inbound).json['status'] == 'accepted'
+    assert client.post('/twilio/inbound', data=inbound).json['status'] == 'accepted'
+    queue.drain()
+    assert db.events_inbound.count_documents({"message_sid": "SMretry01"}) == 1
+    assert client.post('/twilio/inbound', data=inbound).json['status'] == 'duplicate'
+
+    # A delivery whose write failed isn't claimed, so Twilio's retry still gets applied
+    lost = {"MessageSid": "SMretry02", "From": "whatsapp:+15550009002", "Body": "STOP"}
+    mocker.patch.object(inbound_queue, '_apply_records', side_effect=ConnectionError("mongo down"))
+    client.post('/twilio/inbound', data=lost)
+    assert queue.drain() == 0
+    mocker.stopall()
+    assert client.post('/twilio/inbound', data=lost).json['status'] == 'accepted'
+    queue.drain()
+    assert db.events_inbound.count_documents({"message_sid": "SMretry02"}) == 1
+
+    db.delivery_receipts.insert_one({"twilio_sid": "SMretry01", "decision": "SENT", "status": "SUCCESS"})
+    for status in ("sent", "sent"):
+        assert client.post('/twilio/status', data={"MessageSid": "SMretry01", "MessageStatus": status}).json['status'] == 'updated'
+    pipeline.flush()
+    assert client.post('/twilio/status', data={"MessageSid": "SMretry01", "MessageStatus": "sent"}).json['status'] == 'duplicate'
+    assert client.post('/twilio/status', data={"MessageSid": "SMretry01", "MessageStatus": "delivered"}).json['status'] == 'updated'
+    pipeline.flush()
+    receipt = db.delivery_receipts.find_one({"twilio_sid": "SMretry01"})
+    assert [h["status"] for h in receipt["status_history"]] == ["sent", "delivered"]
+
+
+def test_list_endpoints_page_by_cursor_and_stream_ndjson(client):
+    """Tests keyset pages, projections and filters on list endpoints, and the NDJSON full dump."""
+    from app.data.database import mongo_db as db
+
+    db.subscriptions.insert_many([
+        {"user_id": f"+1555001200{i}", "topic": "PAGED", "subscribed_at": None} for i in range(5)
+    ])
+
+    pages, after = [], ""
+    while True:
+        response = client.get(f"/api/v1/subscriptions/?topic=PAGED&fields=user_id&limit=2&after={after}")
+        assert response.status_code == 200
+        pages.append(response.get_json())
+        after = response.headers.get("X-Next-Cursor")
+        if not after:
+            break
+        assert 'rel="next"' in response.headers["Link"]
+
+    assert [len(page) for page in pages] == [2, 2, 1]
+    rows = [row for page in pages for row in page]
+    assert [row["user_id"] for row in rows] == [f"+1555001200{i}" for i in range(5)]
+    assert set(rows[0]) == {"_id", "user_id"}
+
+    response = client.get("/api/v1/subscriptions/?topic=PAGED&format=ndjson")
+    assert response.mimetype == "application/x-ndjson"
+    streamed = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [row["_id"] for row in streamed] == [row["_id"] for row in rows]
+    assert streamed[0]["topic"] == "PAGED"
+
+    # Filter indexes are built when the app starts, not by list requests
+    assert "topic_1__id_1" in db.subscriptions.index_information()
+    assert client.get("/api/v1/subscriptions/?limit=0").status_code == 400
+    assert isinstance(client.get("/api/v1/templates/").get_json(), list)
+
+
+def test_campaigns_list_while_a_run_is_checkpointed(client, mocker):
+    """Tests that a checkpointed campaign still lists and dumps as JSON, and resumes from the stored cursor."""
+    from app.data.database import mongo_db as db
+    from app.services.campaign_runner import run_campaign
+
+    mocker.patch('app.services.campaign_runner.QuietSchedule.release_at', return_value=None)
+    mock_twilio_client = MagicMock()
+    mock_twilio_client.messages.create.return_value.sid = "SMckpt"
+    mocker.patch('app.services.campaign_runner.client', mock_twilio_client)
+
+    template_id, campaign_id = ObjectId(), ObjectId()
+    db.templates.insert_one({"_id": template_id, "content": "Hi"})
+    db.campaigns.insert_one({"_id": campaign_id, "topic": "CKPTLIST", "template_id": str(template_id), "rate_limit": 6000})
+    for i in range(3):
+        db.users.insert_one({"id": f"+1555001400{i}", "consent_state": "STARTED"})
+        db.subscriptions.insert_one({"user_id": f"+1555001400{i}", "topic": "CKPTLIST"})
+
+    # Crash the run right after its first checkpoint
+    def crash(counts):
+        raise RuntimeError("worker died")
+
+    try:
+        run_campaign(str(campaign_id), progress=crash)
+    except RuntimeError:
+        pass
+    assert db.campaigns.find_one({"_id": campaign_id})["status"] == "running"
+
+    response = client.get("/api/v1/campaigns/?topic=CKPTLIST")
+    assert response.status_code == 200
+    listed = response.get_json()[0]
+    assert ObjectId.is_valid(listed["checkpoint"]["after"])
+    dumped = client.get("/api/v1/campaigns/?topic=CKPTLIST&format=ndjson").get_data(as_text=True)
+    assert json.loads(dumped.splitlines()[0])["checkpoint"] == listed["checkpoint"]
+
+    # The resumed run picks up after the stored cursor instead of re-reading the audience
+    assert run_campaign(str(campaign_id))["already_handled"] == 0
+    assert db.campaigns.find_one({"_id": campaign_id})["status"] == "completed"
+    assert mock_twilio_client.messages.create.call_count == 3
@@ -0,0 +1,673 @@
+import json
+from time import monotonic, sleep
+from datetime import datetime, time, timedelta
+from io import BytesIO
+from unittest.mock import MagicMock, patch
+from bson.objectid import ObjectId
+from mongomock import MongoClient
+from twilio.base.exceptions import TwilioRestException
+from app.services.audience import iter_audience, snapshot_topic_audiences, iter_snapshot_recipients
+from app.services.receipt_sink import ReceiptSink
+from app.services.stats import record_receipt_counts
+from app.services.send_engine import SendEngine
+from app.services.rate_limiter import TokenBucket
+from app.services.template_renderer import compile_template
+from app.services.scheduler import QuietWindow, DeferredQueue
+from app.services.ingestion import iter_json_array, iter_csv_records, ingest_user_records, open_user_records, IngestionError
+
+
+def test_iter_audience_batches_and_preserves_order():
+    """Tests that the audience resolver joins subscriptions to users across batches."""
+    db = MongoClient().db
+    ids = [f"+1555000{i:04d}" for i in range(7)]
+    db.users.insert_many([{"id": uid, "name": f"User {i}"} for i, uid in enumerate(ids) if i != 3])
+    db.subscriptions.insert_many([{"user_id": uid, "topic": "NEWS"} for uid in ids])
+    db.subscriptions.insert_one({"user_id": ids[0], "topic": "OTHER"})
+
+    users = list(iter_audience(db, "NEWS", batch_size=2))
+
+    assert [u["id"] for u in users] == [uid for i, uid in enumerate(ids) if i != 3]
+
+
+def test_receipt_sink_flushes_on_threshold_and_exit():
+    """Tests that the receipt sink bulk-writes on its size threshold and flushes the rest on exit."""
+    db = MongoClient().db
+    try:
+        with ReceiptSink(db.delivery_receipts, max_batch=3, max_interval=60) as receipts:
+            for i in range(4):
+                receipts.insert({"user_id": str(i), "decision": "SENT"})
+            assert db.delivery_receipts.count_documents({}) == 3
+            raise RuntimeError("run aborted")
+    except RuntimeError:
+        pass
+
+    assert db.delivery_receipts.count_documents({}) == 4
+
+
+def test_send_engine_overlaps_slow_sends():
+    """Tests that the send engine runs slow provider calls concurrently and waits for callbacks."""
+    results = []
+    started = monotonic()
+    with SendEngine(max_workers=4) as engine:
+        for i in range(4):
+            engine.submit(lambda n: sleep(0.2) or n, i, callback=results.append)
+        engine.wait()
+
+    assert sorted(results) == [0, 1, 2, 3]
+    assert monotonic() - started < 0.6
+
+
+def test_send_engine_shutdown_keeps_retries_scheduled_by_running_tasks():
+    """Tests that leaving the engine waits for a retry parked by a task that was still running."""
+    results = []
+
+    def first_attempt(engine):
+        sleep(0.1)
+        engine.submit_later(0.05, results.append, "retried")
+
+    with SendEngine(max_workers=2) as engine:
+        engine.submit(first_attempt, engine)
+
+    assert results == ["retried"]
+
+
+def test_token_bucket_paces_sends_evenly():
+    """Tests that the token bucket spreads acquisitions at its configured rate."""
+    bucket = TokenBucket(rate=20, capacity=1)
+    started = monotonic()
+    for _ in range(5):
+        bucket.acquire()
+
+    assert 0.15 <= monotonic() - started < 0.5
+
+
+def test_compiled_template_renders_only_referenced_placeholders():
+    """Tests that a compiled template renders in one pass and reports undeclared placeholders."""
+    compiled = compile_template("Hi {{name}}, {{city}} awaits {{name}}! {{missing}}")
+
+    assert compiled.placeholders == ("name", "city", "missing")
+    assert compiled.render({"name": "Ana", "city": "Lisbon", "unused": 1}) == "Hi Ana, Lisbon awaits Ana! {{missing}}"
+    assert compiled.undeclared(["name", "city"]) == ["missing"]
+
+
+def test_deferred_queue_releases_due_entries_in_time_order():
+    """Tests quiet window wrapping and that deferred sends are claimed earliest-first, once."""
+    window = QuietWindow({"start": "22:00", "end": "07:00"})
+    assert window.contains(time(23, 30)) and window.contains(time(6, 59))
+    assert not window.contains(time(7, 0))
+
+    db = MongoClient().db
+    queue = DeferredQueue(db)
+    now = datetime.utcnow()
+    queue.defer("c1", "+15550000002", now - timedelta(minutes=1))
+    queue.defer("c1", "+15550000001", now - timedelta(minutes=5))
+    queue.defer("c1", "+15550000003", now + timedelta(hours=1))
+    queue.defer("c1", "+15550000001", now - timedelta(minutes=5))
+    queue.flush()
+
+    claimed = queue.claim_due(limit=10, now=now)
+
+    assert [entry["user_id"] for entry in claimed] == ["+15550000001", "+15550000002"]
+    assert queue.claim_due(limit=10, now=now) == []
+    assert queue.next_release_at() > now
+
+
+def test_run_campaign_retries_throttling_but_not_permanent_errors(app, mocker):
+    """Tests that 429s are retried with backoff while invalid numbers fail on the first attempt."""
+    from app.data.database import mongo_db as db
+    from app.services.campaign_runner import run_campaign
+
+    mocker.patch('app.services.campaign_runner.Config.RETRY_BASE_DELAY', 0.01)
+    mocker.patch('app.services.campaign_runner.QuietSchedule.release_at', return_value=None)
+
+    template_id, campaign_id = ObjectId(), ObjectId()
+    db.templates.insert_one({"_id": template_id, "content": "Hi"})
+    db.campaigns.insert_one({"_id": campaign_id, "topic": "RETRY", "template_id": str(template_id), "rate_limit": 6000})
+    for uid in ("+15550003001", "+15550003002"):
+        db.users.insert_one({"id": uid, "consent_state": "STARTED"})
+        db.subscriptions.insert_one({"user_id": uid, "topic": "RETRY"})
+
+    throttled = TwilioRestException(429, "/Messages", "Too Many Requests", code=20429)
+    invalid = TwilioRestException(400, "/Messages", "Invalid 'To' number", code=21211)
+    sent = MagicMock(sid="SMretry")
+    outcomes = {"whatsapp:+15550003001": [throttled, sent], "whatsapp:+15550003002": [invalid]}
+
+    def create(**kwargs):
+        outcome = outcomes[kwargs["to"]].pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    mock_twilio_client = MagicMock()
+    mock_twilio_client.messages.create.side_effect = create
+    mocker.patch('app.services.campaign_runner.client', mock_twilio_client)
+
+    result = run_campaign(str(campaign_id))
+
+    assert result["total_sent"] == 1
+    retried = db.delivery_receipts.find_one({"campaign_id": str(campaign_id), "user_id": "+15550003001"})
+    assert retried["decision"] == "SENT" and retried["attempts"] == 2
+    failed = db.delivery_receipts.find_one({"campaign_id": str(campaign_id), "user_id": "+15550003002"})
+    assert failed["error_class"] == "permanent" and failed["attempts"] == 1 and failed["error_code"] == "21211"
+
+
+def test_run_campaign_resumes_from_checkpoint_without_duplicates(app, mocker):
+    """Tests that a crashed run resumes after its checkpoint and skips users already in the ledger."""
+    from app.data.database import mongo_db as db
+    from app.services.campaign_runner import run_campaign
+
+    mocker.patch('app.services.campaign_runner.QuietSchedule.release_at', return_value=None)
+    mock_twilio_client = MagicMock()
+    mock_twilio_client.messages.create.return_value.sid = "SMresume"
+    mocker.patch('app.services.campaign_runner.client', mock_twilio_client)
+
+    template_id, campaign_id = ObjectId(), ObjectId()
+    ids = [f"+1555000400{i}" for i in range(4)]
+    sub_keys = [ObjectId() for _ in ids]
+    db.templates.insert_one({"_id": template_id, "content": "Hi"})
+    for key, uid in zip(sub_keys, ids):
+        db.users.insert_one({"id": uid, "consent_state": "STARTED"})
+        db.subscriptions.insert_one({"_id": key, "user_id": uid, "topic": "RESUME"})
+
+    # The previous run checkpointed the first subscriber and had already claimed the second
+    db.campaign_deliveries.insert_many([
+        {"campaign_id": str(campaign_id), "user_id": ids[0]},
+        {"campaign_id": str(campaign_id), "user_id": ids[1]},
+    ])
+    db.campaigns.insert_one({
+        "_id": campaign_id, "topic": "RESUME", "template_id": str(template_id), "rate_limit": 6000,
+        "status": "running", "checkpoint": {"after": sub_keys[0], "counts": {"processed": 1, "sent": 1}}
+    })
+
+    result = run_campaign(str(campaign_id))
+
+    sent_to = sorted(call.kwargs["to"] for call in mock_twilio_client.messages.create.call_args_list)
+    assert sent_to == [f"whatsapp:{ids[2]}", f"whatsapp:{ids[3]}"]
+    assert result["total_sent"] == 3 and result["already_handled"] == 1
+
+    campaign = db.campaigns.find_one({"_id": campaign_id})
+    assert campaign["status"] == "completed" and "checkpoint" not in campaign
+    assert run_campaign(str(campaign_id))["total_sent"] == 0
+
+
+def test_crash_mid_batch_does_not_strand_unsent_recipients(app, mocker):
+    """Tests that recipients are claimed one at a time, so users never handed to the engine are sent on restart."""
+    from app.data.database import mongo_db as db
+    from app.services.campaign_runner import run_campaign
+    from app.services.send_engine import SendEngine as Engine
+
+    mocker.patch('app.services.campaign_runner.QuietSchedule.release_at', return_value=None)
+    mock_twilio_client = MagicMock()
+    mock_twilio_client.messages.create.return_value.sid = "SMstrand"
+    mocker.patch('app.services.campaign_runner.client', mock_twilio_client)
+
+    template_id, campaign_id = ObjectId(), ObjectId()
+    ids = [f"+1555001500{i}" for i in range(4)]
+    db.templates.insert_one({"_id": template_id, "content": "Hi"})
+    db.campaigns.insert_one({"_id": campaign_id, "topic": "STRAND", "template_id": str(template_id), "rate_limit": 6000})
+    for uid in ids:
+        db.users.insert_one({"id": uid, "consent_state": "STARTED"})
+        db.subscriptions.insert_one({"user_id": uid, "topic": "STRAND"})
+
+    # The process dies while waiting to hand the second recipient to the engine
+    submit = Engine.submit
+    calls = []
+
+    def dying_submit(self, *args, **kwargs):
+        calls.append(1)
+        if len(calls) == 2:
+            raise RuntimeError("worker died")
+        return submit(self, *args, **kwargs)
+
+    with patch.object(Engine, "submit", dying_submit):
+        try:
+            run_campaign(str(campaign_id))
+        except RuntimeError:
+            pass
+    assert db.campaign_deliveries.count_documents({"campaign_id": str(campaign_id)}) == 2
+
+    result = run_campaign(str(campaign_id))
+    sent_to = sorted(call.kwargs["to"] for call in mock_twilio_client.messages.create.call_args_list)
+    # The recipient claimed when the process died is lost (at-most-once); everyone after it is still sent
+    assert sent_to == [f"whatsapp:{ids[0]}", f"whatsapp:{ids[2]}", f"whatsapp:{ids[3]}"]
+    assert result["already_handled"] == 2
+
+
+def test_checkpoint_is_saved_only_after_deferrals_are_written(app, mocker):
+    """Tests that users deferred in a batch are in deferred_sends before the batch is checkpointed."""
+    from app.data.database import mongo_db as db
+    from app.services.campaign_runner import process_audience
+
+    mocker.patch('app.services.campaign_runner.QuietSchedule.release_at', return_value=datetime.utcnow() + timedelta(hours=1))
+    template_id, campaign_id = ObjectId(), ObjectId()
+    campaign = {"_id": campaign_id, "topic": "QUIETCKPT", "template_id": str(template_id), "rate_limit": 6000}
+    for i in range(3):
+        db.users.insert_one({"id": f"+1555001300{i}", "consent_state": "STARTED"})
+        db.subscriptions.insert_one({"user_id": f"+1555001300{i}", "topic": "QUIETCKPT"})
+
+    durable = []
+    process_audience(db, campaign, {"_id": template_id, "content": "Hi"}, save_checkpoint=lambda after, counts: durable.append(
+        (db.deferred_sends.count_documents({"campaign_id": str(campaign_id)}), counts["delayed"])
+    ))
+
+    assert durable and all(written == delayed for written, delayed in durable)
+    assert durable[-1] == (3, 3)
+
+
+def test_shard_worker_reclaims_expired_leases_and_aggregates(app, mocker):
+    """Tests that a shard worker takes over a dead worker's shard and completes the campaign once."""
+    import pytest
+    from app.data.database import mongo_db as db
+    from app.services.sharding import plan_shards, run_shard_worker
+
+    mocker.patch('app.services.campaign_runner.QuietSchedule.release_at', return_value=None)
+    mock_twilio_client = MagicMock()
+    mock_twilio_client.messages.create.return_value.sid = "SMshard"
+    mocker.patch('app.services.campaign_runner.client', mock_twilio_client)
+
+    template_id, campaign_id = ObjectId(), ObjectId()
+    ids = [f"+155500050{i:02d}" for i in range(12)]
+    db.templates.insert_one({"_id": template_id, "content": "Hi"})
+    db.campaigns.insert_one({"_id": campaign_id, "topic": "SHARDS", "template_id": str(template_id), "rate_limit": 60000})
+    for uid in ids:
+        db.users.insert_one({"id": uid, "consent_state": "STARTED"})
+        db.subscriptions.insert_one({"user_id": uid, "topic": "SHARDS"})
+
+    run_id = plan_shards(db, str(campaign_id), shard_count=3)
+    assert plan_shards(db, str(campaign_id), shard_count=5) == run_id
+    db.campaign_shards.update_one(
+        {"_id": f"{run_id}:0"},
+        {"$set": {"owner": "dead-worker", "status": "running", "lease_expires_at": datetime.utcnow() - timedelta(seconds=1)}}
+    )
+
+    totals = run_shard_worker(str(campaign_id), run_id, worker_id="w1", lease_seconds=5)
+
+    sent_to = sorted(call.kwargs["to"] for call in mock_twilio_client.messages.create.call_args_list)
+    assert sent_to == sorted(f"whatsapp:{uid}" for uid in ids)
+    assert totals["sent"] == 12
+    assert db.campaigns.find_one({"_id": campaign_id})["status"] == "completed"
+    assert db.campaign_shards.count_documents({"run_id": run_id, "status": "done"}) == 3
+
+    # A later run with a different shard count starts fresh and reaches every new subscriber
+    new_ids = [f"+155500051{i:02d}" for i in range(6)]
+    for uid in new_ids:
+        db.users.insert_one({"id": uid, "consent_state": "STARTED"})
+        db.subscriptions.insert_one({"user_id": uid, "topic": "SHARDS"})
+    mock_twilio_client.messages.create.reset_mock()
+
+    next_run = plan_shards(db, str(campaign_id), shard_count=4)
+    assert next_run != run_id
+    totals = run_shard_worker(str(campaign_id), next_run, worker_id="w1", lease_seconds=5)
+
+    sent_to = sorted(call.kwargs["to"] for call in mock_twilio_client.messages.create.call_args_list)
+    assert sent_to == sorted(f"whatsapp:{uid}" for uid in new_ids)
+    assert (totals["sent"], totals["already_handled"]) == (6, 12)
+    assert db.campaigns.find_one({"_id": campaign_id})["last_run_counts"]["sent"] == 6
+    with pytest.raises(ValueError):
+        plan_shards(db, str(campaign_id), shard_count=0)
+    assert db.campaign_shards.count_documents({"campaign_id": str(campaign_id)}) == 4
+
+
+def test_streaming_parsers_read_records_incrementally():
+    """Tests that JSON arrays and CSV files are parsed record by record across small reads."""
+    with open("samples/user.json", "rb") as f:
+        expected = json.load(f)
+    with open("samples/user.json", "rb") as f:
+        assert list(iter_json_array(f, read_size=7)) == expected
+
+    assert list(iter_json_array(BytesIO(b'{"id": "+14155552671"}'))) == [{"id": "+14155552671"}]
+    assert list(iter_json_array(BytesIO(b"[1, 23, 456]"), read_size=2)) == [1, 23, 456]
+
+    rows = list(iter_csv_records(BytesIO("\ufeffid,name\n+14155552671,\"Ana, B\"\n".encode("utf-8"))))
+    assert rows == [{"id": "+14155552671", "name": "Ana, B"}]
+
+
+def test_ingest_user_records_bulk_upserts_and_merges(app):
+    """Tests that chunked bulk upserts create new users and merge existing ones in place."""
+    from app.data.database import mongo_db as db
+    db.users.insert_one({"id": "+14155550100", "name": "Old", "tags": ["vip"], "created_at": datetime(2020, 1, 1)})
+    records = [
+        {"id": "+14155550100", "name": "New", "consent_state": "STARTED"},
+        {"id": "+14155550101", "name": "Fresh", "consent_state": "STARTED"},
+        {"id": "not-a-phone", "name": "Bad"}
+    ]
+
+    summary = ingest_user_records(db, records, chunk_size=2)
+
+    assert (summary["total"], summary["valid"], summary["invalid"]) == (3, 2, 1)
+    assert (summary["new"], summary["merged"]) == (1, 1)
+    merged = db.users.find_one({"id": "+14155550100"})
+    assert merged["name"] == "New" and merged["tags"] == ["vip"]
+    assert merged["created_at"] == datetime(2020, 1, 1)
+    assert db.users.count_documents({"id": "+14155550101"}) == 1
+
+
+def test_user_upload_bumps_suppression_version_only_when_opt_outs_change(app):
+    """Tests that chunks which leave every user's opt-out state alone don't invalidate suppression indexes."""
+    from app.data.database import mongo_db as db
+
+    def version():
+        return (db.suppression_meta.find_one({"_id": "consent"}) or {}).get("version", 0)
+
+    start = version()
+    ingest_user_records(db, [{"id": "+14155550300", "consent_state": "STARTED"}, {"id": "+14155550301", "consent_state": "STOPPED"}])
+    assert version() == start + 1
+    ingest_user_records(db, [{"id": "+14155550300", "name": "Renamed"}, {"id": "+14155550301", "consent_state": "STOPPED"}])
+    assert version() == start + 1
+    ingest_user_records(db, [{"id": "+14155550301", "consent_state": "STARTED"}])
+    assert version() == start + 2
+
+
+def test_ingest_user_records_validates_chunks_on_a_pool_and_caps_errors(app):
+    """Tests that pooled batch validation keeps row numbers and caps the error report."""
+    from app.data.database import mongo_db as db
+
+    records = [{"id": f"+1415555{i:04d}", "name": f"User {i}"} for i in range(8)]
+    records[2]["id"] = "12345"
+    records[5]["consent_state"] = "MAYBE"
+    records[6] = "not an object"
+
+    summary = ingest_user_records(db, records, chunk_size=3, workers=2, parallel_threshold=3, max_errors=2)
+
+    assert (summary["total"], summary["valid"], summary["invalid"], summary["new"]) == (8, 5, 3, 5)
+    assert [(e["row"], e["field"]) for e in summary["errors"]] == [(3, "id"), (6, "consent_state")]
+    assert summary["errors_truncated"] is True
+
+
+def test_ingest_user_records_collapses_repeated_ids(app):
+    """Tests that repeated phone numbers merge last-write-wins into a single write."""
+    from app.data.database import mongo_db as db
+
+    records = [
+        {"id": "+14155550200", "name": "First", "attributes": {"city": "Kandy", "age": 30}},
+        {"id": "+14155550201", "name": "Other"},
+        {"id": " +14155550200", "name": "Second", "attributes": {"city": "Colombo"}},
+    ]
+
+    summary = ingest_user_records(db, records)
+
+    assert (summary["valid"], summary["duplicates"], summary["new"]) == (3, 1, 2)
+    user = db.users.find_one({"id": "+14155550200"})
+    assert user["name"] == "Second" and user["attributes"] == {"city": "Colombo", "age": 30}
+
+
+def test_topic_audience_snapshots_are_chunked_per_topic():
+    """Tests that one aggregation snapshots several topics into bounded chunks that later uploads reuse."""
+    db = MongoClient().db
+    db.subscriptions.insert_many([{"user_id": f"+1555000500{i}", "topic": "A"} for i in range(5)])
+    db.subscriptions.insert_many([{"user_id": "+15550005100", "topic": "B"}])
+
+    audiences = snapshot_topic_audiences(db, ["A", "B", "EMPTY", "A"], chunk_size=2)
+
+    assert {topic: a["recipient_count"] for topic, a in audiences.items()} == {"A": 5, "B": 1, "EMPTY": 0}
+    assert db.audience_snapshots.count_documents({"snapshot_id": audiences["A"]["snapshot_id"], "seq": {"$gte": 0}}) == 3
+    assert list(iter_snapshot_recipients(db, audiences["A"]["snapshot_id"])) == [f"+1555000500{i}" for i in range(5)]
+    assert "created_at_1" in db.audience_snapshots.index_information()
+
+    # A recent snapshot is reused instead of copied again; an expired reuse window takes a new one
+    written = db.audience_snapshots.count_documents({})
+    assert snapshot_topic_audiences(db, ["EMPTY", "A"], reuse_within=60) == {t: audiences[t] for t in ("EMPTY", "A")}
+    assert db.audience_snapshots.count_documents({}) == written
+    assert snapshot_topic_audiences(db, ["B"], reuse_within=0)["B"]["snapshot_id"] != audiences["B"]["snapshot_id"]
+
+
+def test_dispatcher_coalesces_outbox_triggers_per_campaign(mocker):
+    """Tests that pending triggers start one job per campaign and stale claims and dead jobs are retried."""
+    from app.services.dispatcher import dispatch_pending, outbox_entry
+
+    db = MongoClient().db
+    submit = mocker.patch('app.services.jobs.submit_campaign_job', side_effect=lambda cid: f"job-{cid}")
+    db.events_inbound.insert_many([{"dispatch": outbox_entry("c1")} for _ in range(3)])
+    db.events_inbound.insert_one({"dispatch": {**outbox_entry("c2"), "state": "dispatching",
+                                               "claimed_at": datetime.utcnow() - timedelta(hours=1)}})
+    db.events_inbound.insert_one({"event": "inbound_message"})
+
+    assert dispatch_pending(db, stale_after=60) == {"c1": "job-c1", "c2": "job-c2"}
+    assert submit.call_count == 2
+    assert db.events_inbound.count_documents({"dispatch.state": "dispatched"}) == 4
+    assert dispatch_pending(db, stale_after=60) == {}
+
+    # A job whose process stopped heartbeating doesn't absorb new triggers
+    live = db.campaign_jobs.insert_one({"campaign_id": "c3", "status": "running", "updated_at": datetime.utcnow()}).inserted_id
+    dead = db.campaign_jobs.insert_one({"campaign_id": "c4", "status": "running",
+                                        "updated_at": datetime.utcnow() - timedelta(hours=1)}).inserted_id
+    db.events_inbound.insert_many([{"dispatch": outbox_entry("c3")}, {"dispatch": outbox_entry("c4")}])
+    assert dispatch_pending(db, stale_after=60) == {"c3": str(live), "c4": "job-c4"}
+    assert db.campaign_jobs.find_one({"_id": dead})["status"] == "failed"
+
+
+def test_open_user_records_inflates_and_sniffs_formats():
+    """Tests that gzip/zstd uploads are inflated on the fly and NDJSON/JSON are told apart by content."""
+    import gzip
+    import pytest
+    import zstandard
+
+    lines = [{"id": f"+1555000600{i}", "name": f"User {i}"} for i in range(3)]
+    ndjson = "\n".join(json.dumps(line) for line in lines).encode("utf-8")
+
+    assert list(open_user_records(BytesIO(gzip.compress(ndjson)), "users.ndjson.gz")) == lines
+    assert list(open_user_records(BytesIO(gzip.compress(ndjson)), "export.json.gz")) == lines
+    assert list(open_user_records(BytesIO(json.dumps(lines, indent=2).encode()), "export")) == lines
+    assert list(open_user_records(BytesIO(gzip.compress(b"id\n+15550006001\n")), "u.csv.gz")) == [{"id": "+15550006001"}]
+
+    # zstd, both with a known content size and as a streamed frame of unknown size
+    assert list(open_user_records(BytesIO(zstandard.ZstdCompressor().compress(ndjson)), "users.ndjson.zst")) == lines
+    streamed = BytesIO()
+    with zstandard.ZstdCompressor().stream_writer(streamed, closefd=False) as writer:
+        writer.write(json.dumps(lines).encode("utf-8"))
+    assert list(open_user_records(BytesIO(streamed.getvalue()), "export.zst")) == lines
+    frames = zstandard.ZstdCompressor().compress(ndjson[:40]) + zstandard.ZstdCompressor().compress(ndjson[40:])
+    assert list(open_user_records(BytesIO(frames), "users.ndjson.zst")) == lines
+
+    with pytest.raises(IngestionError):
+        list(open_user_records(BytesIO(gzip.compress(ndjson)[:-8]), "users.ndjson.gz"))
+    with pytest.raises(IngestionError):
+        list(open_user_records(BytesIO(zstandard.ZstdCompressor().compress(ndjson)[:-4]), "users.ndjson.zst"))
+    with pytest.raises(IngestionError):
+        open_user_records(BytesIO(b"\x00\x01binary"), "users.bin")
+
+
+def test_inbound_queue_spills_when_full_and_applies_in_order(app, tmp_path):
+    """Tests that overflow spills to disk and queued plus spilled commands are applied in arrival order."""
+    import os
+    from app.data.database import mongo_db as db
+    from app.services.inbound_queue import InboundQueue, parse_inbound
+
+    queue = InboundQueue(str(tmp_path), max_size=2, start=False)
+    for body in ("START", "SUBSCRIBE NEWS", "STOP", "UNSUBSCRIBE NEWS"):
+        queue.put(parse_inbound({"From": "whatsapp:+15550007001", "Body": body}))
+    assert os.path.exists(queue.spill_path)
+
+    assert queue.drain() == 2
+
+    assert db.users.find_one({"id": "+15550007001"})["consent_state"] == "STOPPED"
+    assert db.subscriptions.count_documents({"user_id": "+15550007001", "topic": "NEWS"}) == 0
+    assert db.events_inbound.count_documents({"from": "+15550007001"}) == 4
+    assert not os.path.exists(queue.spill_path)
+
+    queue.put(parse_inbound({"From": "whatsapp:+15550007001", "Body": "START"}))
+    assert not os.path.exists(queue.spill_path) and queue.drain() == 1
+
+
+def test_inbound_queues_only_adopt_spill_files_of_dead_processes(app, tmp_path):
+    """Tests that each queue spills to its own files and only drains another's once its lock is released."""
+    import os
+    from app.data.database import mongo_db as db
+    from app.services.inbound_queue import InboundQueue, parse_inbound
+
+    live = InboundQueue(str(tmp_path), max_size=1, start=False)
+    live.put(parse_inbound({"From": "whatsapp:+15550007200", "Body": "START"}))
+    for body in ("SUBSCRIBE ORPHAN", "STOP"):
+        live.put(parse_inbound({"From": "whatsapp:+15550007201", "Body": body}))
+    # A spill file from before per-process files, whose owner is gone
+    with open(tmp_path / "inbound.spill", "w", encoding="utf-8") as legacy:
+        legacy.write(live._encode(parse_inbound({"From": "whatsapp:+15550007202", "Body": "STOP"})))
+
+    other = InboundQueue(str(tmp_path), max_size=1, start=False)
+    assert other.spill_path != live.spill_path
+    other.drain()
+    assert os.path.exists(live.spill_path) and not os.path.exists(tmp_path / "inbound.spill")
+    assert db.users.find_one({"id": "+15550007202"})["consent_state"] == "STOPPED"
+    assert db.events_inbound.count_documents({"from": "+15550007201"}) == 0
+
+    # The owner shuts down with Mongo unavailable; the next queue to start picks its records up
+    live._lock_file.close()
+    successor = InboundQueue(str(tmp_path), start=False)
+    successor.drain()
+    assert db.events_inbound.count_documents({"from": "+15550007201"}) == 2
+    assert not os.path.exists(live.spill_path)
+
+
+def test_inbound_queue_keeps_batches_that_fail_to_apply(app, tmp_path, mocker):
+    """Tests that a batch Mongo rejected is spilled ahead of later records and applied on the next pass."""
+    import os
+    from app.data.database import mongo_db as db
+    from app.services import inbound_queue
+    from app.services.inbound_queue import InboundQueue, parse_inbound
+
+    queue = InboundQueue(str(tmp_path), max_size=10, batch_size=2, start=False)
+    for body in ("SUBSCRIBE RETRY", "STOP", "START"):
+        queue.put(parse_inbound({"From": "whatsapp:+15550007101", "Body": body}))
+
+    apply = mocker.patch.object(inbound_queue, "apply_inbound_batch", side_effect=ConnectionError("mongo down"))
+    assert queue.drain() == 0
+    assert os.path.exists(queue.spill_path) and apply.call_count == 1
+    queue.put(parse_inbound({"From": "whatsapp:+15550007101", "Body": "UNSUBSCRIBE RETRY"}))
+
+    mocker.stopall()
+    queue.drain()
+    assert db.users.find_one({"id": "+15550007101"})["consent_state"] == "SUBSCRIBED"
+    assert db.subscriptions.count_documents({"user_id": "+15550007101", "topic": "RETRY"}) == 0
+    assert [e["body"] for e in db.events_inbound.find({"from": "+15550007101"})] == ["SUBSCRIBE RETRY", "STOP", "START", "UNSUBSCRIBE RETRY"]
+    assert not os.path.exists(queue.spill_path)
+
+
+def test_status_pipeline_coalesces_transitions_and_ignores_regressions(app):
+    """Tests that a burst of callbacks becomes one receipt update and late statuses are dropped."""
+    from app.data.database import mongo_db as db
+    from app.services.status_pipeline import StatusPipeline
+
+    db.delivery_receipts.insert_one({"twilio_sid": "SMpipe1", "decision": "SENT", "status": "SUCCESS"})
+    pipeline = StatusPipeline(history_cap=3, start=False)
+    for status in ("queued", "sent", "queued", "delivered", "read"):
+        pipeline.record("SMpipe1", status)
+    pipeline.record("SMlater", "sent")
+
+    assert pipeline.flush() == 1
+    receipt = db.delivery_receipts.find_one({"twilio_sid": "SMpipe1"})
+    assert receipt["delivery_status"] == "read" and receipt["status"] == "SUCCESS"
+    assert [h["status"] for h in receipt["status_history"]] == ["sent", "delivered", "read"]
+
+    # A regression is ignored; the callback that beat its receipt is retried once it exists
+    pipeline.record("SMpipe1", "delivered")
+    db.delivery_receipts.insert_one({"twilio_sid": "SMlater", "decision": "SENT"})
+    assert pipeline.flush() == 1
+    assert db.delivery_receipts.find_one({"twilio_sid": "SMpipe1"})["delivery_status"] == "read"
+    assert db.delivery_receipts.find_one({"twilio_sid": "SMlater"})["delivery_status"] == "sent"
+    assert db.delivery_receipts.count_documents({"twilio_sid": {"$in": ["SMpipe1", "SMlater"]}}) == 2
+
+
+def test_suppression_index_filters_opted_out_users_before_fetch(app, mocker):
+    """Tests that opted-out users are dropped from the audience and the index reloads on a version bump."""
+    from app.data.database import mongo_db as db
+    from app.services.campaign_runner import run_campaign
+    from app.services.suppression import SuppressionIndex, bump_suppression_version
+
+    mocker.patch('app.services.campaign_runner.QuietSchedule.release_at', return_value=None)
+    mock_twilio_client = MagicMock()
+    mock_twilio_client.messages.create.return_value.sid = "SMsuppress"
+    mocker.patch('app.services.campaign_runner.client', mock_twilio_client)
+
+    template_id, campaign_id = ObjectId(), ObjectId()
+    db.templates.insert_one({"_id": template_id, "content": "Hi"})
+    db.campaigns.insert_one({"_id": campaign_id, "topic": "SUPPRESS", "template_id": str(template_id), "rate_limit": 6000})
+    for uid, state in (("+15550008001", "STOPPED"), ("+15550008002", "STARTED")):
+        db.users.insert_one({"id": uid, "consent_state": state})
+        db.subscriptions.insert_one({"user_id": uid, "topic": "SUPPRESS"})
+    bump_suppression_version(db)
+
+    result = run_campaign(str(campaign_id))
+
+    assert (result["total_sent"], result["skipped"], result["suppressed"]) == (1, 0, 1)
+    # Only receipt-backed decisions count as skipped, so run counters agree with rollups
+    assert db.campaigns.find_one({"_id": campaign_id})["last_run_counts"].get("skipped", 0) == db.delivery_receipts.count_documents(
+        {"campaign_id": str(campaign_id), "decision": "SKIPPED"}
+    )
+    assert [c.kwargs["to"] for c in mock_twilio_client.messages.create.call_args_list] == ["whatsapp:+15550008002"]
+    assert db.campaign_deliveries.count_documents({"campaign_id": str(campaign_id), "user_id": "+15550008001"}) == 0
+
+    index = SuppressionIndex(check_interval=0).refresh(db)
+    db.users.update_one({"id": "+15550008002"}, {"$set": {"consent_state": "STOPPED"}})
+    assert "+15550008002" not in index.refresh(db)
+    bump_suppression_version(db)
+    assert "+15550008002" in index.refresh(db)
+
+
+def test_stats_modes_agree_and_cache_is_single_flight():
+    """Tests that $facet and counter stats match and concurrent polls share one computation."""
+    from threading import Thread
+    from app.services.stats import aggregate_stats, counter_stats, SingleFlightCache
+    from app.services.suppression import bump_suppression_version
+
+    db = MongoClient().db
+    db.users.insert_many([{"id": "+15550010001", "consent_state": "STOPPED"}, {"id": "+15550010002", "consent_state": "STARTED"}])
+    bump_suppression_version(db)
+    db.delivery_receipts.insert_many([{"status": "SUCCESS"}, {"status": "ERROR"}, {"decision": "SKIPPED"}])
+    assert counter_stats(db) == aggregate_stats(db)
+
+    # Counters pick up later receipts through the sink hook
+    with ReceiptSink(db.delivery_receipts, on_flush=lambda docs: record_receipt_counts(db, docs)) as receipts:
+        receipts.insert({"status": "SUCCESS"})
+    stats = counter_stats(db)
+    assert stats == aggregate_stats(db)
+    assert (stats["total_users"], stats["opt_outs"], stats["sent"], stats["failed"]) == (2, 1, 2, 1)
+
+    calls = []
+    cache = SingleFlightCache(60, lambda: calls.append(1) or sleep(0.1) or len(calls))
+    threads = [Thread(target=cache.get) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1 and cache.get() == 1
+
+
+def test_campaign_rollups_feed_funnel_from_receipts_and_callbacks(app, client, mocker):
+    """Tests that send receipts and status callbacks land in minute rollups served by the analytics endpoint."""
+    from app.data.database import mongo_db as db
+    from app.services.campaign_runner import run_campaign
+    from app.services.status_pipeline import StatusPipeline
+
+    mocker.patch('app.services.campaign_runner.QuietSchedule.release_at', return_value=None)
+    mock_twilio_client = MagicMock()
+    mock_twilio_client.messages.create.side_effect = [MagicMock(sid="SMfunnel1"), MagicMock(sid="SMfunnel2")]
+    mocker.patch('app.services.campaign_runner.client', mock_twilio_client)
+
+    template_id, campaign_id = ObjectId(), ObjectId()
+    db.templates.insert_one({"_id": template_id, "content": "Hi"})
+    db.campaigns.insert_one({"_id": campaign_id, "topic": "FUNNEL", "template_id": str(template_id), "rate_limit": 6000})
+    for uid in ("+15550011001", "+15550011002"):
+        db.users.insert_one({"id": uid, "consent_state": "STARTED"})
+        db.subscriptions.insert_one({"user_id": uid, "topic": "FUNNEL"})
+    assert run_campaign(str(campaign_id))["total_sent"] == 2
+
+    pipeline = StatusPipeline(start=False)
+    for status in ("sent", "delivered", "read"):
+        pipeline.record("SMfunnel1", status)
+    pipeline.record("SMfunnel2", "undelivered")
+    pipeline.flush()
+    # A duplicate terminal callback doesn't count twice
+    pipeline.record("SMfunnel1", "delivered")
+    pipeline.flush()
+
+    response = client.get(f"/api/v1/campaigns/{campaign_id}/analytics?interval=15")
+    assert response.status_code == 200
+    data = response.get_json()
+    funnel = data["funnel"]
+    assert (funnel["sent"], funnel["delivered"], funnel["read"], funnel["failed"]) == (2, 1, 1, 1)
+    assert funnel["delivery_rate"] == 50.0
+    assert sum(point["sent"] for point in data["series"]) == 2
+
+    future = (datetime.utcnow() + timedelta(hours=1)).isoformat()
+    assert client.get(f"/api/v1/campaigns/{campaign_id}/analytics?from={future}").get_json()["funnel"]["sent"] == 0
+    assert client.get(f"/api/v1/campaigns/{campaign_id}/analytics?interval=abc").status_code == 400